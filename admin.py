@@ -10,4 +10,10 @@ admin.site.register(models.MailAcct)
 admin.site.register(models.MailGroup)
 admin.site.register(models.FilterTag)
 admin.site.register(models.Filter)
+
+# --- cached server stats, listed without connecting to any server ---
+class AccountStatsAdmin(admin.ModelAdmin):
+    list_display = ('account', 'connected', 'remote_emails', 'unread', 'checked', 'error')
+
+admin.site.register(models.AccountStats, AccountStatsAdmin)
 # admin.site.register(models.EmailObj)
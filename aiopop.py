@@ -0,0 +1,180 @@
+"""
+asyncio POP3 client, used by controller.main_async so many account sessions
+can stay open on one event loop instead of one blocking poplib connection per
+thread.
+
+method names and return values follow poplib.POP3 so the rest of the app can
+treat the responses the same way:
+    - single line commands return the response line (bytes)
+    - listings (LIST, UIDL, RETR, TOP) return (response, [lines], octets)
+
+usage:
+    conn = await AsyncPOP3.connect('pop.example.com', 995, use_ssl=True)
+    await conn.user('name')
+    await conn.pass_('password')
+    resp, lines, octets = await conn.uidl()
+    await conn.quit()
+"""
+
+import asyncio, ssl
+
+POP3_PORT = 110
+POP3_SSL_PORT = 995
+CRLF = b'\r\n'
+
+# ------------------------------------------------------------------------------
+class POP3Error(Exception):
+    """ raised when the server answers with -ERR or the connection drops """
+    pass
+
+# ******************************************************************************
+class AsyncPOP3:
+    """
+    a single POP3 session on top of an asyncio stream reader/writer pair
+
+    timeout (seconds) applies to every read from the server, None waits forever
+    """
+    def __init__(self, reader, writer, timeout=None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.welcome = None
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    async def connect(cls, host, port=None, use_ssl=False, ssl_context=None, timeout=None):
+        """
+        open a connection and read the server greeting
+
+        use_ssl connects with implicit TLS (POP3_SSL), use stls() afterwards for
+        upgrading a plain connection
+        """
+        if port is None:
+            port = POP3_SSL_PORT if use_ssl else POP3_PORT
+        if use_ssl and ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        #
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host, port,
+                ssl=ssl_context if use_ssl else None,
+                limit=2 ** 20,
+            ),
+            timeout,
+        )
+        conn = cls(reader, writer, timeout)
+        try:
+            conn.welcome = await conn._get_response()
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    # --------------------------------------------------------------------------
+    async def _readline(self) -> bytes:
+        try:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        except ValueError:
+            # --- readline turns LimitOverrunError into ValueError ---
+            raise POP3Error('line too long')
+        if not line:
+            raise POP3Error('connection closed by server')
+        return line.rstrip(b'\r\n')
+
+    async def _get_response(self) -> bytes:
+        resp = await self._readline()
+        if not resp.startswith(b'+'):
+            raise POP3Error(resp.decode('utf-8', 'replace'))
+        return resp
+
+    async def _get_multiline(self) -> tuple:
+        resp = await self._get_response()
+        lines = []
+        octets = 0
+        while True:
+            line = await self._readline()
+            if line == b'.':
+                break
+            # --- undo byte stuffing on lines that started with a dot ---
+            if line.startswith(b'..'):
+                line = line[1:]
+            octets += len(line) + 2
+            lines.append(line)
+        return resp, lines, octets
+
+    async def _send(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self.writer.write(line + CRLF)
+        await self.writer.drain()
+
+    async def _shortcmd(self, line) -> bytes:
+        await self._send(line)
+        return await self._get_response()
+
+    async def _longcmd(self, line) -> tuple:
+        await self._send(line)
+        return await self._get_multiline()
+
+    # --- commands -------------------------------------------------------------
+    async def user(self, user):
+        return await self._shortcmd('USER %s' % user)
+
+    async def pass_(self, pswd):
+        return await self._shortcmd('PASS %s' % pswd)
+
+    async def stls(self, context=None):
+        """
+        upgrade the connection to TLS, needs python 3.11+ (StreamWriter.start_tls)
+        """
+        if context is None:
+            context = ssl.create_default_context()
+        resp = await self._shortcmd('STLS')
+        await asyncio.wait_for(self.writer.start_tls(context), self.timeout)
+        return resp
+
+    async def stat(self) -> tuple:
+        """ returns (message count, mailbox size) """
+        resp = await self._shortcmd('STAT')
+        parts = resp.split()
+        return int(parts[1]), int(parts[2])
+
+    async def list(self, which=None):
+        if which is not None:
+            return await self._shortcmd('LIST %s' % which)
+        return await self._longcmd('LIST')
+
+    async def uidl(self, which=None):
+        if which is not None:
+            return await self._shortcmd('UIDL %s' % which)
+        return await self._longcmd('UIDL')
+
+    async def retr(self, which):
+        return await self._longcmd('RETR %s' % which)
+
+    async def top(self, which, howmany):
+        return await self._longcmd('TOP %s %s' % (which, howmany))
+
+    async def dele(self, which):
+        return await self._shortcmd('DELE %s' % which)
+
+    async def rset(self):
+        return await self._shortcmd('RSET')
+
+    async def noop(self):
+        return await self._shortcmd('NOOP')
+
+    async def quit(self):
+        try:
+            resp = await self._shortcmd('QUIT')
+        finally:
+            self.close()
+        return resp
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """ close the connection without sending QUIT """
+        try:
+            self.writer.close()
+        except Exception:
+            pass
@@ -0,0 +1,159 @@
+"""
+where each attachment sits in the raw bytes of a message, so one attachment
+can be served without parsing (or even reading) the rest of the message.
+
+scan() walks the MIME boundaries in the bytes themselves and returns the
+exact span of every attachment body.  at ingest EmailObj.write_file keeps the
+result in EmailObj.attachment_index, one entry per attachment in message
+order:
+    part          position of the part in the MIME tree (depth first, same
+                  order as msg.walk() for messages without message/rfc822 parts)
+    filename, content_type, encoding (content-transfer-encoding)
+    offset/length span of the encoded body in the stored bytes
+    sha256        only for bodies moved to the blob store (see blobstore),
+                  offset is then where it was cut out of the stored bytes
+
+decode_chunks() turns the encoded body, read a chunk at a time (the stores
+mmap plain files, see emlstore iter_range), into decoded bytes.
+"""
+
+import re, base64, quopri, hashlib
+import email.parser, email.policy
+
+_BLANK_LINE = re.compile(rb'\r?\n\r?\n')
+_LINE_BREAK = re.compile(rb'\r?\n')
+_WHITESPACE = b' \t\r\n'
+
+# ******************************************************************************
+class Span:
+    """ one attachment body found by scan() """
+    __slots__ = ('part', 'start', 'end', 'headers')
+
+    def __init__(self, part, start, end, headers):
+        self.part = part
+        self.start = start
+        self.end = end
+        self.headers = headers
+
+    @property
+    def length(self) -> int:
+        return self.end - self.start
+
+    @property
+    def encoding(self) -> str:
+        return str(self.headers.get('content-transfer-encoding', '7bit')).strip().lower()
+
+# ------------------------------------------------------------------------------
+def _headers(data) -> object:
+    return email.parser.BytesHeaderParser(policy=email.policy.default).parsebytes(data)
+
+def is_attachment(headers) -> bool:
+    """ same parts iter_attachments would call attachments, minus inline text """
+    disposition = headers.get_content_disposition()
+    if disposition == 'attachment':
+        return True
+    return bool(headers.get_filename()) and headers.get_content_maintype() != 'text'
+
+def scan(data) -> list:
+    """
+    Span for every attachment body in a raw message (bytes or anything
+    bytes-like, an mmap works), in message order
+    """
+    spans = []
+    counter = [0]
+    #
+    def walk(start, end):
+        part = counter[0]
+        counter[0] += 1
+        if data[start:start + 1] in (b'\n', b'\r'):
+            # --- no headers at all, body starts after the blank line ---
+            match = _LINE_BREAK.match(data, start)
+            header_end = body_start = match.end()
+        else:
+            match = _BLANK_LINE.search(data, start, end)
+            if match is None:
+                return
+            header_end, body_start = match.start(), match.end()
+        headers = _headers(bytes(data[start:header_end]) + b'\n')
+        #
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_param('boundary')
+            if not boundary:
+                return
+            delimiter = re.compile(
+                rb'(?m)^--' + re.escape(str(boundary).encode('utf-8')) + rb'(--)?[ \t]*\r?$'
+            )
+            part_start = None
+            for match in delimiter.finditer(data, body_start, end):
+                if part_start is not None:
+                    # --- the line break before a delimiter belongs to it ---
+                    part_end = match.start()
+                    if data[part_end - 2:part_end] == b'\r\n':
+                        part_end -= 2
+                    elif data[part_end - 1:part_end] == b'\n':
+                        part_end -= 1
+                    walk(part_start, max(part_start, part_end))
+                if match.group(1):
+                    break
+                line_end = _LINE_BREAK.match(data, match.end())
+                part_start = line_end.end() if line_end else match.end()
+        elif is_attachment(headers):
+            spans.append(Span(part, body_start, end, headers))
+    #
+    walk(0, len(data))
+    return spans
+
+def build_index(spans, data, refs=None) -> list:
+    """
+    attachment_index entries for spans scanned from data, refs are the
+    blobstore refs of bodies cut out of data (in the same order), offsets
+    are shifted to where things are in what's left
+    """
+    refs = list(refs or [])
+    index = []
+    removed = 0
+    for span in spans:
+        entry = {
+            "part": span.part,
+            "filename": span.headers.get_filename(),
+            "content_type": span.headers.get_content_type(),
+            "encoding": span.encoding,
+            "offset": span.start - removed,
+            "length": span.length,
+        }
+        if refs and refs[0]['length'] == span.length and \
+                hashlib.sha256(data[span.start:span.end]).hexdigest() == refs[0]['sha256']:
+            entry['sha256'] = refs.pop(0)['sha256']
+            removed += span.length
+        index.append(entry)
+    return index
+
+# ------------------------------------------------------------------------------
+def decode_chunks(chunks, encoding) -> object:
+    """
+    generator of decoded bytes from an iterable of encoded chunks (split
+    anywhere), only a chunk's worth is held at a time
+    """
+    if encoding == 'base64':
+        carry = b''
+        for chunk in chunks:
+            data = carry + bytes(chunk).translate(None, _WHITESPACE)
+            usable = len(data) - len(data) % 4
+            carry = data[usable:]
+            if usable:
+                yield base64.b64decode(data[:usable])
+        if carry.rstrip(b'='):
+            yield base64.b64decode(carry + b'=' * (-len(carry) % 4))
+    elif encoding == 'quoted-printable':
+        carry = b''
+        for chunk in chunks:
+            data = carry + bytes(chunk)
+            cut = data.rfind(b'\n') + 1
+            carry = data[cut:]
+            if cut:
+                yield quopri.decodestring(data[:cut])
+        if carry:
+            yield quopri.decodestring(carry)
+    else:
+        for chunk in chunks:
+            yield bytes(chunk)
@@ -0,0 +1,421 @@
+"""
+benchmarks for the ingest path, meant to be called from the Django shell:
+
+    from scarifmail import benchmarks
+    print(benchmarks.bench_cleantext(account=models.MailAcct.objects.first()))
+    print(benchmarks.bench_ingest(count=1000))
+    print(benchmarks.bench_scales())
+
+the ingest benchmarks don't need a real mailbox, a generated corpus is served
+by localpop.LocalPOP3Server and fetched through a throwaway MailAcct (removed
+again along with its emails and files when the run is done).  they do write to
+the configured database and MAILDIR, so run them against a scratch copy.
+"""
+# --- general imports ---
+import os, sys, glob, random, time, datetime, email, poplib, resource, tempfile
+from email.message import EmailMessage
+from email.utils import format_datetime
+
+# --- custom/project imports ---
+from scarifmail import models, controller, localpop, poppool, textextract, emlstore
+
+CLEANTEXT_LIMIT = 16383
+
+# ------------------------------------------------------------------------------
+def newsletter_html(rng) -> str:
+    """
+    synthetic newsletter style html: head with style block, tracking script,
+    nested layout tables with inline styles, entities, links and a footer
+    """
+    words = (
+        "sale offer weekly update news team product launch free shipping "
+        "members event webinar discount limited time read more unsubscribe "
+        "account privacy policy today new features customers"
+    ).split()
+    #
+    def sentence(n):
+        return " ".join(rng.choice(words) for _ in range(n)).capitalize() + "."
+    #
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'><title>%s</title>" % sentence(5),
+        "<style>body{margin:0;padding:0} .btn{color:#fff !important;} %s</style>"
+        % " ".join(".c%d{width:%dpx}" % (i, rng.randint(10, 600)) for i in range(40)),
+        "<script>var _t = {id: '%d'}; (function(){ /* tracking */ })();</script>" % rng.randint(1, 10**9),
+        "</head><body><table width='100%' cellpadding='0' cellspacing='0'>",
+    ]
+    for block in range(rng.randint(5, 25)):
+        parts.append(
+            "<tr><td class='c%d' style='font-family:Arial,sans-serif;padding:10px'>" % (block % 40)
+        )
+        parts.append("<h2>%s</h2>" % sentence(rng.randint(3, 8)))
+        for p in range(rng.randint(1, 4)):
+            parts.append("<p>%s &amp; %s &nbsp;&mdash; <a href='https://example.com/%d?utm=x'>%s</a></p>" % (
+                sentence(rng.randint(10, 40)), sentence(5), rng.randint(1, 10**6), sentence(3),
+            ))
+        parts.append(
+            "<img src='https://example.com/img/%d.png' width='600' alt='' />"
+            "<table><tr><td>&copy; 2021</td><td>%s</td></tr></table></td></tr>"
+            % (rng.randint(1, 10**6), sentence(4))
+        )
+    parts.append(
+        "<tr><td><p style='font-size:10px'>%s <a href='#'>unsubscribe</a></p></td></tr>"
+        "</table><img src='https://t.example.com/open.gif' width='1' height='1'></body></html>"
+        % sentence(20)
+    )
+    return "".join(parts)
+
+# ------------------------------------------------------------------------------
+def cleantext_corpus(paths=None, account=None, count=200, seed=1) -> list:
+    """
+    list of html bodies to benchmark cleantext extraction with:
+        - paths: list of .eml files (compressed ones too)
+        - account: every .eml stored for that MailAcct (real mail)
+        - otherwise count synthetic newsletters
+    """
+    if account is not None:
+        paths = glob.glob(os.path.join(models.MAILDIR, account.address, '**', '*.eml*'), recursive=True)
+    if paths:
+        corpus = []
+        for path in paths:
+            try:
+                with emlstore.open_eml(path) as f:
+                    msg = email.message_from_binary_file(f, policy=email.policy.default)
+                body = msg.get_body(preferencelist=('html', 'related', 'plain'))
+                if body is not None:
+                    corpus.append(body.get_content())
+            except Exception:
+                continue
+        return corpus
+    #
+    rng = random.Random(seed)
+    return [newsletter_html(rng) for _ in range(count)]
+
+# ------------------------------------------------------------------------------
+def bench_cleantext(paths=None, account=None, count=200, repeat=3) -> str:
+    """
+    times cleantext extraction with BeautifulSoup (the old path) vs
+    textextract.html_to_text on the same corpus, see cleantext_corpus for the
+    arguments.  also reports how many documents give the same cleantext
+
+    returns the report as a string
+    """
+    corpus = cleantext_corpus(paths, account, count)
+    if not corpus:
+        return "no documents to benchmark"
+    #
+    def run(extract):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for content in corpus:
+                extract(content)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    #
+    soup_time = run(lambda c: textextract.soup_text(c)[:CLEANTEXT_LIMIT])
+    fast_time = run(lambda c: textextract.html_to_text(c, CLEANTEXT_LIMIT)[:CLEANTEXT_LIMIT])
+    same = sum(
+        1 for c in corpus
+        if textextract.soup_text(c)[:CLEANTEXT_LIMIT] == textextract.html_to_text(c, CLEANTEXT_LIMIT)[:CLEANTEXT_LIMIT]
+    )
+    total_bytes = sum(len(c) for c in corpus)
+    #
+    lines = [
+        "documents: %d (%.1f KB avg)" % (len(corpus), total_bytes / len(corpus) / 1024),
+        "beautifulsoup: %.2f ms/doc" % (soup_time * 1000 / len(corpus)),
+        "textextract:   %.2f ms/doc" % (fast_time * 1000 / len(corpus)),
+        "speedup: %.1fx" % (soup_time / fast_time if fast_time else 0),
+        "same cleantext: %d/%d" % (same, len(corpus)),
+    ]
+    return "\n".join(lines)
+
+# ------------------------------------------------------------------------------
+# --- synthetic mail corpus ---
+WORDS = (
+    "meeting invoice schedule report project update please review attached "
+    "thanks regards call tomorrow budget quarter draft final version notes "
+    "customer order shipping delay question answer follow up"
+).split()
+KINDS = ('plain', 'html', 'multipart', 'reply')
+MIX = (0.4, 0.25, 0.15, 0.2) # default share of each kind in a corpus
+START_DATE = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+
+def _text(rng, words) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def synthetic_message(rng, index, kind, thread_ids=None) -> bytes:
+    """
+    one generated message as raw bytes (CRLF line endings, like RETR returns)
+        - plain: short text/plain body
+        - html: newsletter style html body
+        - multipart: text + html alternative with 1-3 binary attachments
+        - reply: text body with In-Reply-To and a References chain built from
+        thread_ids (message ids of the earlier replies, the list is extended)
+    """
+    msg = EmailMessage()
+    message_id = "<bench-%d-%d@localpop.test>" % (index, rng.randint(1, 10**9))
+    msg['From'] = "sender%d@example.com" % rng.randint(1, 200)
+    msg['To'] = "bench@localpop.test"
+    msg['Subject'] = _text(rng, rng.randint(2, 8)).capitalize()
+    msg['Date'] = format_datetime(START_DATE + datetime.timedelta(minutes=index))
+    msg['Message-ID'] = message_id
+    #
+    if kind == 'html':
+        msg.set_content(newsletter_html(rng), subtype='html')
+    elif kind == 'multipart':
+        body = _text(rng, rng.randint(20, 200))
+        msg.set_content(body)
+        msg.add_alternative("<html><body><p>%s</p></body></html>" % body, subtype='html')
+        for n in range(rng.randint(1, 3)):
+            msg.add_attachment(
+                rng.randbytes(rng.randint(512, 16 * 1024)),
+                maintype='application', subtype='octet-stream',
+                filename="attachment-%d-%d.bin" % (index, n),
+            )
+        # --- fixed boundaries so the same seed gives the same bytes ---
+        for n, part in enumerate(part for part in msg.walk() if part.is_multipart()):
+            part.set_boundary("bench-boundary-%d-%d" % (index, n))
+    else:
+        msg.set_content(_text(rng, rng.randint(10, 300)))
+    #
+    if kind == 'reply' and thread_ids is not None:
+        # --- replies carry the whole conversation so far in References ---
+        if thread_ids:
+            msg['In-Reply-To'] = thread_ids[-1]
+            msg['References'] = " ".join(thread_ids)
+        thread_ids.append(message_id)
+    return msg.as_bytes(policy=email.policy.SMTP)
+
+def synthetic_corpus(count, seed=1, mix=MIX, max_refs=200) -> list:
+    """
+    count generated messages as (uidl, raw bytes) tuples in mailbox order,
+    ready for localpop.LocalPOP3Server.  mix is the share of each of KINDS,
+    replies all join one conversation until its References chain reaches
+    max_refs message ids, then a new one is started
+    """
+    rng = random.Random(seed)
+    corpus = []
+    thread_ids = []
+    for index in range(count):
+        kind = rng.choices(KINDS, weights=mix)[0]
+        if len(thread_ids) >= max_refs:
+            thread_ids = []
+        corpus.append((
+            "bench-%d" % index,
+            synthetic_message(rng, index, kind, thread_ids),
+        ))
+    return corpus
+
+# ------------------------------------------------------------------------------
+# --- ingest benchmarks against localpop ---
+BENCH_ADDRESS = "bench@localpop.test"
+
+def peak_rss() -> int:
+    """ peak resident set size of this process so far, in KB """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # --- linux reports KB, macOS reports bytes ---
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+def bench_account(server) -> object:
+    """
+    throwaway MailAcct pointed at a running LocalPOP3Server.  pop_connect
+    only knows SSL/STLS so this instance gets a plain one, poppool calls it
+    whenever the session has to be (re)opened
+    """
+    account, created = models.MailAcct.objects.get_or_create(
+        address=BENCH_ADDRESS,
+        defaults={'user': server.user, 'password': server.password, 'server': '127.0.0.1'},
+    )
+    account.reset_mailbox()
+    account.portno_in = server.port
+    #
+    def pop_connect():
+        connection = poplib.POP3('127.0.0.1', server.port, timeout=30)
+        connection.user(server.user)
+        connection.pass_(server.password)
+        account.connection = connection
+    account.pop_connect = pop_connect
+    with account.pop_session():
+        pass
+    return account
+
+def _summary(name, timings) -> str:
+    """ one report line for a list of per message timings in seconds """
+    if not timings:
+        return "%-15s no samples" % name
+    ordered = sorted(timings)
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+    return "%-15s total %.2fs  mean %.2f ms  p50 %.2f ms  p95 %.2f ms  max %.2f ms" % (
+        name, sum(timings), sum(timings) * 1000 / len(timings), pct(0.5), pct(0.95), ordered[-1] * 1000,
+    )
+
+def bench_ingest(count=1000, seed=1, corpus=None, per_message=False, keep=False) -> str:
+    """
+    fetches count generated messages and saves them one at a time through
+    save_eml (new_eml_object) and write_file, timing each stage
+
+    - fetching goes through a FetchSession like controller.main does,
+    per_message=True calls controller.grab_eml for every message instead
+    (a UIDL listing per message, too slow for the 100k scale)
+    - corpus: (uidl, raw) list to serve instead of generating one
+    - keep: leave the benchmark account, its emails and files in place
+
+    returns the report as a string: messages/sec, latency per stage and peak
+    RSS (process wide, so run each scale in a fresh shell to compare them)
+    """
+    rss_start = peak_rss()
+    if corpus is None:
+        corpus = synthetic_corpus(count, seed)
+    corpus_bytes = sum(len(raw) for uidl, raw in corpus)
+    stages = {'grab_eml': [], 'new_eml_object': [], 'write_file': []}
+    errors = 0
+    #
+    with localpop.LocalPOP3Server(corpus) as server:
+        account = bench_account(server)
+        if per_message:
+            messages = iter(lambda: controller.grab_eml(account), None)
+        else:
+            messages = iter(account.fetch_session())
+        start = time.perf_counter()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                eml_message = next(messages, None)
+                t1 = time.perf_counter()
+                if eml_message is None:
+                    break
+                eml_object = controller.save_eml(account, eml_message)
+                t2 = time.perf_counter()
+                if not controller.write_file(eml_message, eml_object) or eml_object.error:
+                    errors += 1
+                t3 = time.perf_counter()
+                stages['grab_eml'].append(t1 - t0)
+                stages['new_eml_object'].append(t2 - t1)
+                stages['write_file'].append(t3 - t2)
+        finally:
+            elapsed = time.perf_counter() - start
+            poppool.POOL.discard(account)
+            if not keep:
+                account.reset_mailbox()
+                account.delete()
+    #
+    fetched = len(stages['grab_eml'])
+    lines = [
+        "messages: %d of %d (%.1f KB avg), errors: %d" % (
+            fetched, len(corpus), corpus_bytes / max(len(corpus), 1) / 1024, errors,
+        ),
+        "elapsed: %.2fs, %.1f messages/sec" % (elapsed, fetched / elapsed if elapsed else 0),
+    ]
+    lines += [_summary(name, timings) for name, timings in stages.items()]
+    lines.append("peak rss: %d KB (%d KB before the run)" % (peak_rss(), rss_start))
+    return "\n".join(lines)
+
+def bench_main(count=1000, seed=1, batch_size=None, corpus=None, keep=False) -> str:
+    """
+    end to end controller.main run over a generated corpus, batch_size is
+    passed through (None uses INGEST_BATCH_SIZE from scarifsettings)
+
+    returns the report as a string
+    """
+    rss_start = peak_rss()
+    if corpus is None:
+        corpus = synthetic_corpus(count, seed)
+    with localpop.LocalPOP3Server(corpus) as server:
+        account = bench_account(server)
+        start = time.perf_counter()
+        try:
+            error = controller.main(account, batch_size=batch_size)
+        finally:
+            elapsed = time.perf_counter() - start
+            saved = models.EmailObj.objects.filter(user=account).count()
+            poppool.POOL.discard(account)
+            if not keep:
+                account.reset_mailbox()
+                account.delete()
+    #
+    lines = [
+        "messages: %d saved of %d, errors: %s, batch size: %s" % (saved, len(corpus), error, batch_size),
+        "elapsed: %.2fs, %.1f messages/sec" % (elapsed, saved / elapsed if elapsed else 0),
+        "peak rss: %d KB (%d KB before the run)" % (peak_rss(), rss_start),
+    ]
+    return "\n".join(lines)
+
+def bench_scales(scales=(1000, 10000, 100000), seed=1) -> str:
+    """
+    bench_ingest at each corpus size in scales, returns all reports
+    """
+    reports = []
+    for count in scales:
+        reports.append("--- %d messages ---\n%s" % (count, bench_ingest(count, seed)))
+    return "\n\n".join(reports)
+
+# ------------------------------------------------------------------------------
+# --- .eml storage formats ---
+def bench_storage(count=1000, seed=1, corpus=None, formats=(None, 'gzip', 'zstd'), repeat=3) -> str:
+    """
+    writes a generated corpus (or corpus, a list of (uidl, raw) tuples) to a
+    temporary directory in each emlstore format and reports the size on disk,
+    write throughput and read throughput, both for reading the bytes back and
+    for reading + parsing them the way EmailObj.read_file does.  throughput is
+    in MB/s of uncompressed message data, best of repeat runs.  formats whose
+    package isn't installed are skipped
+
+    returns the report as a string
+    """
+    if corpus is None:
+        corpus = synthetic_corpus(count, seed)
+    raw_bytes = sum(len(raw) for uidl, raw in corpus)
+    megabytes = raw_bytes / (1024 * 1024)
+    #
+    def best(run):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        return min(times)
+    #
+    lines = ["messages: %d, %.1f MB uncompressed" % (len(corpus), megabytes)]
+    lines.append("%-8s %10s %8s %12s %12s %12s" % ("format", "disk MB", "ratio", "write MB/s", "read MB/s", "parse MB/s"))
+    for compression in formats:
+        try:
+            emlstore.check_format(compression)
+        except ImportError as e:
+            lines.append("%-8s skipped, %s" % (compression, str(e)))
+            continue
+        with tempfile.TemporaryDirectory() as store:
+            paths = [
+                os.path.join(store, uidl + '.eml' + emlstore.suffix(compression))
+                for uidl, raw in corpus
+            ]
+            #
+            def write():
+                for path, (uidl, raw) in zip(paths, corpus):
+                    with emlstore.open_eml(path, 'wb') as f:
+                        f.write(raw)
+            #
+            def read():
+                for path in paths:
+                    with emlstore.open_eml(path) as f:
+                        f.read()
+            #
+            def parse():
+                for path in paths:
+                    with emlstore.open_eml(path) as f:
+                        email.message_from_binary_file(f, policy=email.policy.default)
+            #
+            write_time = best(write)
+            disk_bytes = sum(os.path.getsize(path) for path in paths)
+            read_time = best(read)
+            parse_time = best(parse)
+        lines.append("%-8s %10.1f %8.2f %12.1f %12.1f %12.1f" % (
+            compression or 'raw',
+            disk_bytes / (1024 * 1024),
+            disk_bytes / raw_bytes,
+            megabytes / write_time,
+            megabytes / read_time,
+            megabytes / parse_time,
+        ))
+    return "\n".join(lines)
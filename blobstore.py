@@ -0,0 +1,140 @@
+"""
+content addressed store for attachment payloads, so the same PDF or logo
+reaching many mailboxes (newsletters, bcc copies across accounts) is only
+stored once.
+
+with ATTACHMENT_BLOBS set in scarifsettings, EmailObj.write_file splits
+attachment bodies of at least ATTACHMENT_BLOB_MIN_BYTES out of the message
+before it goes to the eml store:
+    - each body is stored under the sha256 of its bytes, as they appear in the
+    message (still base64 etc. encoded), in <root>/ab/cd/<sha256>
+    - the .eml file (or segment record) keeps everything else, a "stub" where
+    those bodies are simply cut out
+    - EmailObj.blobs lists where each one was cut out (offset in the stub,
+    sha256, length) plus its filename, content type and transfer encoding
+
+rebuild() splices the bodies back in so read_file gets the message byte for
+byte as it came in.  payload() / iter_payload() decode a single body without
+touching the stub, for serving an attachment directly.  identical copies
+(same bytes on the wire) share a blob, the same file encoded differently by
+another mailer is stored again.  reference counts live in
+models.AttachmentBlob.
+"""
+
+import os, io, mmap, hashlib, threading
+
+from scarifmail import scarifsettings, attachindex
+
+ENABLED = getattr(scarifsettings, 'ATTACHMENT_BLOBS', False)
+MIN_BYTES = getattr(scarifsettings, 'ATTACHMENT_BLOB_MIN_BYTES', 16 * 1024)
+
+# ******************************************************************************
+class BlobStore:
+    """
+    blob files under root, see the module docstring.  writes go to a temp
+    file first so a blob is either complete or not there
+    """
+    def __init__(self, root, min_bytes=MIN_BYTES):
+        self.root = root
+        self.min_bytes = min_bytes
+
+    # --------------------------------------------------------------------------
+    def path(self, digest) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest, data):
+        """ writes the blob unless it's already stored """
+        path = self.path(digest)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, digest) -> bytes:
+        with open(self.path(digest), 'rb') as f:
+            return f.read()
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+    # --------------------------------------------------------------------------
+    def split(self, data, spans=None) -> tuple:
+        """
+        cuts the attachment bodies out of a raw message, returns
+        (stub bytes, refs, {sha256: body bytes}).  refs is [] (and stub is
+        data) if there was nothing big enough to split out.  nothing is
+        written, the caller stores the blobs once it has counted them
+
+        - spans from attachindex.scan(data) if the caller has them already
+        """
+        if spans is None:
+            spans = attachindex.scan(data)
+        refs = []
+        payloads = {}
+        pieces = []
+        position = 0
+        stub_length = 0
+        for span in spans:
+            if span.length < self.min_bytes:
+                continue
+            body = data[span.start:span.end]
+            digest = hashlib.sha256(body).hexdigest()
+            pieces.append(data[position:span.start])
+            stub_length += span.start - position
+            position = span.end
+            payloads[digest] = body
+            refs.append({
+                "offset": stub_length,
+                "sha256": digest,
+                "length": len(body),
+                "filename": span.headers.get_filename(),
+                "content_type": span.headers.get_content_type(),
+                "encoding": span.encoding,
+            })
+        if not refs:
+            return data, [], {}
+        pieces.append(data[position:])
+        return b''.join(pieces), refs, payloads
+
+    def rebuild(self, stub, refs) -> bytes:
+        """ the original message from a stub and its refs """
+        pieces = []
+        position = 0
+        for ref in sorted(refs, key=lambda ref: ref['offset']):
+            pieces.append(stub[position:ref['offset']])
+            pieces.append(self.get(ref['sha256']))
+            position = ref['offset']
+        pieces.append(stub[position:])
+        return b''.join(pieces)
+
+    def open_rebuilt(self, f, refs) -> object:
+        """ wraps an open stub file, returns the rebuilt message as a binary file """
+        with f:
+            stub = f.read()
+        return io.BytesIO(self.rebuild(stub, refs))
+
+    def payload(self, ref) -> bytes:
+        """ decoded attachment body for one ref, read from the blob alone """
+        return b''.join(self.iter_payload(ref))
+
+    def iter_payload(self, ref, chunk_size=1 << 20) -> object:
+        """ decoded attachment body for one ref, a chunk at a time """
+        return attachindex.decode_chunks(self.iter_blob(ref['sha256'], chunk_size), ref.get('encoding'))
+
+    def iter_blob(self, digest, chunk_size=1 << 20) -> object:
+        """ raw blob bytes a chunk at a time, from a memory map of the file """
+        with open(self.path(digest), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+                for start in range(0, len(view), chunk_size):
+                    yield view[start:start + chunk_size]
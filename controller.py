@@ -1,16 +1,18 @@
-import os, pdb
+import os, pdb, time, concurrent.futures, asyncio, collections
 import threading # for acquiring lock
 import dateutil.parser
-import warnings
-from bs4 import BeautifulSoup
 
+from asgiref.sync import sync_to_async
+from django import db
+from django.db import transaction
 from django.utils import timezone
 
 from . import customlog
-from scarifmail import models
+from scarifmail import models, scarifsettings, searchindex, textextract, metrics, emlstore
 
 MAILDIR = models.MAILDIR
 LOCKFILE = "mailcontroller.lockfile"
+CLEANTEXT_LIMIT = 16383 # characters, see EmailObj.cleantext
 
 """
 controller for managing data flow and process of creating emails, threads, etc.
@@ -62,6 +64,54 @@ def get_account_info(account=None) -> str:
     return outputstr
 #
 # ------------------------------------------------------------------------------
+def parse_eml_fields(email, msg_obj):
+    """
+    copies the headers we keep (sender, recipient, references, subject, date,
+    cc, bcc), a cleantext version of the body and the structure summary from
+    msg_obj onto an EmailObj, nothing is saved
+    """
+    email.sender = models.parse_email(msg_obj['from'])[0]
+    email.recipient = models.parse_email(msg_obj['to'])[0]
+    if msg_obj['in-reply-to']:
+        email.in_reply_to = models.parse_email(msg_obj['in-reply-to'])[0]
+
+    if msg_obj['references']:
+        refs = models.parse_email(msg_obj['references'])
+        email.references += ', '.join(refs)
+
+    if msg_obj['subject']:
+        email.subject = msg_obj['subject']
+
+    if msg_obj['date']:
+        email.date = dateutil.parser.parse(msg_obj['date'])
+        # email.date = datetime.datetime.strptime(msg_obj['date'], '%a, %d %b %Y %H:%M:%S %z')
+        if not timezone.is_aware(email.date):
+            email.date = timezone.make_aware(email.date)
+
+    if msg_obj['cc']:
+        email.cc = msg_obj['cc']
+
+    if msg_obj['bcc']:
+        email.bcc = msg_obj['bcc']
+    # --- save a cleantext version of the email body ---
+    body = msg_obj.get_body(preferencelist=('html', 'related', 'plain'))
+    content = body.get_content()
+
+    # vvv 16383 chars stops text from overflowing past SQL limit vvv
+    try:
+        with metrics.timer('cleantext'):
+            cleantext = textextract.html_to_text(content, CLEANTEXT_LIMIT)
+    except:
+        cleantext = content
+
+    cleantext = email.subject + " " + cleantext
+    email.cleantext = cleantext[:CLEANTEXT_LIMIT].lower()
+
+    # --- attachments, html part etc. so templates don't need the file ---
+    with metrics.timer('structure'):
+        email.structure = models.message_structure(msg_obj, getattr(msg_obj, 'raw_size', None))
+#
+# ------------------------------------------------------------------------------
 def new_eml_object(mail_acct, msg_obj, rel_path) -> object:
     """
     save essential headers from email to an email object in database, will be
@@ -72,65 +122,37 @@ def new_eml_object(mail_acct, msg_obj, rel_path) -> object:
 
     """
     # won't make duplicate emails...
-    email, email_created = models.EmailObj.objects.get_or_create(
-        uidl=msg_obj['UIDL'],
-        user=mail_acct,
-    )
+    with metrics.timer('db', mail_acct):
+        email, email_created = models.EmailObj.objects.get_or_create(
+            uidl=msg_obj['UIDL'],
+            user=mail_acct,
+        )
     if email_created:
         email.uidl = msg_obj['UIDL']
         email.message_id = msg_obj['MSG-ID']
         email.fileloc = str(rel_path)
 
         try:
-            email.sender = models.parse_email(msg_obj['from'])[0]
-            email.recipient = models.parse_email(msg_obj['to'])[0]
-            if msg_obj['in-reply-to']:
-                email.in_reply_to = models.parse_email(msg_obj['in-reply-to'])[0]
-
-            if msg_obj['references']:
-                refs = models.parse_email(msg_obj['references'])
-                email.references += ', '.join(refs)
-
-            if msg_obj['subject']:
-                email.subject = msg_obj['subject']
-
-            if msg_obj['date']:
-                email.date = dateutil.parser.parse(msg_obj['date'])
-                # email.date = datetime.datetime.strptime(msg_obj['date'], '%a, %d %b %Y %H:%M:%S %z')
-                if not timezone.is_aware(email.date):
-                    email.date = timezone.make_aware(email.date)
-
-            if msg_obj['cc']:
-                email.cc = msg_obj['cc']
-
-            if msg_obj['bcc']:
-                email.bcc = msg_obj['bcc']
-            # --- save a cleantext version of the email body ---
-            body = msg_obj.get_body(preferencelist=('html', 'related', 'plain'))
-            content = body.get_content()
-
-            try:
-                warnings.filterwarnings('ignore', category=UserWarning, module='bs4')
-                cleantext = " ".join((BeautifulSoup(content, "lxml").text).split())
-            except:
-                cleantext = content
-
-            # vvv 16383 chars stops text from overflowing past SQL limit vvv
-            cleantext = email.subject + " " + cleantext
-            email.cleantext = cleantext[:16383].lower()
+            parse_eml_fields(email, msg_obj)
             # --- assign thread for this email ---
-            email.assign_thread()
+            with metrics.timer('thread', mail_acct):
+                email.assign_thread()
 
             # --- run filters and assign tags to email thread ---
-            email.filter_for_tags()
+            with metrics.timer('filter', mail_acct):
+                email.filter_for_tags()
 
             email.error = False
-            email.save()
+            with metrics.timer('db', mail_acct):
+                email.save()
+            with metrics.timer('index', mail_acct):
+                searchindex.index_emails([email])
 
         except Exception as e:
             error_msg = 'error saving email: '
             error_msg += str(msg_obj['MSG-ID']) + '\n... ' + str(e)
             customlog.writelog("errorlog", error_msg)
+            metrics.count('errors', 1, mail_acct)
             email.error_msg = error_msg
             email.save()
 
@@ -149,12 +171,157 @@ def save_eml(account, eml_message) -> object:
     save eml_message as an object in db, thread will also be assigned inside of
     new_eml_object() function
     """
-    fname = eml_message['UIDL'] + '.eml'
-    filepath = os.path.join(MAILDIR, account.address, fname)
-    return new_eml_object(account, eml_message, filepath)
+    return new_eml_object(account, eml_message, eml_filepath(account, eml_message))
+#
+def eml_filepath(account, eml_message) -> str:
+    """
+    where the .eml file for a message is written to (see emlstore for the
+    suffix and the shard directories)
+    """
+    fname = eml_message['UIDL'] + '.eml' + emlstore.suffix()
+    return emlstore.shard_path(os.path.join(MAILDIR, account.address), fname)
 #
-def write_file(eml_message, eml_object) -> bool:
-    return eml_object.write_file(eml_message)
+def write_file(eml_message, eml_object, save=True) -> bool:
+    return eml_object.write_file(eml_message, save)
+#
+# ------------------------------------------------------------------------------
+def save_eml_batch(account, eml_messages) -> list:
+    """
+    batch version of save_eml for a chunk of messages.  all db writes for the
+    chunk happen in one transaction:
+        - one query for uidls already saved (those are skipped)
+        - new threads and emails go in with bulk_create
+        - tag links and ThreadRef rows are bulk inserted, search index entries
+        are added for the new emails
+        - every uidl in the chunk is marked as seen (and current_uidl moved to
+        the last one)
+
+    threads are matched the same way as assign_thread, including against
+    threads created earlier in the same chunk.  matched threads are marked
+    unread and their summary fields updated with one bulk_update
+    (Thread.summary_changes).  an error
+    parsing, threading or filtering an email is logged and kept on that email
+    like in new_eml_object, the rest of the chunk goes ahead
+
+    returns a list of (eml_message, eml_object) for the new messages, files
+    still need to be written for those
+    """
+    uidls = [eml_message['UIDL'] for eml_message in eml_messages]
+    with metrics.timer('db', account):
+        existing = set(
+            models.EmailObj.objects.filter(user=account, uidl__in=uidls)
+            .values_list('uidl', flat=True)
+        )
+    pairs = []
+    for eml_message in eml_messages:
+        uidl = eml_message['UIDL']
+        if uidl in existing:
+            continue
+        existing.add(uidl)
+        #
+        email = models.EmailObj(
+            uidl=uidl,
+            user=account,
+            message_id=eml_message['MSG-ID'],
+            fileloc=eml_filepath(account, eml_message),
+        )
+        try:
+            parse_eml_fields(email, eml_message)
+            email.error = False
+        except Exception as e:
+            batch_error(account, email, e)
+        pairs.append((eml_message, email))
+    #
+    filters = models.Filter.compiled()
+    with transaction.atomic():
+        # --- threads, message ids seen in this chunk are kept so later emails can match them ---
+        new_threads = []
+        email_threads = []
+        pending = {}
+        linked = {} # emails linked to existing threads, by thread pk
+        with metrics.timer('thread', account):
+            for eml_message, email in pairs:
+                if email.error:
+                    # --- same as new_eml_object, emails with errors get no thread ---
+                    email_threads.append(None)
+                    continue
+                try:
+                    thread = email.find_thread(pending)
+                except Exception as e:
+                    batch_error(account, email, e)
+                    email_threads.append(None)
+                    continue
+                if thread is None:
+                    thread = models.Thread(
+                        thread_id=email.message_id,
+                        user=account,
+                        subject=email.subject,
+                    )
+                    new_threads.append(thread)
+                if thread.pk:
+                    linked.setdefault(thread.pk, []).append(email)
+                else:
+                    thread.note_email(email)
+                if email.message_id:
+                    pending[models.ThreadRef.normalize(email.message_id)] = thread
+                email_threads.append(thread)
+        with metrics.timer('db', account):
+            models.Thread.objects.bulk_create(new_threads)
+            # --- same as assign_thread, unread and counted with F() expressions ---
+            models.Thread.objects.bulk_update(
+                [models.Thread(pk=pk, **models.Thread.summary_changes(emails)) for pk, emails in linked.items()],
+                ['unread'] + models.Thread.SUMMARY_FIELDS,
+            )
+        #
+        # --- emails, thread is assigned after the threads have primary keys ---
+        tag_links = set()
+        with metrics.timer('filter', account):
+            for (eml_message, email), thread in zip(pairs, email_threads):
+                if thread is None:
+                    continue
+                email.thread = thread
+                try:
+                    tags = filters.tags_for(email)
+                except Exception as e:
+                    # --- thread stays linked, same as a filter error in new_eml_object ---
+                    batch_error(account, email, e)
+                    continue
+                for tag_pk in tags:
+                    tag_links.add((thread.pk, tag_pk))
+        with metrics.timer('db', account):
+            models.EmailObj.objects.bulk_create([email for eml_message, email in pairs])
+        with metrics.timer('index', account):
+            searchindex.index_emails([email for eml_message, email in pairs if not email.error])
+        with metrics.timer('db', account):
+            models.ThreadRef.objects.bulk_create(
+                [
+                    models.ThreadRef(message_id=message_id, thread=thread)
+                    for message_id, thread in pending.items()
+                ],
+                ignore_conflicts=True,
+            )
+            #
+            TagLink = models.Thread.tags.through
+            TagLink.objects.bulk_create(
+                [TagLink(thread_id=thread_pk, filtertag_id=tag_pk) for thread_pk, tag_pk in tag_links],
+                ignore_conflicts=True,
+            )
+            #
+            account.mark_seen(uidls)
+    #
+    return pairs
+#
+def batch_error(account, email, e):
+    """
+    error while saving an email in save_eml_batch, logged and kept on the email
+    the same way new_eml_object does (error stays set, not indexed)
+    """
+    error_msg = 'error saving email: '
+    error_msg += str(email.message_id) + '\n... ' + str(e)
+    customlog.writelog("errorlog", error_msg)
+    metrics.count('errors', 1, account)
+    email.error = True
+    email.error_msg = error_msg
 #
 # ------------------------------------------------------------------------------
 
@@ -169,11 +336,146 @@ def make_account_list(account_in) -> list:
         return [account_in]
 #
 # ------------------------------------------------------------------------------
-def main(account_in=None) -> bool:
+def process_messages(account, session) -> bool:
+    """
+    one at a time save/write loop over a FetchSession, returns error flag
+    """
+    error = None
+    try:
+        for eml_message in session:
+            try:
+                eml_object = save_eml(account, eml_message)
+            except Exception as e:
+                customlog.writelog("errorlog", "error in mail controller main.save_eml" + str(e))
+                break
+            #
+            try:
+                if not write_file(eml_message, eml_object):
+                    # error logged in function call
+                    error = True
+                else:
+                    pass
+                #
+            except Exception as e:
+                customlog.writelog("errorlog", "error in mail controller main.write_file" + str(e))
+        else:
+            # --- loop ends on its own once every new message is fetched, or at the deadline ---
+            if session.deadline_hit:
+                customlog.writelog("maillog", "deadline reached, %d left" % len(session.pending))
+            else:
+                customlog.writelog("maillog", "mailbox empty")
+    except Exception as e:
+        customlog.writelog("errorlog", "error in mail controller main.grab_eml" + str(e))
+    #
+    return error
+#
+def process_batches(account, session, batch_size) -> bool:
+    """
+    chunked save/write loop over a FetchSession (opened with checkpoint=False),
+    each chunk is saved by save_eml_batch then its files are written.  returns
+    error flag
+    """
+    error = None
+    chunk = []
+    try:
+        for eml_message in session:
+            chunk.append(eml_message)
+            if len(chunk) < batch_size:
+                continue
+            batch, chunk = chunk, []
+            if not write_batch(account, batch):
+                error = True
+    except Exception as e:
+        customlog.writelog("errorlog", "error in mail controller main.save_eml_batch" + str(e))
+    #
+    # --- messages fetched before the end (or an error) still get saved ---
+    if chunk:
+        try:
+            if not write_batch(account, chunk):
+                error = True
+        except Exception as e:
+            customlog.writelog("errorlog", "error in mail controller main.save_eml_batch" + str(e))
+    #
+    return error
+#
+def write_batch(account, chunk) -> bool:
+    """
+    save_eml_batch followed by write_file for every new message in the chunk,
+    what the writes set on the rows (blobs, attachment index, segment record)
+    is saved with one bulk_update.  returns False if any file couldn't be
+    written
+    """
+    written = True
+    changed = []
+    fields = set()
+    for eml_message, eml_object in save_eml_batch(account, chunk):
+        try:
+            if not write_file(eml_message, eml_object, save=False):
+                written = False
+                continue
+        except Exception as e:
+            customlog.writelog("errorlog", "error in mail controller main.write_file" + str(e))
+            continue
+        written_fields = eml_object.written_fields()
+        if eml_object.pk and written_fields:
+            changed.append(eml_object)
+            fields.update(written_fields)
+    if changed:
+        with metrics.timer('db', account):
+            models.EmailObj.objects.bulk_update(changed, sorted(fields))
+    return written
+#
+# ------------------------------------------------------------------------------
+def process_account(account, batch_size=None) -> bool:
+    """
+    fetch/save/write loop for a single account, returns error flag for the
+    account (None if no errors, True if a file couldn't be written)
+
+    - batch_size saves messages in chunks of that size through save_eml_batch
+    instead of one at a time, defaults to INGEST_BATCH_SIZE in scarifsettings
+    (not set means one at a time)
+    """
+    if batch_size is None:
+        batch_size = getattr(scarifsettings, 'INGEST_BATCH_SIZE', None)
+    # logstr = "main driver started, account %s, connection: %s, messages on server: %s"
+    logstr = "main driver started, account %s, unread messages on server: %s"
+    error = None
+    # --- session takes one UIDL snapshot, used for the whole account ---
+    session = account.fetch_session(checkpoint=not batch_size)
+    customlog.writelog(
+        'maillog',
+        logstr % (
+            str(account),
+            str(session.unread),
+        )
+    )
+    if not session.connection:
+        return error
+    #
+    # --- stages below report under this account, see metrics.py ---
+    with metrics.scope(account), metrics.timer('account', account):
+        if batch_size:
+            error = process_batches(account, session, batch_size)
+        else:
+            error = process_messages(account, session)
+    #
+    customlog.writelog(
+        'maillog',
+        'finished getting emails for %s, errors: %s, messages left: %s' % (
+            str(account),
+            str(error),
+            str(session.unread),
+        )
+    )
+    return error
+#
+# ------------------------------------------------------------------------------
+def main(account_in=None, batch_size=None) -> bool:
     """
     main driver for getting and saving/writing emails
 
     - if account_in argument is missing then will process for all accounts
+    - batch_size turns on batch ingest, see process_account
     """
     # --- attempt to get lock on lockfile here (if environment allows multiple threads) ---
     # if not MailLock.acquire():
@@ -182,70 +484,220 @@ def main(account_in=None) -> bool:
     #     return False # error is false
 
     account_list = make_account_list(account_in)
-    # logstr = "main driver started, account %s, connection: %s, messages on server: %s"
-    logstr = "main driver started, account %s, unread messages on server: %s"
+    models.Filter.reset_compiled() # filters are compiled once per run
     error = False
     try:
         for account in account_list:
-            error = None
+            error = process_account(account, batch_size)
+    except Exception as e:
+        customlog.writelog("maillog", "error - check errorlog")
+        customlog.writelog("errorlog", str(e))
+
+    # # --- release lock if previously obtained ---
+    # MailLock.release()
+
+    return error
+#
+# ------------------------------------------------------------------------------
+def main_parallel(account_in=None, workers=None, batch_size=None) -> dict:
+    """
+    parallel version of main, each account gets its own worker from a thread
+    pool so one slow server doesn't hold up the rest.
+
+    - workers sets the width of the pool, defaults to FETCH_WORKERS in
+    scarifsettings (8 if that isn't set)
+    - batch_size turns on batch ingest, see process_account
+    - returns a dict of {account address: error flag}, an account that raised
+    inside its worker is reported as True
+    """
+    if not workers:
+        workers = getattr(scarifsettings, 'FETCH_WORKERS', 8)
+    #
+    def run_account(account):
+        # --- each worker thread gets its own db connection, close it when done ---
+        try:
+            return process_account(account, batch_size)
+        finally:
+            db.connection.close()
+    #
+    results = {}
+    account_list = list(make_account_list(account_in))
+    models.Filter.reset_compiled() # filters are compiled once per run
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_account, account): account for account in account_list
+        }
+        for future in concurrent.futures.as_completed(futures):
+            account = futures[future]
+            try:
+                results[str(account)] = future.result()
+            except Exception as e:
+                customlog.writelog("maillog", "error - check errorlog")
+                customlog.writelog("errorlog", "%s - %s" % (str(account), str(e)))
+                results[str(account)] = True
+    #
+    return results
+#
+# ------------------------------------------------------------------------------
+def store_eml(account, lines, server_id) -> bool:
+    """
+    blocking part of the async loop for one message: builds the message from
+    the RETR lines, marks it as seen (same as FetchSession) then runs
+    the save/write stages
+
+    returns False if the file couldn't be written, raises if saving failed
+    """
+    with metrics.scope(account):
+        eml_message = models.build_eml_message(lines, server_id)
+        account.mark_seen([server_id])
+        eml_object = save_eml(account, eml_message)
+        try:
+            return write_file(eml_message, eml_object)
+        except Exception as e:
+            customlog.writelog("errorlog", "error in mail controller main.write_file" + str(e))
+            return False
+#
+# ------------------------------------------------------------------------------
+async def async_process_account(account, sessions) -> bool:
+    """
+    asyncio version of process_account.  POP3 traffic stays on the event loop,
+    parsing and the save/write stages go through sync_to_async so the ORM is
+    only used from its worker thread
+
+    - sessions is a semaphore capping how many servers are talked to at once
+    - the account's fetch_deadline is applied the same way as in FetchSession
+    """
+    logstr = "main driver started, account %s, unread messages on server: %s"
+    error = None
+    store = sync_to_async(store_eml)
+    async with sessions:
+        deadline = None
+        if account.fetch_deadline:
+            deadline = time.monotonic() + account.fetch_deadline
+        connection = await account.async_pop_connect()
+        if not connection:
             customlog.writelog(
                 'maillog',
-                logstr % (
-                    str(account),
-                    # str(bool(account.get_connection())),
-                    # "True",
-                    str(account.stat_unread()),
-                )
+                logstr % (str(account), "ERR can't connect: " + account.connect_err)
             )
-            # --- acct.stat_unread will update connection status ---
-            if not account.connection:
-                continue # go to next iteration of for loop
+            await sync_to_async(models.AccountStats.record)(account, error=account.connect_err)
+            return error
+        #
+        pending = collections.deque()
+        cut_off = False
+        try:
+            with metrics.timer('uidl', account):
+                resp, lines, octets = await connection.uidl()
+            snapshot = models.parse_uidl_listing(lines)
+            pending = collections.deque(await sync_to_async(account.new_positions)(snapshot))
+            await sync_to_async(account.sync_server_state)(snapshot)
+            await sync_to_async(models.AccountStats.record)(account, len(snapshot), len(pending))
+            customlog.writelog('maillog', logstr % (str(account), str(len(pending))))
             #
-            while True:
-                try:
-                    eml_message = grab_eml(account)
-                except Exception as e:
-                    customlog.writelog("errorlog", "error in mail controller main.grab_eml" + str(e))
-                    break
-                #
-                if not eml_message:
-                    # --- eml_message will be False when mailbox is empty ---
-                    customlog.writelog("maillog", "mailbox empty")
-                    break
-                #
+            while pending:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        customlog.writelog('maillog', 'fetch session for %s hit its deadline, %d messages left' % (
+                            str(account), len(pending),
+                        ))
+                        metrics.count('deadlines', 1, account)
+                        break
+                    connection.timeout = min(account.read_timeout, remaining)
+                pos, server_id = pending.popleft()
                 try:
-                    eml_object = save_eml(account, eml_message)
-                except Exception as e:
-                    customlog.writelog("errorlog", "error in mail controller main.save_eml" + str(e))
+                    with metrics.timer('retr', account):
+                        resp, lines, octets = await asyncio.wait_for(
+                            connection.retr(pos),
+                            deadline - time.monotonic() if deadline is not None else None,
+                        )
+                except asyncio.TimeoutError:
+                    if deadline is None or time.monotonic() < deadline:
+                        raise
+                    # --- RETR still running at the deadline, message stays for next run ---
+                    pending.appendleft((pos, server_id))
+                    cut_off = True
+                    customlog.writelog('maillog', 'fetch session for %s hit its deadline, %d messages left' % (
+                        str(account), len(pending),
+                    ))
+                    metrics.count('deadlines', 1, account)
                     break
-                #
+                metrics.count('messages', 1, account)
+                metrics.count('bytes', octets, account)
                 try:
-                    if not write_file(eml_message, eml_object):
+                    if not await store(account, lines, server_id):
                         # error logged in function call
                         error = True
-                    else:
-                        pass
-                    #
                 except Exception as e:
-                    customlog.writelog("errorlog", "error in mail controller main.write_file" + str(e))
-            #
-            customlog.writelog(
-                'maillog',
-                'finished getting emails for %s, errors: %s, messages left: %s' % (
-                    str(account),
-                    str(error),
-                    str(account.stat_unread()),
-                )
-            )
-    except Exception as e:
-        customlog.writelog("maillog", "error - check errorlog")
-        customlog.writelog("errorlog", str(e))
-
-    # # --- release lock if previously obtained ---
-    # MailLock.release()
-
+                    customlog.writelog("errorlog", "error in mail controller main.save_eml" + str(e))
+                    break
+            else:
+                customlog.writelog("maillog", "mailbox empty")
+        except Exception as e:
+            customlog.writelog("errorlog", "error in mail controller main.grab_eml" + str(e))
+        finally:
+            try:
+                if cut_off:
+                    # --- rest of the RETR is still on the wire, just hang up ---
+                    connection.close()
+                else:
+                    if not account.autoremove:
+                        await connection.rset()
+                    await connection.quit()
+            except Exception:
+                connection.close()
+            await sync_to_async(models.AccountStats.record)(account, unread=len(pending))
+    #
+    customlog.writelog(
+        'maillog',
+        'finished getting emails for %s, errors: %s, messages left: %s' % (
+            str(account),
+            str(error),
+            str(len(pending)),
+        )
+    )
     return error
 #
 # ------------------------------------------------------------------------------
+async def async_main(account_list, concurrency=None) -> dict:
+    """
+    runs async_process_account for every account in account_list on the
+    current event loop
+
+    - concurrency caps the number of open POP3 sessions, defaults to
+    ASYNC_FETCH_SESSIONS in scarifsettings (200 if that isn't set)
+    - returns a dict of {account address: error flag} like main_parallel
+    """
+    if not concurrency:
+        concurrency = getattr(scarifsettings, 'ASYNC_FETCH_SESSIONS', 200)
+    sessions = asyncio.Semaphore(concurrency)
+    #
+    outcomes = await asyncio.gather(
+        *[async_process_account(account, sessions) for account in account_list],
+        return_exceptions=True,
+    )
+    results = {}
+    for account, outcome in zip(account_list, outcomes):
+        if isinstance(outcome, Exception):
+            customlog.writelog("maillog", "error - check errorlog")
+            customlog.writelog("errorlog", "%s - %s" % (str(account), str(outcome)))
+            outcome = True
+        results[str(account)] = outcome
+    #
+    # --- db work ran on the sync_to_async worker thread, close its connection ---
+    await sync_to_async(db.connection.close)()
+    return results
+#
+def main_async(account_in=None, concurrency=None) -> dict:
+    """
+    entry point for the asyncio fetch loop, same arguments as main plus
+    concurrency (see async_main).  not meant to be called from inside a
+    running event loop, await async_main directly there
+    """
+    account_list = list(make_account_list(account_in))
+    models.Filter.reset_compiled() # filters are compiled once per run
+    return asyncio.run(async_main(account_list, concurrency))
+#
+# ------------------------------------------------------------------------------
 if __name__ == '__main__':
     main()
@@ -12,30 +12,252 @@ writelog('errorlog', 'this is an error log')
 
 # LOG_DIR needs to be defined in <project_name>.settings
 # that will typically be something like: LOG_DIR = os.path.join(BASE_DIR, 'logs')
+
+# optional settings (also in <project_name>.settings):
+#   LOG_BUFFERED        False writes every line straight to the file (default True)
+#   LOG_FLUSH_INTERVAL  seconds between flushes of the buffered writer (default 1)
+#   LOG_QUEUE_SIZE      lines held before new ones are dropped (default 100000)
+#   LOG_MAX_BYTES       rotate a log once it grows past this size (default off)
+#   LOG_ROTATE          'daily' or 'monthly' rotation by time (default off)
 """
 
 import datetime
-import os
+import os, atexit, queue, threading, time
+from main import settings
 from main.settings import LOG_DIR
+
+LOG_BUFFERED = getattr(settings, 'LOG_BUFFERED', True)
+LOG_FLUSH_INTERVAL = getattr(settings, 'LOG_FLUSH_INTERVAL', 1.0)
+LOG_QUEUE_SIZE = getattr(settings, 'LOG_QUEUE_SIZE', 100000)
+LOG_MAX_BYTES = getattr(settings, 'LOG_MAX_BYTES', None)
+LOG_ROTATE = getattr(settings, 'LOG_ROTATE', None)
+
+PERIODS = {'daily': '%Y-%m-%d', 'monthly': '%Y-%m'}
+#
+def format_line(when, message) -> str:
+    timestamp = datetime.datetime.fromtimestamp(when).strftime("%b%d-%D-%H:%M:%S")
+    return timestamp + " " + str(message) + "\n"
+#
+# ------------------------------------------------------------------------------
+class LogFile:
+    """
+    open append handle for one log plus what is needed to rotate it
+
+    - max_bytes: rotate once the file is bigger than this
+    - rotate: 'daily' or 'monthly', rotate when the period changes
+    rotated files are renamed to <logname>.<period or timestamp>
+    """
+    def __init__(self, path, max_bytes=None, rotate=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate = rotate
+        self.open()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.handle = open(self.path, "a+", encoding="utf-8", errors="replace")
+        self.size = self.handle.tell()
+        self.period = self.current_period(os.path.getmtime(self.path) if self.size else time.time())
+
+    def current_period(self, when) -> str:
+        if self.rotate not in PERIODS:
+            return None
+        return datetime.datetime.fromtimestamp(when).strftime(PERIODS[self.rotate])
+
+    # --------------------------------------------------------------------------
+    def write(self, text, when):
+        if self.needs_rotation(when):
+            self.rollover(when)
+        self.handle.write(text)
+        # --- max_bytes is in bytes, not characters ---
+        self.size += len(text.encode("utf-8", "replace"))
+
+    def needs_rotation(self, when) -> bool:
+        if not self.size:
+            return False
+        if self.max_bytes and self.size >= self.max_bytes:
+            return True
+        return self.period is not None and self.period != self.current_period(when)
+
+    def rollover(self, when):
+        self.handle.close()
+        suffix = self.period or datetime.datetime.fromtimestamp(when).strftime("%Y%m%d-%H%M%S")
+        target = "%s.%s" % (self.path, suffix)
+        count = 1
+        while os.path.exists(target):
+            target = "%s.%s.%d" % (self.path, suffix, count)
+            count += 1
+        os.rename(self.path, target)
+        self.open()
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        self.handle.close()
 #
+# ------------------------------------------------------------------------------
+class LogWriter:
+    """
+    background thread writing queued log lines, file handles stay open between
+    writes and are flushed every flush_interval seconds (and on flush()/exit)
+
+    writelog only puts (logname, time, message) on the queue, if the queue is
+    full the line is dropped and counted, the count is written to the log once
+    there is room again.  close() writes what is queued and stops the thread
+    """
+    def __init__(self, log_dir, flush_interval=1.0, queue_size=100000, max_bytes=None, rotate=None):
+        self.log_dir = log_dir
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.rotate = rotate
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.files = {}
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def start(self):
+        """ (re)start the writer thread, also after a fork """
+        with self.lock:
+            if self.thread and self.thread.is_alive() and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.files = {}
+            self.thread = threading.Thread(target=self.run, name="customlog", daemon=True)
+            self.thread.start()
+
+    def put(self, logname, message):
+        if self.pid != os.getpid() or not (self.thread and self.thread.is_alive()):
+            self.start()
+        try:
+            self.queue.put_nowait((logname, time.time(), message))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def flush(self, timeout=5):
+        """ blocks until everything queued so far is on disk """
+        if not (self.thread and self.thread.is_alive()):
+            return
+        done = threading.Event()
+        try:
+            self.queue.put((None, None, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def close(self, timeout=5):
+        """ writes everything queued so far, stops the thread and closes the files """
+        thread = self.thread
+        if not (thread and thread.is_alive()):
+            return
+        self.flush(timeout)
+        try:
+            self.queue.put((None, None, None), timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    # --------------------------------------------------------------------------
+    def run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                items = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                items = []
+            # --- take whatever else is already waiting in one go ---
+            while len(items) < 1000:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            #
+            waiting = []
+            stop = False
+            for logname, when, message in items:
+                if logname is None:
+                    # --- flush() event, or None from close() ---
+                    if message is None:
+                        stop = True
+                    else:
+                        waiting.append(message)
+                    continue
+                self.write(logname, when, message)
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.write('errorlog', time.time(), "customlog - %d log lines dropped, queue full" % dropped)
+            #
+            if waiting or stop or time.monotonic() - last_flush >= self.flush_interval:
+                self.flush_files()
+                last_flush = time.monotonic()
+            for done in waiting:
+                done.set()
+            if stop:
+                self.close_files()
+                return
+
+    def write(self, logname, when, message):
+        try:
+            logfile = self.files.get(logname)
+            if logfile is None:
+                logfile = self.files[logname] = LogFile(
+                    os.path.join(self.log_dir, logname), self.max_bytes, self.rotate,
+                )
+            logfile.write(format_line(when, message), when)
+        except Exception as e:
+            self.files.pop(logname, None)
+            print("error in website logging, reason: ", str(e))
+
+    def flush_files(self):
+        for logfile in list(self.files.values()):
+            try:
+                logfile.flush()
+            except Exception as e:
+                print("error in website logging, reason: ", str(e))
+
+    def close_files(self):
+        for logfile in list(self.files.values()):
+            try:
+                logfile.close()
+            except Exception as e:
+                print("error in website logging, reason: ", str(e))
+        self.files = {}
+#
+WRITER = LogWriter(LOG_DIR, LOG_FLUSH_INTERVAL, LOG_QUEUE_SIZE, LOG_MAX_BYTES, LOG_ROTATE)
+atexit.register(WRITER.close)
+#
+# ------------------------------------------------------------------------------
 def writelog(logname, message):
     '''
     writes a custom log at a location decided in project main.settings
 
-    to do:
-        - rotate logs based on set timeframe (set in main.settings)
-            - default monthly?
+    lines are queued for the background LogWriter unless LOG_BUFFERED is False,
+    call flush() to wait for them to reach the file.  logs are rotated by size
+    (LOG_MAX_BYTES) and/or time (LOG_ROTATE), see the settings at the top
     '''
-    logfile = os.path.join(LOG_DIR, logname)
-    if not os.path.exists(LOG_DIR): os.makedirs(LOG_DIR)
+    if LOG_BUFFERED:
+        WRITER.put(logname, str(message))
+        return
+    #
     try:
-        with open(logfile, "a+") as targetfile:
-            timestamp = datetime.datetime.now().strftime("%b%d-%D-%H:%M:%S")
-            logstring = timestamp + " " + str(message) + "\n"
-            targetfile.write(logstring)
+        logfile = LogFile(os.path.join(LOG_DIR, logname), LOG_MAX_BYTES, LOG_ROTATE)
+        try:
+            when = time.time()
+            logfile.write(format_line(when, message), when)
+        finally:
+            logfile.close()
         #
     except Exception as e:
         print("error in website logging, reason: ", str(e))
+#
+def flush():
+    """ wait for queued log lines to be written """
+    WRITER.flush()
 
 
 #
@@ -0,0 +1,577 @@
+"""
+how .eml files are stored on disk, either one file per message (FileStore,
+plain or compressed per file) or packed into append-only segment files per
+mailbox (SegmentStore).  EML_STORE in scarifsettings picks the store new
+messages are written to ('files', the default, or 'segments'), EmailObj reads,
+trashes and deletes through store_for() so both kinds can be in the db at once.
+
+the format of a file is picked from its name:
+    <uidl>.eml       raw bytes as they came off the server
+    <uidl>.eml.gz    gzip
+    <uidl>.eml.zst   zstandard (needs the zstandard package)
+
+with EML_SHARD_LEVELS set (0, flat, by default) files go into that many levels
+of hash prefix directories under the mailbox so no single directory gets too
+big, e.g. 2 levels: MAILDIR/<address>/3f/a2/<uidl>.eml (trash/3f/a2/ for
+trashed ones).  the directories come from a hash of the uidl, EML_SHARD_WIDTH
+hex characters each.  maintenance.relocate_eml_store moves existing files to
+the configured layout.
+
+new files are written in the EML_COMPRESSION format from scarifsettings
+(None, 'gzip' or 'zstd', level from EML_COMPRESSION_LEVEL), existing files
+keep whatever format they were written in until
+maintenance.convert_eml_store rewrites them.  anything opening a stored
+message should go through open_eml so every format reads the same.
+
+segment layout, under MAILDIR/<address>/segments:
+    000001.seg       records appended one after the other, a new segment is
+                     started once the current one passes EML_SEGMENT_BYTES
+    000001.seg.dead  tombstones, one "<offset> <length>" line per deleted record
+    .lock            flock()ed around appends, tombstones and compaction so
+                     other processes (cron fetch, a shell running
+                     compact_segments) don't write into the same segment
+
+a record is a small header (magic, compression, uidl length), the uidl, then
+the message compressed on its own in the EML_COMPRESSION format.  the
+EmailObj row keeps the segment path in fileloc plus store_offset/store_length,
+so a read is one seek.  deleting only writes a tombstone, the space comes back
+when maintenance.compact_segments copies the live records of a mostly dead
+segment into the current one and removes it.
+"""
+
+import os, io, gzip, mmap, shutil, struct, threading, hashlib, contextlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # windows, appends are only serialized within the process
+
+from scarifmail import scarifsettings
+
+COMPRESSION = getattr(scarifsettings, 'EML_COMPRESSION', None)
+LEVEL = getattr(scarifsettings, 'EML_COMPRESSION_LEVEL', None)
+SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+STORE = getattr(scarifsettings, 'EML_STORE', 'files')
+SHARD_LEVELS = getattr(scarifsettings, 'EML_SHARD_LEVELS', 0)
+SHARD_WIDTH = getattr(scarifsettings, 'EML_SHARD_WIDTH', 2)
+MAX_SHARD_LEVELS = 4
+SEGMENT_BYTES = getattr(scarifsettings, 'EML_SEGMENT_BYTES', 64 * 1024 * 1024)
+
+# ------------------------------------------------------------------------------
+def check_format(compression):
+    if compression not in SUFFIXES:
+        raise ValueError("unknown eml compression %r, use one of %s" % (compression, list(SUFFIXES)))
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("EML_COMPRESSION = 'zstd' needs the zstandard package")
+
+def suffix(compression=COMPRESSION) -> str:
+    """ added after .eml for files written in the given format """
+    return SUFFIXES[compression]
+
+def file_format(path) -> str:
+    """ compression used by the file at path, None for a plain .eml """
+    for compression, ending in SUFFIXES.items():
+        if ending and path.endswith(ending):
+            return compression
+    return None
+
+def base_path(path) -> str:
+    """ path without the compression suffix """
+    ending = SUFFIXES[file_format(path)]
+    return path[:-len(ending)] if ending else path
+
+# ------------------------------------------------------------------------------
+def message_name(path) -> str:
+    """ uidl part of a stored file name (<uidl>.eml[.gz|.zst]) """
+    name = os.path.basename(base_path(path))
+    return name[:-4] if name.endswith('.eml') else name
+
+def shard_dirs(name, levels=None, width=SHARD_WIDTH) -> list:
+    """ hash prefix directories a message with this uidl goes under """
+    levels = SHARD_LEVELS if levels is None else levels
+    if not levels:
+        return []
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    return [digest[i * width:(i + 1) * width] for i in range(levels)]
+
+def shard_path(mailbox, fname, levels=None) -> str:
+    """ where fname goes under the mailbox directory in the sharded layout """
+    return os.path.join(mailbox, *shard_dirs(message_name(fname), levels), fname)
+
+def mailbox_dir(path) -> str:
+    """
+    mailbox (or trash) directory a stored file is in, with or without shard
+    directories in between (files written before the layout changed)
+    """
+    directory = os.path.dirname(path)
+    parts = directory.split(os.sep)
+    name = message_name(path)
+    for levels in range(MAX_SHARD_LEVELS, 0, -1):
+        if len(parts) > levels and parts[-levels:] == shard_dirs(name, levels):
+            return os.sep.join(parts[:-levels])
+    return directory
+
+def place(old_path, new_path):
+    """
+    makes the file at old_path also appear at new_path (hard link, copy if
+    that isn't possible), the caller removes old_path once nothing refers to
+    it.  an existing new_path that is already the same file is fine
+    """
+    os.makedirs(os.path.dirname(new_path), exist_ok=True)
+    try:
+        os.link(old_path, new_path)
+    except FileExistsError:
+        if not os.path.samefile(old_path, new_path):
+            raise
+    except OSError:
+        tmp_path = new_path + '.tmp'
+        shutil.copy2(old_path, tmp_path)
+        os.replace(tmp_path, new_path)
+
+# ------------------------------------------------------------------------------
+def open_eml(path, mode='rb', level=None) -> object:
+    """
+    open a stored message for reading ('rb') or writing ('wb'), data is
+    (de)compressed on the fly based on the file name
+    """
+    compression = file_format(path)
+    if mode.startswith('w'):
+        return open_eml_as(path, compression, level)
+    if compression is None:
+        return open(path, 'rb')
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    check_format(compression)
+    return zstandard.open(path, 'rb')
+
+def open_eml_as(path, compression, level=None) -> object:
+    """ open a file for writing in the given format, whatever its name """
+    if compression is None:
+        return open(path, 'wb')
+    check_format(compression)
+    if level is None:
+        level = LEVEL if LEVEL is not None else DEFAULT_LEVELS[compression]
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=level)
+    return zstandard.open(path, 'wb', cctx=zstandard.ZstdCompressor(level=level))
+
+def raw_size(path) -> int:
+    """ size of the message itself (uncompressed) without reading it all """
+    compression = file_format(path)
+    if compression == 'gzip':
+        with open(path, 'rb') as f:
+            # --- gzip trailer holds the size mod 2**32 ---
+            f.seek(-4, os.SEEK_END)
+            size = int.from_bytes(f.read(4), 'little')
+        if size < os.path.getsize(path):
+            # --- wrapped around (> 4GB) or odd file, count it the slow way ---
+            with open_eml(path) as f:
+                size = sum(len(chunk) for chunk in iter(lambda: f.read(1 << 20), b''))
+        return size
+    if compression == 'zstd':
+        check_format(compression)
+        with open(path, 'rb') as f:
+            size = zstandard.frame_content_size(f.read(18))
+        if size >= 0:
+            return size
+        with open_eml(path) as f:
+            return sum(len(chunk) for chunk in iter(lambda: f.read(1 << 20), b''))
+    return os.path.getsize(path)
+
+# ------------------------------------------------------------------------------
+def convert(path, compression, level=None, remove=True) -> str:
+    """
+    rewrite the file at path in another format, the new file is written next
+    to the old one and only replaces it once it is complete.  returns the new
+    path (the same path if it is already in that format)
+
+    - remove=False leaves the old file in place for the caller to delete
+    """
+    check_format(compression)
+    if file_format(path) == compression:
+        return path
+    new_path = base_path(path) + SUFFIXES[compression]
+    tmp_path = new_path + '.tmp'
+    try:
+        with open_eml(path) as src, open_eml_as(tmp_path, compression, level) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        shutil.copystat(path, tmp_path)
+        os.replace(tmp_path, new_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if remove:
+        os.remove(path)
+    return new_path
+
+# ------------------------------------------------------------------------------
+def message_bytes(eml_message) -> bytes:
+    """ the bytes written for a message (RawMessage or email.message) """
+    if hasattr(eml_message, 'write_to'):
+        buf = io.BytesIO()
+        eml_message.write_to(buf)
+        return buf.getvalue()
+    return bytes(eml_message)
+
+def compress(data, compression, level=None) -> bytes:
+    if compression is None:
+        return data
+    check_format(compression)
+    if level is None:
+        level = LEVEL if LEVEL is not None else DEFAULT_LEVELS[compression]
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+def decompress(data, compression) -> bytes:
+    if compression is None:
+        return data
+    check_format(compression)
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=1 << 31)
+
+def mapped_chunks(path, offset, length, chunk_size=1 << 20) -> object:
+    """ bytes [offset, offset + length) of a file a chunk at a time, through a memory map """
+    if length <= 0:
+        return
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        end = min(offset + length, len(view))
+        for start in range(offset, end, chunk_size):
+            yield view[start:min(start + chunk_size, end)]
+
+def read_chunks(f, length, chunk_size=1 << 20) -> object:
+    """ length bytes from the current position of f a chunk at a time """
+    while length > 0:
+        chunk = f.read(min(chunk_size, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+# ******************************************************************************
+class FileStore:
+    """
+    one .eml file per message at EmailObj.fileloc, the layout described at the
+    top.  trashed files are moved to a trash directory next to them
+    """
+    name = 'files'
+
+    # --------------------------------------------------------------------------
+    def trash_path(self, path) -> str:
+        """ where trash() moves the file at path """
+        fname = os.path.basename(path)
+        return shard_path(os.path.join(mailbox_dir(path), 'trash'), fname)
+
+    def write(self, email, eml_message):
+        os.makedirs(os.path.dirname(email.fileloc), exist_ok=True)
+        with open_eml(email.fileloc, 'wb') as f:
+            if hasattr(eml_message, 'write_to'):
+                # --- RawMessage, server bytes go straight to the file ---
+                eml_message.write_to(f)
+            else:
+                f.write(bytes(eml_message))
+
+    def open(self, email) -> object:
+        """ stored bytes as a binary file """
+        return open_eml(email.fileloc)
+
+    def load(self, email, cache, wrap=None, extra=0) -> object:
+        """
+        parsed message through cache (a msgcache.MessageCache).  wrap is
+        called with the open stored file and returns the file to parse
+        (blobstore splicing attachments back in), extra is what it adds
+        """
+        if wrap is None:
+            return cache.get(email.fileloc)
+        return cache.get(email.fileloc, opener=lambda path, mode: wrap(open_eml(path, mode)), extra=extra)
+
+    def cache_path(self, email) -> str:
+        return email.fileloc
+
+    def iter_range(self, email, offset, length, chunk_size=1 << 20) -> object:
+        """
+        stored bytes [offset, offset + length) a chunk at a time.  plain files
+        are memory mapped, compressed ones are decompressed up to offset
+        (without keeping what's skipped) and read from there
+        """
+        if file_format(email.fileloc) is None:
+            yield from mapped_chunks(email.fileloc, offset, length, chunk_size)
+        else:
+            with open_eml(email.fileloc) as f:
+                f.seek(offset)
+                yield from read_chunks(f, length, chunk_size)
+
+    def raw_size(self, email) -> int:
+        return raw_size(email.fileloc)
+
+    # --------------------------------------------------------------------------
+    def trash(self, email, data=None):
+        """
+        raises FileNotFoundError if the file is already gone.  data is written
+        to the trash instead of the stored bytes (a message rebuilt from a stub)
+        """
+        trash_path = self.trash_path(email.fileloc)
+        os.makedirs(os.path.dirname(trash_path), exist_ok=True)
+        if os.path.exists(trash_path):
+            return
+        if data is None:
+            shutil.move(email.fileloc, trash_path)
+        else:
+            with open_eml(trash_path, 'wb') as f:
+                f.write(data)
+            os.remove(email.fileloc)
+
+    def delete(self, email):
+        os.remove(email.fileloc)
+
+# ******************************************************************************
+class SegmentStore:
+    """
+    messages packed into append-only segment files per mailbox, see the
+    layout at the top.  appends to a mailbox are serialized with a lock per
+    segment directory (a thread lock plus flock on the directory's .lock file
+    for other processes), reads don't take it (records never move while their
+    segment exists)
+    """
+    name = 'segments'
+    HEADER = struct.Struct('<4sBxH') # magic, compression code, uidl length
+    MAGIC = b'SEG1'
+    CODES = {None: 0, 'gzip': 1, 'zstd': 2}
+    SEGMENTS_DIR = 'segments'
+
+    def __init__(self, segment_bytes=SEGMENT_BYTES, compression=COMPRESSION, level=None):
+        self.segment_bytes = segment_bytes
+        self.compression = compression
+        self.level = level
+        self.formats = {code: name for name, code in self.CODES.items()}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def segment_dir(self, path) -> str:
+        """
+        segment directory for a mailbox, path is anything in the mailbox
+        directory (a .eml path from eml_filepath) or a segment in it
+        """
+        directory = os.path.dirname(path)
+        if os.path.basename(directory) == self.SEGMENTS_DIR:
+            return directory
+        return os.path.join(mailbox_dir(path), self.SEGMENTS_DIR)
+
+    def segments(self, directory) -> list:
+        """ segment paths in directory, oldest first """
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.seg'))
+        except FileNotFoundError:
+            return []
+        return [os.path.join(directory, name) for name in names]
+
+    def _dir_lock(self, directory):
+        with self.lock:
+            lock = self.locks.get(directory)
+            if lock is None:
+                lock = self.locks[directory] = threading.Lock()
+            return lock
+
+    @contextlib.contextmanager
+    def locked(self, directory):
+        """ holds the lock for a segment directory, in this process and across processes """
+        with self._dir_lock(directory):
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, '.lock'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _active(self, directory, incoming) -> str:
+        """ segment to append incoming bytes to, lock for directory has to be held """
+        segments = self.segments(directory)
+        if segments:
+            size = os.path.getsize(segments[-1])
+            if size == 0 or size + incoming <= self.segment_bytes:
+                return segments[-1]
+        number = int(os.path.basename(segments[-1])[:-4]) + 1 if segments else 1
+        return os.path.join(directory, '%06d.seg' % number)
+
+    # --------------------------------------------------------------------------
+    def pack(self, uidl, data, compression=None) -> bytes:
+        """ record bytes for a message """
+        uidl = (uidl or '').encode('utf-8')
+        payload = compress(data, compression, self.level)
+        return self.HEADER.pack(self.MAGIC, self.CODES[compression], len(uidl)) + uidl + payload
+
+    def unpack(self, record) -> tuple:
+        """ (uidl, message bytes) from record bytes """
+        magic, code, uidl_len = self.HEADER.unpack_from(record)
+        if magic != self.MAGIC:
+            raise ValueError("not a segment record")
+        start = self.HEADER.size + uidl_len
+        uidl = record[self.HEADER.size:start].decode('utf-8')
+        return uidl, decompress(record[start:], self.formats[code])
+
+    def append(self, directory, record) -> tuple:
+        """
+        appends record bytes to the current (last) segment of directory,
+        returns (segment path, offset, length)
+        """
+        with self.locked(directory):
+            return self._append(directory, record)
+
+    def _append(self, directory, record) -> tuple:
+        """ append, the lock for directory has to be held """
+        os.makedirs(directory, exist_ok=True)
+        path = self._active(directory, len(record))
+        with open(path, 'ab') as f:
+            offset = f.tell()
+            f.write(record)
+        return path, offset, len(record)
+
+    def read_record(self, path, offset, length) -> bytes:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            record = f.read(length)
+        if len(record) != length:
+            raise ValueError("short read in %s at %d" % (path, offset))
+        return record
+
+    def read(self, path, offset, length) -> bytes:
+        """ message bytes of the record at offset """
+        return self.unpack(self.read_record(path, offset, length))[1]
+
+    # --------------------------------------------------------------------------
+    def tombstone(self, path, offset, length):
+        """ marks a record as deleted, the bytes stay until compaction """
+        with self.locked(os.path.dirname(path)):
+            with open(path + '.dead', 'a') as f:
+                f.write("%d %d\n" % (offset, length))
+
+    def tombstones(self, path) -> list:
+        """ (offset, length) of the deleted records in path """
+        try:
+            with open(path + '.dead') as f:
+                return [tuple(int(n) for n in line.split()) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def remove_segment(self, path):
+        with self.locked(os.path.dirname(path)):
+            for name in (path, path + '.dead'):
+                if os.path.exists(name):
+                    os.remove(name)
+
+    # --------------------------------------------------------------------------
+    def write(self, email, eml_message):
+        """
+        appends the message and points email at the record, saving the row is
+        left to the caller (EmailObj.write_file)
+        """
+        record = self.pack(email.uidl, message_bytes(eml_message), self.compression)
+        email.fileloc, email.store_offset, email.store_length = self.append(
+            self.segment_dir(email.fileloc), record,
+        )
+
+    def open(self, email) -> object:
+        return io.BytesIO(self.read(email.fileloc, email.store_offset, email.store_length))
+
+    def load(self, email, cache, wrap=None, extra=0) -> object:
+        path, offset, length = email.fileloc, email.store_offset, email.store_length
+        wrap = wrap or (lambda f: f)
+        return cache.get(
+            self.cache_path(email), size=length, extra=extra,
+            opener=lambda key, mode: wrap(io.BytesIO(self.read(path, offset, length))),
+        )
+
+    def cache_path(self, email) -> str:
+        return self.record_key(email.fileloc, email.store_offset)
+
+    def iter_range(self, email, offset, length, chunk_size=1 << 20) -> object:
+        """
+        bytes [offset, offset + length) of the stored message a chunk at a
+        time, straight from a memory map of the segment for uncompressed
+        records (compressed ones are decompressed whole)
+        """
+        with open(email.fileloc, 'rb') as f:
+            f.seek(email.store_offset)
+            magic, code, uidl_len = self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError("not a segment record")
+        if self.formats[code] is None:
+            start = email.store_offset + self.HEADER.size + uidl_len + offset
+            yield from mapped_chunks(email.fileloc, start, length, chunk_size)
+        else:
+            data = self.read(email.fileloc, email.store_offset, email.store_length)
+            for start in range(offset, offset + length, chunk_size):
+                yield data[start:min(start + chunk_size, offset + length)]
+
+    def record_key(self, path, offset) -> str:
+        """ MessageCache key of the record at offset """
+        return "%s#%d" % (path, offset)
+
+    def raw_size(self, email) -> int:
+        return len(self.read(email.fileloc, email.store_offset, email.store_length))
+
+    # --------------------------------------------------------------------------
+    def trash(self, email, data=None):
+        """
+        copies the record to the mailbox trash segments, then tombstones it.
+        raises FileNotFoundError if the segment is gone.  data is trashed
+        instead of the stored bytes
+        """
+        if data is None:
+            record = self.read_record(email.fileloc, email.store_offset, email.store_length)
+        else:
+            record = self.pack(email.uidl, data, self.compression)
+        mailbox = os.path.dirname(self.segment_dir(email.fileloc))
+        self.append(os.path.join(mailbox, 'trash', self.SEGMENTS_DIR), record)
+        self.tombstone(email.fileloc, email.store_offset, email.store_length)
+
+    def delete(self, email):
+        self.tombstone(email.fileloc, email.store_offset, email.store_length)
+
+    # --------------------------------------------------------------------------
+    def compact(self, path, records) -> dict:
+        """
+        copies live records out of the segment at path into the current
+        segment of the same directory (path can't be the current one).
+        records is [(key, offset, length)], tombstoned ones are skipped,
+        returns {key: (new path, new offset, length)}.  the caller points its
+        rows at the new locations and then calls remove_segment(path)
+        """
+        directory = os.path.dirname(path)
+        moved = {}
+        with self.locked(directory), open(path, 'rb') as f:
+            dead = set(self.tombstones(path))
+            for key, offset, length in records:
+                if (offset, length) in dead:
+                    continue
+                f.seek(offset)
+                moved[key] = self._append(directory, f.read(length))
+        return moved
+
+STORES = {FileStore.name: FileStore(), SegmentStore.name: SegmentStore()}
+
+def get_store(name=None) -> object:
+    """ store new messages are written to, EML_STORE unless name is given """
+    name = STORE if name is None else name
+    if name not in STORES:
+        raise ValueError("unknown eml store %r, use one of %s" % (name, list(STORES)))
+    return STORES[name]
+
+def store_for(email) -> object:
+    """ store an existing EmailObj was written to """
+    if getattr(email, 'store_offset', None) is not None:
+        return STORES[SegmentStore.name]
+    return STORES[FileStore.name]
@@ -0,0 +1,145 @@
+"""
+compiled version of the Filter rules so an email can be checked against every
+filter in one pass (see Filter.compiled / EmailObj.filter_for_tags)
+
+for each email field:
+    - substring rules are merged into one trie shaped regex, a single scan of
+    the field finds every pattern that occurs in it
+    - exact match rules go in a dict keyed by the lower case value
+
+matching is case insensitive and follows Filter.filter_email, including the
+match_all rules (every field set on the filter has to match vs any one of them)
+"""
+
+import re
+
+FIELDS = ("subject", "sender", "recipient", "cleantext", "cc", "bcc")
+
+# ------------------------------------------------------------------------------
+def _trie_regex(node) -> str:
+    """
+    regex for a trie node, longer continuations are tried first so the regex
+    returns the longest pattern starting at a position
+    """
+    branches = [
+        re.escape(char) + _trie_regex(child)
+        for char, child in sorted(node.items())
+        if char != ''
+    ]
+    if not branches:
+        return ''
+    if len(branches) == 1:
+        body = branches[0]
+    else:
+        body = '(?:' + '|'.join(branches) + ')'
+    if '' in node:
+        # --- a pattern ends here, continuing is optional ---
+        body = '(?:' + body + ')?'
+    return body
+
+# ******************************************************************************
+class PatternMatcher:
+    """
+    finds which of a set of substrings occur in a string with one regex scan
+
+    the regex reports the longest pattern at each position, patterns contained
+    in a reported pattern are added from a precomputed table so shorter
+    overlapping patterns aren't missed
+    """
+    def __init__(self, patterns):
+        self.patterns = sorted(set(p for p in patterns if p))
+        self.regex = None
+        self.implied = {}
+        if not self.patterns:
+            return
+        #
+        trie = {}
+        for pattern in self.patterns:
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[''] = True
+        self.regex = re.compile('(?=(' + _trie_regex(trie) + '))', re.DOTALL)
+        #
+        for pattern in self.patterns:
+            self.implied[pattern] = [p for p in self.patterns if p in pattern]
+
+    # --------------------------------------------------------------------------
+    def search(self, text) -> set:
+        """ returns the set of patterns found in text """
+        found = set()
+        if self.regex is None or not text:
+            return found
+        for hit in set(self.regex.findall(text)):
+            found.update(self.implied[hit])
+        return found
+
+# ******************************************************************************
+class CompiledFilters:
+    """
+    built from an iterable of Filter objects, answers which filters (and tags)
+    match an email
+    """
+    def __init__(self, filters):
+        self.filters = []   # (filter pk, tag pk, match_all, number of fields set)
+        substrings = {field: {} for field in FIELDS}
+        self.exact = {field: {} for field in FIELDS}
+        #
+        for filter in filters:
+            index = len(self.filters)
+            needed = 0
+            for field in FIELDS:
+                value = getattr(filter, field)
+                if not value:
+                    continue
+                needed += 1
+                value = value.lower()
+                if getattr(filter, field + "_exact_match"):
+                    self.exact[field].setdefault(value, []).append(index)
+                else:
+                    substrings[field].setdefault(value, []).append(index)
+            self.filters.append((filter.pk, filter.tag_id, filter.match_all, needed))
+        #
+        self.substrings = substrings
+        self.matchers = {
+            field: PatternMatcher(substrings[field]) for field in FIELDS if substrings[field]
+        }
+
+    # --------------------------------------------------------------------------
+    def matching(self, emailobj) -> list:
+        """ returns indexes (in build order) of the filters matching emailobj """
+        matched = {}
+        for field in FIELDS:
+            value = getattr(emailobj, field)
+            if not value:
+                continue
+            value = value.lower()
+            #
+            hits = []
+            if field in self.matchers:
+                for pattern in self.matchers[field].search(value):
+                    hits.extend(self.substrings[field][pattern])
+            hits.extend(self.exact[field].get(value, ()))
+            for index in hits:
+                matched[index] = matched.get(index, 0) + 1
+        #
+        result = []
+        for index, (pk, tag_pk, match_all, needed) in enumerate(self.filters):
+            count = matched.get(index, 0)
+            if match_all:
+                # --- every field set on the filter matched (or none were set) ---
+                if count == needed:
+                    result.append(index)
+            elif count > 0:
+                result.append(index)
+        return result
+
+    # --------------------------------------------------------------------------
+    def tags_for(self, emailobj) -> list:
+        """ returns tag pks of all filters matching emailobj, no duplicates """
+        tags = []
+        for index in self.matching(emailobj):
+            tag_pk = self.filters[index][1]
+            if tag_pk and tag_pk not in tags:
+                tags.append(tag_pk)
+        return tags
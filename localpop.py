@@ -0,0 +1,209 @@
+"""
+small in-process POP3 server for tests and benchmarks, serves a list of
+messages from memory on 127.0.0.1 so nothing needs a real mailbox.
+
+usage:
+    with LocalPOP3Server([('uidl-1', b'Subject: hi\\r\\n\\r\\nbody')]) as server:
+        conn = poplib.POP3('127.0.0.1', server.port)
+        ...
+
+supports USER, PASS, STAT, LIST, UIDL, RETR, TOP, DELE, RSET, NOOP, CAPA and
+QUIT.  STLS is answered with -ERR (no certificate to offer), messages marked
+with DELE are removed from the mailbox when the session sends QUIT.
+"""
+
+import socketserver, threading
+
+# ------------------------------------------------------------------------------
+def split_lines(raw) -> list:
+    """
+    splits raw message bytes into lines without line endings, a line ending
+    at the very end doesn't make an extra empty line (same as a real server)
+    """
+    lines = raw.replace(b'\r\n', b'\n').split(b'\n')
+    if len(lines) > 1 and lines[-1] == b'':
+        lines.pop()
+    return lines
+
+# ******************************************************************************
+class POP3Handler(socketserver.StreamRequestHandler):
+    """
+    one client session, the mailbox is shared through self.server.mailbox
+    """
+    # --------------------------------------------------------------------------
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        self.wfile.write(line + b'\r\n')
+
+    def send_multiline(self, lines):
+        out = []
+        for line in lines:
+            # --- byte stuffing for lines starting with a dot ---
+            if line.startswith(b'.'):
+                line = b'.' + line
+            out.append(line)
+        out.append(b'.')
+        self.wfile.write(b'\r\n'.join(out) + b'\r\n')
+
+    # --------------------------------------------------------------------------
+    def visible(self) -> list:
+        """ (pos, uidl, raw) for every message not marked as deleted """
+        return [
+            (pos, uidl, raw)
+            for pos, (uidl, raw) in enumerate(self.snapshot, start=1)
+            if pos not in self.deleted
+        ]
+
+    def get_message(self, arg):
+        try:
+            pos = int(arg)
+        except (TypeError, ValueError):
+            return None
+        if pos < 1 or pos > len(self.snapshot) or pos in self.deleted:
+            return None
+        return self.snapshot[pos - 1]
+
+    # --------------------------------------------------------------------------
+    def handle(self):
+        server = self.server
+        self.deleted = set()
+        self.snapshot = []
+        username = None
+        authorized = False
+        self.send('+OK localpop ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.strip().decode('utf-8', 'replace').split()
+            if not parts:
+                self.send('-ERR empty command')
+                continue
+            cmd = parts[0].upper()
+            args = parts[1:]
+            #
+            if cmd == 'QUIT':
+                if authorized:
+                    server.remove_messages(self.snapshot, self.deleted)
+                self.send('+OK bye')
+                return
+            elif cmd == 'CAPA':
+                self.send('+OK capability list follows')
+                self.send_multiline([b'USER', b'UIDL', b'TOP'])
+            elif cmd == 'STLS':
+                self.send('-ERR STLS not supported')
+            elif not authorized:
+                if cmd == 'USER' and args:
+                    username = args[0]
+                    self.send('+OK')
+                elif cmd == 'PASS' and args:
+                    if username == server.user and ' '.join(args) == server.password:
+                        authorized = True
+                        self.snapshot = list(server.mailbox)
+                        self.send('+OK logged in')
+                    else:
+                        self.send('-ERR invalid login')
+                else:
+                    self.send('-ERR not logged in')
+            elif cmd == 'NOOP':
+                self.send('+OK')
+            elif cmd == 'STAT':
+                msgs = self.visible()
+                self.send('+OK %d %d' % (len(msgs), sum(len(raw) for p, u, raw in msgs)))
+            elif cmd in ('LIST', 'UIDL'):
+                if args:
+                    message = self.get_message(args[0])
+                    if message is None:
+                        self.send('-ERR no such message')
+                    elif cmd == 'LIST':
+                        self.send('+OK %s %d' % (args[0], len(message[1])))
+                    else:
+                        self.send('+OK %s %s' % (args[0], message[0]))
+                else:
+                    msgs = self.visible()
+                    if cmd == 'LIST':
+                        lines = [('%d %d' % (p, len(raw))).encode() for p, u, raw in msgs]
+                    else:
+                        lines = [('%d %s' % (p, u)).encode() for p, u, raw in msgs]
+                    self.send('+OK %d messages' % len(msgs))
+                    self.send_multiline(lines)
+            elif cmd in ('RETR', 'TOP'):
+                message = self.get_message(args[0] if args else None)
+                if message is None:
+                    self.send('-ERR no such message')
+                    continue
+                lines = split_lines(message[1])
+                if cmd == 'TOP':
+                    try:
+                        howmany = int(args[1])
+                    except (IndexError, ValueError):
+                        self.send('-ERR syntax')
+                        continue
+                    if b'' in lines:
+                        blank = lines.index(b'')
+                        lines = lines[:blank + 1 + howmany]
+                self.send('+OK %d octets' % len(message[1]))
+                self.send_multiline(lines)
+            elif cmd == 'DELE':
+                if self.get_message(args[0] if args else None) is None:
+                    self.send('-ERR no such message')
+                else:
+                    self.deleted.add(int(args[0]))
+                    self.send('+OK deleted')
+            elif cmd == 'RSET':
+                self.deleted = set()
+                self.send('+OK')
+            else:
+                self.send('-ERR unknown command')
+
+# ******************************************************************************
+class LocalPOP3Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    threaded POP3 server bound to an ephemeral port on localhost
+
+    messages is a list of (uidl, raw bytes) tuples in mailbox order
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages=None, user='test', password='test', host='127.0.0.1', port=0):
+        super().__init__((host, port), POP3Handler)
+        self.mailbox = list(messages or [])
+        self.user = user
+        self.password = password
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # --------------------------------------------------------------------------
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def add_message(self, uidl, raw):
+        with self.lock:
+            self.mailbox.append((uidl, raw))
+
+    def remove_messages(self, snapshot, deleted):
+        """ apply DELEs from a session once it sends QUIT """
+        if not deleted:
+            return
+        gone = set(snapshot[pos - 1][0] for pos in deleted)
+        with self.lock:
+            self.mailbox = [item for item in self.mailbox if item[0] not in gone]
+
+    # --------------------------------------------------------------------------
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
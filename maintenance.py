@@ -0,0 +1,388 @@
+"""
+one off maintenance jobs (backfills, store migrations), meant to be called from
+the Django shell once the project's migrations for scarifmail have been run:
+
+    from scarifmail import maintenance
+    maintenance.backfill_thread_refs()
+
+long ones can be left running in the background with
+    maintenance.run_in_background(maintenance.relocate_eml_store, pause=0.5)
+"""
+# --- general imports ---
+import os, time, threading
+from django.db import connection, transaction
+from django.db.models import F
+
+# --- custom/project imports ---
+from scarifmail import models, searchindex, emlstore, attachindex
+from . import customlog
+
+# ------------------------------------------------------------------------------
+def backfill_thread_refs(batch_size=1000) -> int:
+    """
+    fills the ThreadRef table from existing data, safe to run more than once:
+        - every message id in Thread.thread_id
+        - EmailObj.message_id for every email linked to a thread
+
+    returns number of rows offered to the table (existing rows are skipped)
+    """
+    total = 0
+    rows = []
+    #
+    def flush():
+        models.ThreadRef.objects.bulk_create(rows, ignore_conflicts=True)
+        rows.clear()
+    #
+    threads = models.Thread.objects.values_list('pk', 'thread_id')
+    for thread_pk, thread_id in threads.iterator(chunk_size=batch_size):
+        for message_id in models.parse_email(thread_id):
+            rows.append(models.ThreadRef(
+                message_id=models.ThreadRef.normalize(message_id),
+                thread_id=thread_pk,
+            ))
+        if len(rows) >= batch_size:
+            total += len(rows)
+            flush()
+    #
+    emails = models.EmailObj.objects.filter(thread__isnull=False, message_id__isnull=False)
+    emails = emails.values_list('thread_id', 'message_id')
+    for thread_pk, message_id in emails.iterator(chunk_size=batch_size):
+        rows.append(models.ThreadRef(
+            message_id=models.ThreadRef.normalize(message_id),
+            thread_id=thread_pk,
+        ))
+        if len(rows) >= batch_size:
+            total += len(rows)
+            flush()
+    #
+    total += len(rows)
+    flush()
+    customlog.writelog('maillog', 'backfill_thread_refs - %d rows' % total)
+    return total
+#
+# ------------------------------------------------------------------------------
+def rebuild_search_index(account=None, batch_size=1000) -> int:
+    """
+    (re)indexes cleantext of every email, or just the emails of one account,
+    for the search index (see searchindex).  safe to run more than once, a
+    full run also drops whole word terms from indexes built before trigrams
+
+    returns number of emails indexed
+    """
+    emails = models.EmailObj.objects.filter(error=False).only('pk', 'cleantext')
+    if account:
+        emails = emails.filter(user=account)
+    else:
+        searchindex.drop_stale_terms()
+    #
+    total = 0
+    chunk = []
+    for email in emails.iterator(chunk_size=batch_size):
+        chunk.append(email)
+        if len(chunk) >= batch_size:
+            searchindex.index_emails(chunk)
+            total += len(chunk)
+            chunk = []
+    searchindex.index_emails(chunk)
+    total += len(chunk)
+    customlog.writelog('maillog', 'rebuild_search_index - %d emails' % total)
+    return total
+#
+# ------------------------------------------------------------------------------
+def backfill_structure(account=None, batch_size=500) -> int:
+    """
+    records EmailObj.structure for emails saved before it existed (or where it
+    is missing), reads each .eml file once.  emails whose file can't be read
+    are skipped
+
+    returns number of emails updated
+    """
+    emails = models.EmailObj.objects.filter(structure__isnull=True)
+    if account:
+        emails = emails.filter(user=account)
+    #
+    total = 0
+    chunk = []
+    for email in emails.iterator(chunk_size=batch_size):
+        msg = email.read_file()
+        if not msg:
+            continue
+        try:
+            size = emlstore.store_for(email).raw_size(email)
+            size += sum(ref['length'] for ref in email.blobs or [])
+            email.structure = models.message_structure(msg, size)
+        except Exception as e:
+            customlog.writelog('errorlog', 'backfill_structure %s - %s' % (email.fileloc, str(e)))
+            continue
+        chunk.append(email)
+        if len(chunk) >= batch_size:
+            models.EmailObj.objects.bulk_update(chunk, ['structure'])
+            total += len(chunk)
+            chunk = []
+    models.EmailObj.objects.bulk_update(chunk, ['structure'])
+    total += len(chunk)
+    customlog.writelog('maillog', 'backfill_structure - %d emails' % total)
+    return total
+#
+# ------------------------------------------------------------------------------
+def backfill_attachment_index(account=None, batch_size=200) -> int:
+    """
+    records EmailObj.attachment_index for emails saved before it existed,
+    scans the stored bytes once (blobs spliced back in).  emails whose file
+    can't be read are skipped
+
+    returns number of emails updated
+    """
+    emails = models.EmailObj.objects.filter(attachment_index__isnull=True).exclude(fileloc='')
+    if account:
+        emails = emails.filter(user=account)
+    #
+    total = 0
+    chunk = []
+    for email in emails.iterator(chunk_size=batch_size):
+        try:
+            with emlstore.store_for(email).open(email) as f:
+                data = f.read()
+            if email.blobs:
+                data = models.BLOBS.rebuild(data, email.blobs)
+            email.attachment_index = attachindex.build_index(attachindex.scan(data), data, email.blobs)
+        except Exception as e:
+            customlog.writelog('errorlog', 'backfill_attachment_index %s - %s' % (email.fileloc, str(e)))
+            continue
+        chunk.append(email)
+        if len(chunk) >= batch_size:
+            models.EmailObj.objects.bulk_update(chunk, ['attachment_index'])
+            total += len(chunk)
+            chunk = []
+    models.EmailObj.objects.bulk_update(chunk, ['attachment_index'])
+    total += len(chunk)
+    customlog.writelog('maillog', 'backfill_attachment_index - %d emails' % total)
+    return total
+#
+# ------------------------------------------------------------------------------
+def backfill_seen_uidls(account=None) -> int:
+    """
+    seeds the SeenUidl table for accounts that only have the old current_uidl
+    cursor (MailAcct.new_positions also does this on the first fetch).  the
+    uidls of saved emails are always recorded, everything on the server up to
+    current_uidl is added when the server can be reached
+
+    returns number of uidls recorded
+    """
+    total = 0
+    for acct in ([account] if account else models.MailAcct.objects.all()):
+        if models.SeenUidl.objects.filter(account=acct).exists():
+            continue
+        with acct.pop_session() as connection:
+            snapshot = acct.uidl_snapshot() if connection else []
+        total += len(acct.seed_seen_uidls(snapshot))
+    customlog.writelog('maillog', 'backfill_seen_uidls - %d uidls' % total)
+    return total
+#
+# ------------------------------------------------------------------------------
+def convert_eml_store(compression=emlstore.COMPRESSION, account=None, level=None, batch_size=500) -> int:
+    """
+    rewrites stored .eml files in the given format (None, 'gzip' or 'zstd',
+    defaults to EML_COMPRESSION) and points EmailObj.fileloc at the new files.
+    messages in the segment store are left alone.
+    also works the other way, compression=None decompresses.  files already in
+    that format or missing are skipped, safe to stop and run again (each
+    row is updated before its old file is removed)
+
+    returns number of files converted
+    """
+    emlstore.check_format(compression)
+    emails = (
+        models.EmailObj.objects.exclude(fileloc='').filter(store_offset__isnull=True)
+        .only('pk', 'fileloc')
+    )
+    if account:
+        emails = emails.filter(user=account)
+    #
+    total = 0
+    for email in emails.iterator(chunk_size=batch_size):
+        old_path = email.fileloc
+        if emlstore.file_format(old_path) == compression or not os.path.exists(old_path):
+            continue
+        try:
+            email.fileloc = emlstore.convert(old_path, compression, level, remove=False)
+        except Exception as e:
+            customlog.writelog('errorlog', 'convert_eml_store %s - %s' % (old_path, str(e)))
+            continue
+        # --- row points at the new file before the old one goes away ---
+        email.save(update_fields=['fileloc'])
+        os.remove(old_path)
+        models.MESSAGE_CACHE.invalidate(old_path)
+        total += 1
+    customlog.writelog('maillog', 'convert_eml_store %s - %d files' % (compression, total))
+    return total
+#
+# ------------------------------------------------------------------------------
+def compact_segments(account=None, min_dead_ratio=0.3) -> int:
+    """
+    reclaims the space of deleted messages in the segment store.  every
+    segment (except the current one of each mailbox, which is still being
+    appended to) where at least min_dead_ratio of the bytes are no longer
+    referenced by an EmailObj has its live records copied into the current
+    segment, the rows are pointed at the copies and the old segment (with its
+    tombstones) is removed.
+
+    safe to stop and run again, a segment is only removed after its rows have
+    been moved.  a stop in between leaves unreferenced copies, those are
+    counted as dead and reclaimed once their segment is compacted
+
+    returns number of segments removed
+    """
+    store = emlstore.get_store('segments')
+    accounts = [account] if account else models.MailAcct.objects.all()
+    total = 0
+    for acct in accounts:
+        directory = os.path.join(models.MAILDIR, acct.address, store.SEGMENTS_DIR)
+        for path in store.segments(directory)[:-1]:
+            rows = list(
+                models.EmailObj.objects.filter(fileloc=path, store_offset__isnull=False)
+                .order_by('store_offset').values_list('pk', 'store_offset', 'store_length')
+            )
+            size = os.path.getsize(path)
+            live = sum(length for pk, offset, length in rows)
+            if size == 0 or (size - live) / size < min_dead_ratio:
+                continue
+            try:
+                moved = store.compact(path, rows)
+            except Exception as e:
+                customlog.writelog('errorlog', 'compact_segments %s - %s' % (path, str(e)))
+                continue
+            emails = []
+            for pk, (new_path, offset, length) in moved.items():
+                emails.append(models.EmailObj(
+                    pk=pk, fileloc=new_path, store_offset=offset, store_length=length,
+                ))
+            with transaction.atomic():
+                models.EmailObj.objects.bulk_update(
+                    emails, ['fileloc', 'store_offset', 'store_length'], batch_size=500,
+                )
+            # --- cache keys are segment path + offset, drop the old ones ---
+            for pk, offset, length in rows:
+                models.MESSAGE_CACHE.invalidate(store.record_key(path, offset))
+            store.remove_segment(path)
+            total += 1
+    customlog.writelog('maillog', 'compact_segments - %d segments' % total)
+    return total
+#
+# ------------------------------------------------------------------------------
+def relocate_eml_store(levels=emlstore.SHARD_LEVELS, account=None, batch_size=500, pause=0) -> int:
+    """
+    moves stored .eml files (and trashed ones) into the sharded layout with
+    the given number of levels (defaults to EML_SHARD_LEVELS, 0 moves them
+    back to flat mailbox directories).  works in batches of batch_size rows:
+    the files are linked at their new paths, the rows updated in one
+    transaction and only then the old paths removed, so it is safe to stop and
+    run again.  pause sleeps between batches to go easy on a busy disk.
+    messages in the segment store are left alone
+
+    returns number of files moved
+    """
+    emails = models.EmailObj.objects.exclude(fileloc='').filter(store_offset__isnull=True)
+    if account:
+        emails = emails.filter(user=account)
+    emails = emails.only('pk', 'fileloc').order_by('pk')
+    #
+    total = 0
+    last_pk = 0
+    while True:
+        batch = list(emails.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        moved = []
+        for email in batch:
+            old_path = email.fileloc
+            new_path = emlstore.shard_path(
+                emlstore.mailbox_dir(old_path), os.path.basename(old_path), levels,
+            )
+            if new_path == old_path or not os.path.exists(old_path):
+                continue
+            try:
+                emlstore.place(old_path, new_path)
+            except Exception as e:
+                customlog.writelog('errorlog', 'relocate_eml_store %s - %s' % (old_path, str(e)))
+                continue
+            email.fileloc = new_path
+            moved.append((email, old_path))
+        #
+        # --- rows point at the new paths before the old ones go away ---
+        with transaction.atomic():
+            models.EmailObj.objects.bulk_update([email for email, old_path in moved], ['fileloc'])
+        for email, old_path in moved:
+            models.MESSAGE_CACHE.invalidate(old_path)
+            try:
+                os.remove(old_path)
+            except OSError as e:
+                # --- trashed or removed meanwhile, the rest of the batch still goes ---
+                customlog.writelog('errorlog', 'relocate_eml_store %s - %s' % (old_path, str(e)))
+        total += len(moved)
+        if pause:
+            time.sleep(pause)
+    #
+    # --- trashed files have no rows, they are just moved ---
+    accounts = [account] if account else models.MailAcct.objects.all()
+    for acct in accounts:
+        trash_dir = os.path.join(models.MAILDIR, acct.address, 'trash')
+        for dirpath, dirnames, filenames in os.walk(trash_dir):
+            if dirpath == trash_dir and emlstore.SegmentStore.SEGMENTS_DIR in dirnames:
+                dirnames.remove(emlstore.SegmentStore.SEGMENTS_DIR)
+            for fname in filenames:
+                old_path = os.path.join(dirpath, fname)
+                new_path = emlstore.shard_path(trash_dir, fname, levels)
+                if new_path != old_path and not os.path.exists(new_path):
+                    try:
+                        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                        os.replace(old_path, new_path)
+                    except OSError as e:
+                        customlog.writelog('errorlog', 'relocate_eml_store %s - %s' % (old_path, str(e)))
+                        continue
+                    total += 1
+    customlog.writelog('maillog', 'relocate_eml_store %d levels - %d files' % (levels, total))
+    return total
+#
+# ------------------------------------------------------------------------------
+def run_in_background(job, *args, **kwargs) -> threading.Thread:
+    """
+    runs one of the jobs above on a daemon thread (so the shell stays usable
+    or it can run next to the mail controller), errors go to the errorlog.
+    returns the thread, join() it to wait for the job
+    """
+    def run():
+        try:
+            job(*args, **kwargs)
+        except Exception as e:
+            customlog.writelog('errorlog', '%s - %s' % (job.__name__, str(e)))
+        finally:
+            # --- the thread's db connection isn't closed for us ---
+            connection.close()
+    #
+    thread = threading.Thread(target=run, name='maintenance-%s' % job.__name__, daemon=True)
+    thread.start()
+    return thread
+#
+# ------------------------------------------------------------------------------
+def backfill_thread_summary(account=None, batch_size=1000) -> int:
+    """
+    fills the Thread summary fields (last_date, last_sender, last_subject,
+    email_count, unread_count) for threads from before they existed.  threads
+    still marked unread count all their emails as unread
+
+    returns number of threads updated
+    """
+    threads = models.Thread.objects.all()
+    if account:
+        threads = threads.filter(user=account)
+    thread_pks = list(threads.values_list('pk', flat=True))
+    for start in range(0, len(thread_pks), batch_size):
+        chunk = thread_pks[start:start + batch_size]
+        models.Thread.refresh_summary(chunk)
+        models.Thread.objects.filter(pk__in=chunk, unread=True).update(unread_count=F('email_count'))
+    customlog.writelog('maillog', 'backfill_thread_summary - %d threads' % len(thread_pks))
+    return len(thread_pks)
+#
+# ------------------------------------------------------------------------------
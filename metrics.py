@@ -0,0 +1,281 @@
+"""
+timers and counters around the stages of the fetch pipeline (connect, UIDL
+listing, RETR, parsing, cleantext, threading, filters, db, search index, file
+writes), so a slow poll cycle can be broken down.
+
+nothing is recorded until a hook is installed, timer() then hands back a
+shared no-op context manager so the cost of a disabled stage is one function
+call.  METRICS_ENABLED in scarifsettings installs the default in-memory
+aggregator at import, from the Django shell:
+
+    from scarifmail import metrics, controller
+    metrics.enable()
+    controller.main()
+    print(metrics.summary())  # readable table per stage
+    print(metrics.dump())     # prometheus text format, per stage and account
+
+hooks are objects with observe(stage, seconds, account) and count(name,
+value, account) methods, account is the address as a string ('' if the
+stage ran outside of an account).  add_hook() plugs in anything else
+(statsd, logging...).
+"""
+
+import time, threading, bisect
+
+from scarifmail import scarifsettings
+
+# --- histogram bucket upper bounds in seconds ---
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PREFIX = 'scarifmail'
+
+_hooks = []
+_local = threading.local()
+
+# ******************************************************************************
+class Histogram:
+    """ bucket counts plus sum and count, same shape as a prometheus histogram """
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q) -> float:
+        """ upper bound of the bucket the q quantile falls in """
+        target = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if n and seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+# ******************************************************************************
+class Aggregator:
+    """
+    default hook, keeps a Histogram for every (stage, account) and a total for
+    every (counter name, account)
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def observe(self, stage, seconds, account):
+        key = (stage, account)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def count(self, name, value, account):
+        key = (name, account)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    # --------------------------------------------------------------------------
+    def exposition(self) -> str:
+        """ everything recorded so far in the prometheus text format """
+        def labels(**items):
+            return ",".join(
+                '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                for key, value in items.items()
+            )
+        #
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            out = [
+                "# HELP %s_stage_seconds time spent in each fetch pipeline stage" % PREFIX,
+                "# TYPE %s_stage_seconds histogram" % PREFIX,
+            ]
+            for (stage, account), histogram in histograms:
+                cumulative = 0
+                for bound, n in zip(self.buckets + ('+Inf',), histogram.counts):
+                    cumulative += n
+                    out.append("%s_stage_seconds_bucket{%s} %d" % (
+                        PREFIX, labels(stage=stage, account=account, le=bound), cumulative,
+                    ))
+                out.append("%s_stage_seconds_sum{%s} %.6f" % (
+                    PREFIX, labels(stage=stage, account=account), histogram.sum,
+                ))
+                out.append("%s_stage_seconds_count{%s} %d" % (
+                    PREFIX, labels(stage=stage, account=account), histogram.count,
+                ))
+            out.append("# HELP %s_events_total counters kept by the fetch pipeline" % PREFIX)
+            out.append("# TYPE %s_events_total counter" % PREFIX)
+            for (name, account), value in counters:
+                out.append("%s_events_total{%s} %d" % (
+                    PREFIX, labels(name=name, account=account), value,
+                ))
+        return "\n".join(out) + "\n"
+
+    def summary(self) -> str:
+        """ per stage totals over all accounts as a plain text table """
+        with self.lock:
+            stages = {}
+            for (stage, account), histogram in self.histograms.items():
+                merged = stages.setdefault(stage, Histogram(self.buckets))
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                merged.sum += histogram.sum
+                merged.count += histogram.count
+                merged.max = max(merged.max, histogram.max)
+            counters = {}
+            for (name, account), value in self.counters.items():
+                counters[name] = counters.get(name, 0) + value
+        #
+        lines = ["%-12s %8s %10s %10s %10s %10s" % ("stage", "count", "total s", "mean ms", "p95 ms", "max ms")]
+        for stage, histogram in sorted(stages.items(), key=lambda item: -item[1].sum):
+            lines.append("%-12s %8d %10.3f %10.3f %10.3f %10.3f" % (
+                stage, histogram.count, histogram.sum,
+                histogram.sum * 1000 / histogram.count,
+                histogram.quantile(0.95) * 1000, histogram.max * 1000,
+            ))
+        for name, value in sorted(counters.items()):
+            lines.append("%-12s %8d" % (name, value))
+        return "\n".join(lines)
+
+AGGREGATOR = Aggregator()
+
+# ******************************************************************************
+class _Timer:
+    """ context manager reporting the time spent inside it to every hook """
+    __slots__ = ('stage', 'account', 'start')
+
+    def __init__(self, stage, account):
+        self.stage = stage
+        self.account = account
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter() - self.start, self.account)
+        return False
+
+class _NullTimer:
+    """ stand in for _Timer (and scope) when nothing is listening """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+class _Scope:
+    """ sets the account stages on this thread are reported under """
+    __slots__ = ('account', 'previous')
+
+    def __init__(self, account):
+        self.account = account
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'account', '')
+        _local.account = self.account
+        return self
+
+    def __exit__(self, *exc):
+        _local.account = self.previous
+        return False
+
+# ------------------------------------------------------------------------------
+def _label(account) -> str:
+    if account is None:
+        return getattr(_local, 'account', '')
+    return str(account)
+
+def enabled() -> bool:
+    return bool(_hooks)
+
+def add_hook(hook):
+    if hook not in _hooks:
+        _hooks.append(hook)
+
+def remove_hook(hook):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+def enable():
+    """ start recording into the default aggregator """
+    add_hook(AGGREGATOR)
+
+def disable():
+    """ stop recording, hooks added with add_hook are removed as well """
+    _hooks.clear()
+
+# ------------------------------------------------------------------------------
+def timer(stage, account=None):
+    """
+    context manager timing a stage:
+        with metrics.timer('retr', account):
+            ...
+    account defaults to the one set with scope() on this thread
+    """
+    if not _hooks:
+        return NULL_TIMER
+    return _Timer(stage, _label(account))
+
+def scope(account):
+    """
+    context manager, stages timed on this thread inside of it without an
+    explicit account are reported under this one
+    """
+    if not _hooks:
+        return NULL_TIMER
+    return _Scope(str(account))
+
+def observe(stage, seconds, account=None):
+    if not _hooks:
+        return
+    account = account if isinstance(account, str) else _label(account)
+    for hook in _hooks:
+        try:
+            hook.observe(stage, seconds, account)
+        except Exception:
+            pass # a broken hook shouldn't stop mail from being fetched
+
+def count(name, value=1, account=None):
+    if not _hooks:
+        return
+    account = _label(account)
+    for hook in _hooks:
+        try:
+            hook.count(name, value, account)
+        except Exception:
+            pass
+
+# ------------------------------------------------------------------------------
+def dump() -> str:
+    """ prometheus text exposition of the default aggregator """
+    return AGGREGATOR.exposition()
+
+def summary() -> str:
+    return AGGREGATOR.summary()
+
+def reset():
+    AGGREGATOR.reset()
+
+if getattr(scarifsettings, 'METRICS_ENABLED', False):
+    enable()
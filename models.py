@@ -1,21 +1,24 @@
 # --- general imports ---
-import poplib, datetime, os, re, email, pdb, time, concurrent.futures
+import poplib, datetime, os, re, email, email.parser, pdb, time, concurrent.futures, socket
 import dateutil.parser
-import random, shutil, time, signal
+import random, shutil, time, threading, collections, contextlib
 from multiprocessing import Process
 from passlib.hash import pbkdf2_sha256
 
 # --- django imports ---
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q, Case, When, Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Substr
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django import forms
 from django.utils import timezone
 
 # --- custom app imports ---
 from main import settings
-from scarifmail import scarifsettings
-from jake_template.django_things import customlog
-from bs4 import BeautifulSoup
+from scarifmail import scarifsettings, aiopop, filterengine, searchindex, msgcache, textextract, metrics, poppool, emlstore, blobstore, attachindex
+from scarifmail import customlog
 
 # email import stuff
 from email.mime.application import MIMEApplication
@@ -32,6 +35,27 @@ EFILE_ROOT = scarifsettings.EFILE_ROOT # where email files will be written to
 #
 # --- directory for email files to be placed under when they are set to delete
 MAILDIR = os.path.join(settings.BASE_DIR, 'scarifmail/eml_files')
+#
+# --- parsed .eml files shared by EmailObj.read_file, size limit in bytes ---
+# --- chunk size and file worker threads for EmailObj.bulk_remove ---
+BULK_DELETE_BATCH = getattr(scarifsettings, 'BULK_DELETE_BATCH', 1000)
+BULK_DELETE_WORKERS = getattr(scarifsettings, 'BULK_DELETE_WORKERS', 8)
+#
+# --- seconds cached server stats are good for, see AccountStats ---
+STATS_TTL = getattr(scarifsettings, 'STATS_TTL', 300)
+#
+# --- uidls per IN (...) lookup in SeenUidl ---
+UIDL_CHUNK = 500
+#
+# --- attachment payloads shared between emails (ATTACHMENT_BLOBS), see blobstore ---
+BLOBS = blobstore.BlobStore(os.path.join(MAILDIR, '_blobs'))
+BLOBS_ENABLED = blobstore.ENABLED
+#
+MESSAGE_CACHE = msgcache.MessageCache(
+    lambda f: email.message_from_binary_file(f, policy=(email.policy.default)),
+    getattr(scarifsettings, 'MESSAGE_CACHE_BYTES', 64 * 1024 * 1024),
+    opener=emlstore.open_eml,
+)
 
 # ------------------------------------------------------------------------------
 def parse_email(e_in):
@@ -55,6 +79,167 @@ def parse_email(e_in):
             return []
         return [e_in]
 
+# ------------------------------------------------------------------------------
+def parse_uidl_listing(lines) -> list:
+    """
+    turns the lines of a UIDL listing into a list of (pos, uidl) tuples
+    """
+    snapshot = []
+    for item in lines:
+        parts = item.split()
+        snapshot.append((int(parts[0]), parts[1].decode('utf-8')))
+    return snapshot
+
+# ------------------------------------------------------------------------------
+def build_eml_message(lines, server_id) -> object:
+    """
+    turns the lines of a RETR response into a RawMessage with the custom UIDL
+    and MSG-ID headers added
+    """
+    with metrics.timer('headers'):
+        email_message = RawMessage(lines)
+
+    # --- UIDL and MSG-ID are custom headers we use to help later on ---
+    email_message['UIDL'] = server_id
+
+    if not email_message['Message-ID'] or '@' not in email_message['Message-ID']:
+        email_message['MSG-ID'] = email_message['UIDL']
+
+    else:
+        message_id = parse_email(email_message['Message-ID'])[0]
+        email_message['MSG-ID'] = message_id
+
+    return email_message
+
+# ******************************************************************************
+class RawMessage:
+    """
+    message as it came off the server (the RETR lines, no copies made) plus the
+    custom headers we add to it.
+
+    - only the headers are parsed up front, msg['from'] etc. read from those
+    - anything else (get_body, walk, iter_attachments...) is handed to a full
+    email.message.EmailMessage that is parsed the first time it is needed
+    - write_to writes the custom headers followed by the original lines, so
+    the .eml file is the server's bytes with our headers in front
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.extra = [] # (name, value) of custom headers, written first
+        self._message = None
+        #
+        header_lines = []
+        for line in lines:
+            if not line:
+                break
+            header_lines.append(line)
+        header_lines.append(b'')
+        self.headers = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+            b'\n'.join(header_lines), headersonly=True,
+        )
+
+    # --------------------------------------------------------------------------
+    @property
+    def raw_size(self) -> int:
+        """ size of the message as it came from the server """
+        return sum(len(line) + 1 for line in self.lines) - 1
+
+    def prefix(self) -> bytes:
+        return b''.join(
+            ('%s: %s\n' % (name, value)).encode('utf-8') for name, value in self.extra
+        )
+
+    # --------------------------------------------------------------------------
+    def __getitem__(self, name):
+        for header, value in self.extra:
+            if header.lower() == name.lower():
+                return value
+        return self.headers[name]
+
+    def __setitem__(self, name, value):
+        self.extra.append((name, str(value)))
+        if self._message is not None:
+            self._message[name] = value
+
+    def __contains__(self, name):
+        return self[name] is not None
+
+    def get(self, name, failobj=None):
+        value = self[name]
+        return failobj if value is None else value
+
+    # --------------------------------------------------------------------------
+    @property
+    def message(self) -> object:
+        """ full parse of the message (custom headers included), done once """
+        if self._message is None:
+            with metrics.timer('parse'):
+                parser = email.parser.BytesFeedParser(policy=email.policy.default)
+                parser.feed(self.prefix())
+                for line in self.lines:
+                    parser.feed(line)
+                    parser.feed(b'\n')
+                self._message = parser.close()
+        return self._message
+
+    def __getattr__(self, name):
+        # --- only called for attributes RawMessage doesn't have ---
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.message, name)
+
+    # --------------------------------------------------------------------------
+    def write_to(self, f):
+        """ write the message to an open binary file without joining the lines """
+        f.write(self.prefix())
+        last = len(self.lines) - 1
+        for index, line in enumerate(self.lines):
+            f.write(line)
+            if index != last:
+                f.write(b'\n')
+
+    def __bytes__(self):
+        return self.prefix() + b'\n'.join(self.lines)
+
+# ------------------------------------------------------------------------------
+def message_structure(msg, size=None) -> dict:
+    """
+    compact summary of a parsed message, stored in EmailObj.structure so
+    templates don't have to open the file:
+        - attachment_count / attachments: name, content type and decoded size
+        of each attachment (same parts as EmailObj.get_attachments)
+        - has_html: any text/html part
+        - body_part / body_type: position in msg.walk() and content type of the
+        part get_body would pick, None if there isn't one
+        - size: size of the message in bytes (None if unknown)
+    """
+    attachments = []
+    for part in msg.iter_attachments():
+        payload = part.get_payload(decode=True)
+        attachments.append({
+            "name": part.get_filename(),
+            "type": part.get_content_type(),
+            "size": len(payload) if payload else 0,
+        })
+    #
+    body = msg.get_body(preferencelist=('html', 'related', 'plain'))
+    body_part = None
+    has_html = False
+    for index, part in enumerate(msg.walk()):
+        if part.get_content_type() == 'text/html':
+            has_html = True
+        if part is body:
+            body_part = index
+    #
+    return {
+        "attachment_count": len(attachments),
+        "attachments": attachments,
+        "has_html": has_html,
+        "body_part": body_part,
+        "body_type": body.get_content_type() if body is not None else None,
+        "size": size,
+    }
+
 # ******************************************************************************
 class MailGroup(models.Model):
     name = models.CharField(
@@ -93,12 +278,29 @@ class MailGroup(models.Model):
 class Thread(models.Model):
     """
     class that links emails together if they are part of the same conversation
+
+    last_date / last_sender / last_subject (latest email), email_count and
+    unread_count are kept up to date as emails are linked (note_email) and
+    removed (refresh_summary) so an inbox page doesn't need to look at the
+    emails at all
     """
+    SNIPPET_LENGTH = 120
+    SUMMARY_FIELDS = ['last_date', 'last_sender', 'last_subject', 'email_count', 'unread_count']
+
     thread_id = models.TextField()
     subject = models.TextField(null=True, default="")
     unread = models.BooleanField(default=True)
     user = models.ForeignKey('MailAcct', null=True, on_delete=models.SET_NULL)
     tags = models.ManyToManyField('FilterTag')
+    # --- summary of the emails in the thread ---
+    last_date = models.DateTimeField(null=True, blank=True, default=None)
+    last_sender = models.EmailField(null=True, blank=True)
+    last_subject = models.CharField(max_length=SNIPPET_LENGTH, null=True, blank=True)
+    email_count = models.IntegerField(default=0)
+    unread_count = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['user', '-last_date'])]
 
     # --------------------------------------------------------------------------
     @property
@@ -112,15 +314,86 @@ class Thread(models.Model):
 
     # --------------------------------------------------------------------------
     def last_email(self) -> object:
-        """ returns info based on last email in the thread """
-        if len(EmailObj.objects.filter(thread=self)) == 0:
-            return None
-        return EmailObj.objects.filter(thread=self).latest('date')
+        """
+        returns info based on last email in the thread (one query, the summary
+        fields have the date, sender and subject without it)
+        """
+        return EmailObj.objects.filter(thread=self).order_by('-date', '-pk').first()
 
     @property
     def last_email_topage(self):
         return self.last_email()
 
+    # --------------------------------------------------------------------------
+    def note_email(self, email):
+        """ counts a newly linked email in the summary fields, doesn't save """
+        self.email_count += 1
+        self.unread_count += 1
+        if self.last_date is None or (email.date is not None and email.date >= self.last_date):
+            self.last_date = email.date
+            self.last_sender = email.sender
+            self.last_subject = (email.subject or '')[:self.SNIPPET_LENGTH]
+
+    @classmethod
+    def summary_changes(cls, emails) -> dict:
+        """
+        update() values linking emails to a thread that is saved already, the
+        same as note_email in the database.  counters go up with F() so a
+        mark_read or refresh_summary running meanwhile isn't overwritten,
+        last_* only change if the newest of the emails is later
+        """
+        latest = None
+        for email in emails:
+            if latest is None or (email.date is not None and (latest.date is None or email.date >= latest.date)):
+                latest = email
+        newer = Q(last_date__isnull=True)
+        if latest.date is not None:
+            newer |= Q(last_date__lte=latest.date)
+        changes = {
+            'unread': True,
+            'email_count': F('email_count') + len(emails),
+            'unread_count': F('unread_count') + len(emails),
+        }
+        values = (
+            ('last_sender', latest.sender),
+            ('last_subject', (latest.subject or '')[:cls.SNIPPET_LENGTH]),
+            ('last_date', latest.date),
+        )
+        for name, value in values:
+            changes[name] = Case(
+                When(newer, then=Value(value, output_field=cls._meta.get_field(name))),
+                default=F(name),
+            )
+        return changes
+
+    def mark_read(self):
+        self.unread = False
+        self.unread_count = 0
+        self.save(update_fields=['unread', 'unread_count'])
+
+    @classmethod
+    def refresh_summary(cls, thread_pks):
+        """
+        recomputes the summary fields of the given threads from their emails
+        (after emails were removed), a couple of queries per chunk of threads.
+        unread_count is capped at the new email_count
+        """
+        thread_pks = [pk for pk in set(thread_pks) if pk]
+        latest = EmailObj.objects.filter(thread=OuterRef('pk')).order_by('-date', '-pk')
+        counts = (
+            EmailObj.objects.filter(thread=OuterRef('pk')).order_by()
+            .values('thread').annotate(n=Count('pk')).values('n')
+        )
+        for start in range(0, len(thread_pks), BULK_DELETE_BATCH):
+            threads = cls.objects.filter(pk__in=thread_pks[start:start + BULK_DELETE_BATCH])
+            threads.update(
+                email_count=Coalesce(Subquery(counts[:1]), Value(0)),
+                last_date=Subquery(latest.values('date')[:1]),
+                last_sender=Subquery(latest.values('sender')[:1]),
+                last_subject=Substr(Subquery(latest.values('subject')[:1]), 1, cls.SNIPPET_LENGTH),
+            )
+            threads.filter(unread_count__gt=F('email_count')).update(unread_count=F('email_count'))
+
     # --------------------------------------------------------------------------
     def clear_thread(self):
         pass
@@ -134,15 +407,82 @@ class Thread(models.Model):
         object
         '''
         #
-        for email in self.get_related_emails():
-            email.remove(skip_trash)
-            # os.remove(email.fileloc)
-            self.user.current_uidl = email.uidl
-            # email.delete()
+        emails = self.get_related_emails()
+        # --- current_uidl goes back to the last email of the thread ---
+        last_uidl = emails.order_by('pk').values_list('uidl', flat=True).last()
+        EmailObj.bulk_remove(emails, skip_trash, refresh_threads=False)
+        if last_uidl is not None:
+            self.user.current_uidl = last_uidl
         #
         self.user.save()
         self.delete()
 
+# ******************************************************************************
+class ThreadRef(models.Model):
+    """
+    lookup table from Message-ID to thread, lets EmailObj.find_thread use exact
+    (indexed) matches instead of scanning Thread.thread_id.
+
+    - every message id in a thread's thread_id and the Message-ID of every email
+    linked to the thread gets a row
+    - message ids are stored lower case so lookups stay case insensitive
+    - the same message id can point at more than one thread (bcc'd copies in
+    different inboxes), the newest thread wins same as before
+    """
+    message_id = models.CharField(max_length=255, db_index=True)
+    thread = models.ForeignKey('Thread', on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('message_id', 'thread')
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def normalize(message_id) -> str:
+        return str(message_id).strip().lower()[:255]
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def register(cls, thread, message_ids):
+        """ add rows linking each of message_ids to thread, existing rows are ignored """
+        rows = [
+            cls(message_id=cls.normalize(item), thread=thread)
+            for item in message_ids if item
+        ]
+        cls.objects.bulk_create(rows, ignore_conflicts=True)
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def lookup(cls, message_ids) -> dict:
+        """
+        returns {normalized message id: thread pk} for the ids that are known,
+        newest thread for ids linked to more than one
+        """
+        found = {}
+        rows = cls.objects.filter(
+            message_id__in=[cls.normalize(item) for item in message_ids if item]
+        ).values_list('message_id', 'thread_id')
+        for message_id, thread_pk in rows:
+            found[message_id] = max(found.get(message_id, 0), thread_pk)
+        return found
+
+# ******************************************************************************
+class SearchTerm(models.Model):
+    """
+    vocabulary for the search index when FTS5 isn't available (see searchindex)
+    """
+    term = models.CharField(max_length=255, unique=True)
+
+# ******************************************************************************
+class SearchPosting(models.Model):
+    """
+    which emails a SearchTerm shows up in
+    """
+    term = models.ForeignKey('SearchTerm', on_delete=models.CASCADE)
+    email = models.ForeignKey('EmailObj', on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('term', 'email')
+
 # ******************************************************************************
 class FilterTag(models.Model):
     """
@@ -182,6 +522,31 @@ class Filter(models.Model):
     # ??? age in days ???
     tag = models.ForeignKey('FilterTag', null=True, on_delete=models.SET_NULL)
 
+    # --- compiled rule set shared by the ingest path, see compiled() ---
+    _compiled = None
+    _compiled_lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def compiled(cls) -> object:
+        """
+        returns a filterengine.CompiledFilters built from every Filter, built on
+        first use and kept until reset_compiled is called (any Filter or
+        FilterTag change does that, so does the start of an ingest run)
+        """
+        compiled = cls._compiled
+        if compiled is None:
+            with cls._compiled_lock:
+                if cls._compiled is None:
+                    cls._compiled = filterengine.CompiledFilters(cls.objects.all())
+                compiled = cls._compiled
+        return compiled
+
+    @classmethod
+    def reset_compiled(cls):
+        cls._compiled = None
+
+    # --------------------------------------------------------------------------
     def filter_email(self, emailobj) -> bool:
         """
         checks if attributes of filter match those of given emailobj, returns true
@@ -225,6 +590,13 @@ class Filter(models.Model):
             # this implies that no fields matched
             return False
     #
+# ------------------------------------------------------------------------------
+@receiver([post_save, post_delete], sender=Filter)
+@receiver([post_save, post_delete], sender=FilterTag)
+def filters_changed(sender, **kwargs):
+    """ filter rules or tags changed, compiled filters get rebuilt on next use """
+    Filter.reset_compiled()
+
 # ******************************************************************************
 class EmailObj(models.Model):
     """
@@ -245,12 +617,21 @@ class EmailObj(models.Model):
     message_id = models.TextField(null=True)
     cc = models.TextField(null=True)
     bcc = models.TextField(null=True)
+    # --- .eml path, or the segment file with the record's offset/length (see emlstore) ---
     fileloc = models.TextField()
+    store_offset = models.BigIntegerField(null=True, blank=True, default=None)
+    store_length = models.IntegerField(null=True, blank=True, default=None)
     # --- cleantext is the stripped down text from email body ---
     # max size for TextField is 65,535 bytes.
     # utf-8 uses up to 4 bytes for each character, at that rate you have roughly
     # 16,383 characters that can be stored in a single field.
     cleantext = models.TextField(default="")
+    # --- summary of the MIME structure recorded at ingest, see message_structure ---
+    structure = models.JSONField(null=True, blank=True, default=None)
+    # --- attachment bodies cut out of the stored file into BLOBS, see blobstore ---
+    blobs = models.JSONField(null=True, blank=True, default=None)
+    # --- where each attachment body is in the stored bytes, see attachindex ---
+    attachment_index = models.JSONField(null=True, blank=True, default=None)
 
     # --------------------------------------------------------------------------
     def assign_thread(self):
@@ -263,18 +644,18 @@ class EmailObj(models.Model):
         the same Message-ID.
         - will save email object
         """
-        match = False
-        refs = parse_email(self.references)
-        refs.insert(0, self.message_id)
-        for item in refs:
-            if Thread.objects.filter(thread_id__icontains=item).exists():
-                tlist = Thread.objects.filter(thread_id__icontains=item)
-                self.thread = tlist[len(tlist)-1]
-                match = True
+        match = self.find_thread()
+        if match:
+            self.thread = match
+            # thread is marked as unread when email is linked, counted in the db
+            Thread.objects.filter(pk=match.pk).update(**Thread.summary_changes([self]))
+            match.unread = True
+            match.note_email(self)
 
-        if not match:
+        else:
             thread = Thread(thread_id=self.message_id, user=self.user)
             thread.subject = self.subject
+            thread.note_email(self)
             thread.save()
             self.thread = thread
 
@@ -283,19 +664,45 @@ class EmailObj(models.Model):
         #     if filter.filter_email(self):
         #         self.thread.tags.add(filter.tag)
 
-        self.thread.save()
-        #
-        # thread is marked as unread by default when email is linked
-        self.thread.unread = True
-        # self.thread.save()
+        ThreadRef.register(self.thread, [self.message_id])
         self.save()
 
+    # --------------------------------------------------------------------------
+    def find_thread(self, pending=None) -> object:
+        """
+        returns the thread this email belongs to based on its Message-ID and
+        references, or None if there isn't one yet.  the last reference with a
+        matching thread wins (see assign_thread)
+
+        matches come from the ThreadRef table, one query for all references
+
+        - pending is a dict of {normalized message id: thread} for threads that
+        aren't in ThreadRef yet (batch ingest), they win over db matches
+        """
+        if pending is None:
+            pending = {}
+        refs = parse_email(self.references)
+        refs.insert(0, self.message_id)
+        refs = [ThreadRef.normalize(item) for item in refs if item]
+        found = ThreadRef.lookup(refs)
+        #
+        match = None
+        for item in refs:
+            if item in pending:
+                match = pending[item]
+            elif item in found:
+                match = found[item]
+        #
+        if match is None or isinstance(match, Thread):
+            return match
+        return Thread.objects.filter(pk=match).first()
+
     # --------------------------------------------------------------------------
     def filter_for_tags(self):
         # --- run filters on email and assign matching tags to thread ---
-        for filter in Filter.objects.all():
-            if filter.filter_email(self):
-                self.thread.tags.add(filter.tag)
+        tags = Filter.compiled().tags_for(self)
+        if tags:
+            self.thread.tags.add(*tags)
         #
         self.save()
 
@@ -306,12 +713,19 @@ class EmailObj(models.Model):
         - relpath is the date -> fname
 
         - will return False and set error flag if unable to read or find file
+        - parsed messages are shared through MESSAGE_CACHE, treat the returned
+        message as read only
         """
         try:
-            f = open(self.fileloc, 'rb')
-            msg = email.message_from_binary_file(f, policy=(email.policy.default))
-            f.close()
-            return msg
+            store = emlstore.store_for(self)
+            if self.blobs:
+                # --- attachments go back in before parsing ---
+                return store.load(
+                    self, MESSAGE_CACHE,
+                    wrap=lambda f: BLOBS.open_rebuilt(f, self.blobs),
+                    extra=sum(ref['length'] for ref in self.blobs),
+                )
+            return store.load(self, MESSAGE_CACHE)
         except:
             self.error = True
             self.error_msg = "Unable to find file: " + self.fileloc
@@ -323,10 +737,10 @@ class EmailObj(models.Model):
         """ send email body to template """
         msg = self.read_file()
         if msg:
-            if msg.is_multipart() and not self.has_attachments:
+            if self.structure is None and msg.is_multipart() and not self.has_attachments:
                 body = self.walk_email_for_body(msg)
             else:
-                body = self.get_body()
+                body = self.body_part(msg).get_content()
 
             body = body.replace("!important;", ";")
             return body
@@ -336,7 +750,7 @@ class EmailObj(models.Model):
         """
         returns body of email in format without any spacing or newlines
         """
-        cleantext = " ".join((BeautifulSoup(self.get_body(), "lxml").text).split())
+        cleantext = textextract.html_to_text(self.get_body())
         return cleantext
 
     # --------------------------------------------------------------------------
@@ -347,12 +761,26 @@ class EmailObj(models.Model):
         """
         msg = self.read_file()
         if msg:
-            body = msg.get_body(preferencelist=('html', 'related', 'plain'))
+            body = self.body_part(msg)
             content = body.get_content()
             return content
         else:
             return str(self.error_msg)
 
+    def body_part(self, msg) -> object:
+        """
+        the part of msg that is the body, taken straight from the position
+        recorded at ingest (structure body_part / body_type) when there is one,
+        otherwise msg.get_body works it out
+        """
+        if self.structure is not None and self.structure.get('body_part') is not None:
+            for index, part in enumerate(msg.walk()):
+                if index == self.structure['body_part']:
+                    if part.get_content_type() == self.structure['body_type']:
+                        return part
+                    break
+        return msg.get_body(preferencelist=('html', 'related', 'plain'))
+
     # --------------------------------------------------------------------------
     def date_match(self, datein) -> bool:
         """
@@ -408,7 +836,7 @@ class EmailObj(models.Model):
         exact_match=True will search for exact string matches
         """
         cleantext = self.subject
-        cleantext += BeautifulSoup(self.get_body(), "lxml").text
+        cleantext += textextract.html_to_text(self.get_body(), collapse=False)
 
         if exact_match:
             # --- need exact match for entire search string ---
@@ -434,15 +862,22 @@ class EmailObj(models.Model):
     # --------------------------------------------------------------------------
     @property
     def has_attachments(self):
-        if len(self.get_attachments()) > 0:
-            return True
-        else:
-            # will return an emply list if
-            return False
+        if self.attachment_index is not None:
+            return len(self.attachment_index) > 0
+        if self.structure is not None:
+            # --- answered from the ingest summary, no file access ---
+            return self.structure['attachment_count'] > 0
+        msg = self.read_file()
+        if msg:
+            for part in msg.iter_attachments():
+                return True
+        return False
 
     # --------------------------------------------------------------------------
     @property
     def is_html(self):
+        if self.structure is not None:
+            return self.structure['has_html']
         msg = self.read_file()
         if msg:
             tlist = [item['content-type'] for item in msg.walk()]
@@ -509,47 +944,109 @@ class EmailObj(models.Model):
         # returns an empty list if none found
         return alist
 
+    def iter_attachment(self, n, chunk_size=1 << 20) -> object:
+        """
+        decoded bytes of the n-th attachment (position in attachment_index) a
+        chunk at a time, read from its span of the stored file (or its blob)
+        without parsing the message.  raises IndexError if there is no index
+        for this email or no such attachment
+        """
+        entry = (self.attachment_index or [])[n]
+        if 'sha256' in entry:
+            return BLOBS.iter_payload(entry, chunk_size)
+        store = emlstore.store_for(self)
+        return attachindex.decode_chunks(
+            store.iter_range(self, entry['offset'], entry['length'], chunk_size), entry['encoding'],
+        )
+
+    def attachment_data(self, n) -> bytes:
+        """ decoded bytes of the n-th attachment, see iter_attachment """
+        return b''.join(self.iter_attachment(n))
+
+    def open_attachment(self, sha256) -> bytes:
+        """
+        decoded payload of an attachment kept in the blob store (one listed in
+        self.blobs), read straight from the blob without parsing the message
+        """
+        for ref in self.blobs or []:
+            if ref['sha256'] == sha256:
+                return BLOBS.payload(ref)
+        raise KeyError(sha256)
+
     # --------------------------------------------------------------------------
-    def write_file(self, eml_message) -> bool:
+    def write_file(self, eml_message, save=True) -> bool:
         """
         - uidl is a custom header added to all emails.  pulled from the id assigned
         by the mailserver
-        - save email obj as text .eml file
+        - save email obj as text .eml file, compressed if fileloc has a .gz/.zst
+        suffix, or as a record in the mailbox segments (EML_STORE, see emlstore)
+        - with ATTACHMENT_BLOBS on, large attachments go to the blob store and
+        the file keeps the rest (see blobstore)
+        - attachment_index is recorded from the same bytes
+        - the fields set here (see written_fields) are saved with one update if
+        the row exists and there is anything to save.  save=False leaves that
+        to the caller, write_batch saves a whole chunk with one bulk_update
         """
         try:
-            # check for mail directory
-            filepath = os.path.join(self.fileloc)
-            filedir = os.path.dirname(self.fileloc)
-            os.makedirs(filedir, exist_ok=True)
-
-            with open(filepath, 'wb') as f:
-                f.write(bytes(eml_message))
-                # gen = email.generator.Generator(f)
-                # gen.flatten(eml_message)
+            with metrics.timer('write'):
+                data = emlstore.message_bytes(eml_message)
+                spans = attachindex.scan(data)
+                stub = self.split_blobs(data, spans) if BLOBS_ENABLED else data
+                self.attachment_index = attachindex.build_index(spans, data, self.blobs)
+                emlstore.get_store().write(self, stub)
+                fields = self.written_fields()
+                if save and self.pk and fields:
+                    EmailObj.objects.filter(pk=self.pk).update(
+                        **{name: getattr(self, name) for name in fields}
+                    )
             return True
         except Exception as e:
+            if self.blobs:
+                AttachmentBlob.release(self.blobs)
+                self.blobs = None
             self.error = True
             self.save()
             errorstr = "unable to write email file - " + str(self.fileloc) + " "+ str(e)
             customlog.writelog('errorlog', errorstr)
             return False
 
+    def written_fields(self) -> list:
+        """
+        fields write_file set that differ from what the row was saved with.  an
+        empty attachment_index isn't saved, has_attachments gets the same
+        answer from structure
+        """
+        fields = [name for name in ('blobs', 'attachment_index') if getattr(self, name)]
+        if self.store_offset is not None:
+            # --- record in the segment store ---
+            fields += ['fileloc', 'store_offset', 'store_length']
+        return fields
+
+    def split_blobs(self, data, spans=None) -> bytes:
+        """
+        moves the attachment bodies of the raw message data into the blob
+        store, sets self.blobs and returns the bytes left to store
+        """
+        stub, refs, payloads = BLOBS.split(data, spans)
+        if refs:
+            AttachmentBlob.acquire(refs, payloads)
+            self.blobs = refs
+        return stub
+
     # --------------------------------------------------------------------------
     def trash_file(self) -> bool:
         """
         returns bool value of whether file moved successfully or not
         """
-        filename = os.path.basename(self.fileloc)
-        basepath = os.path.dirname(self.fileloc)
-        filepath = os.path.join(basepath, 'trash')
-        os.makedirs(filepath, exist_ok=True)
+        store = emlstore.store_for(self)
         try:
-            if not os.path.exists(os.path.join(filepath, filename)):
-                shutil.move(self.fileloc, filepath)
-                # self.fileloc = os.path.join(filepath, filename)
-                # self.save()
-            # self.fileloc = filepath
-            # self.save()
+            if self.blobs:
+                # --- trash keeps the whole message, blobs are released with the row ---
+                with store.open(self) as f:
+                    store.trash(self, BLOBS.rebuild(f.read(), self.blobs))
+            else:
+                store.trash(self)
+            MESSAGE_CACHE.invalidate(store.cache_path(self))
             return True
         except FileNotFoundError:
             return True
@@ -561,26 +1058,389 @@ class EmailObj(models.Model):
             # self.save()
             return False
 
+    def delete_file(self) -> bool:
+        """
+        removes the file skipping trash, errors are logged.  always returns
+        True, the row goes either way
+        """
+        store = emlstore.store_for(self)
+        try:
+            store.delete(self)
+            MESSAGE_CACHE.invalidate(store.cache_path(self))
+        except Exception as e:
+            customlog.writelog('errorlog', 'unable to delete %s - %s' % (str(self.fileloc), str(e)))
+        return True
+
+    # --------------------------------------------------------------------------
+    def delete(self, *args, **kwargs):
+        # --- drop search index entries along with the row ---
+        searchindex.unindex_emails([self.pk])
+        return super(EmailObj, self).delete(*args, **kwargs)
+
     # --------------------------------------------------------------------------
     def remove(self, skip_trash=False):
         # --- first check thread and delete if empty or if this is it's only related email---
         #
+        thread_pk = self.thread_id
+        row_deleted = False
         if self.thread:
             if len(self.thread.get_related_emails()) <= 1:
+                # thread delete cascades to this email, unindex it first
+                searchindex.unindex_emails([self.pk])
                 self.thread.delete()
+                thread_pk = None
+                row_deleted = True
         #
         if skip_trash:
             # --- remove file skipping trash ---
-            try:
-                os.remove(self.fileloc)
-            except Exception as e:
-                customlog.writelog('errorlog', 'unable to delete %s - %s' % (str(self.fileloc), str(e)))
+            self.delete_file()
             self.delete()
         #
         else:
             # --- attempt to move file to trash, mark with error if not ---
-            if self.trash_file():
-                self.delete()
+            if not self.trash_file():
+                if row_deleted and self.blobs:
+                    # --- the row went with the thread, so do its blob references ---
+                    AttachmentBlob.release(self.blobs)
+                return
+            self.delete()
+        #
+        if self.blobs:
+            AttachmentBlob.release(self.blobs)
+        if thread_pk:
+            Thread.refresh_summary([thread_pk])
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def bulk_remove(cls, emails, skip_trash=False, delete_files=True, batch_size=None,
+                    workers=None, progress=None, refresh_threads=True) -> int:
+        """
+        remove() for a whole queryset of emails, what Thread.remove and
+        MailAcct.clear_all_mail use:
+            - emails are handled in chunks of batch_size (BULK_DELETE_BATCH)
+            - files of a chunk are trashed (or deleted with skip_trash) on
+            workers threads (BULK_DELETE_WORKERS)
+            - search index entries and rows of a chunk go with one query each,
+            blob references with one release
+        emails whose file couldn't be trashed are kept, same as remove().
+        threads are left for the caller.  delete_files=False leaves the files
+        alone, for callers removing the mailbox directory anyway.  progress is
+        called with (done, total) after every chunk.  summaries of the
+        threads the emails were in are refreshed, refresh_threads=False skips
+        that for callers deleting those threads next
+
+        returns number of emails removed
+        """
+        batch_size = batch_size or BULK_DELETE_BATCH
+        workers = workers or BULK_DELETE_WORKERS
+        pks = list(emails.order_by('pk').values_list('pk', flat=True))
+        total = len(pks)
+        removed = 0
+        fields = ('pk', 'uidl', 'fileloc', 'store_offset', 'store_length', 'blobs', 'thread')
+        handle = cls.delete_file if skip_trash else cls.trash_file
+        #
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, total, batch_size):
+                chunk = list(cls.objects.filter(pk__in=pks[start:start + batch_size]).only(*fields))
+                if delete_files:
+                    done = [email for email, ok in zip(chunk, pool.map(handle, chunk)) if ok]
+                else:
+                    done = chunk
+                    for email in chunk:
+                        MESSAGE_CACHE.invalidate(emlstore.store_for(email).cache_path(email))
+                #
+                done_pks = [email.pk for email in done]
+                with transaction.atomic():
+                    searchindex.unindex_emails(done_pks)
+                    cls.objects.filter(pk__in=done_pks).delete()
+                refs = [ref for email in done for ref in email.blobs or []]
+                if refs:
+                    AttachmentBlob.release(refs)
+                if refresh_threads:
+                    Thread.refresh_summary([email.thread_id for email in done])
+                #
+                removed += len(done)
+                if len(done) < len(chunk):
+                    customlog.writelog('errorlog', 'bulk_remove - %d emails kept, trash failed' % (len(chunk) - len(done)))
+                if progress:
+                    progress(min(start + batch_size, total), total)
+        if total > batch_size:
+            customlog.writelog('maillog', 'bulk_remove - %d of %d emails removed' % (removed, total))
+        return removed
+
+# ******************************************************************************
+class AttachmentBlob(models.Model):
+    """
+    one row per attachment payload in the blob store (BLOBS), refcount is the
+    number of EmailObj.blobs entries pointing at it.  the blob file is removed
+    when the count drops to 0
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.IntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def acquire(cls, refs, payloads):
+        """
+        counts one reference per entry in refs, payloads ({sha256: bytes}) are
+        written for blobs not stored yet.  the file is checked for while the
+        count update holds the row lock, a release removing it either finished
+        before (the file is written again) or waits and sees the new count
+        """
+        counts = {}
+        for ref in refs:
+            counts[ref['sha256']] = counts.get(ref['sha256'], 0) + 1
+        with transaction.atomic():
+            for digest, n in counts.items():
+                # --- a release can delete the row in between, then it's created again ---
+                while not cls.objects.filter(sha256=digest).update(refcount=F('refcount') + n):
+                    cls.objects.bulk_create([cls(sha256=digest, size=len(payloads[digest]))], ignore_conflicts=True)
+                BLOBS.put(digest, payloads[digest])
+
+    @classmethod
+    def release(cls, refs):
+        """
+        drops one reference per entry in refs.  a blob whose count is at 0 is
+        removed inside the transaction while its row is locked, so an acquire
+        for the same blob waits and writes it again afterwards
+        """
+        counts = {}
+        for ref in refs:
+            counts[ref['sha256']] = counts.get(ref['sha256'], 0) + 1
+        with transaction.atomic():
+            for digest, n in counts.items():
+                cls.objects.filter(sha256=digest).update(refcount=F('refcount') - n)
+                row = cls.objects.select_for_update().filter(sha256=digest, refcount__lte=0).first()
+                if row is not None:
+                    row.delete()
+                    BLOBS.remove(digest)
+
+# ******************************************************************************
+class SeenUidl(models.Model):
+    """
+    every UIDL already fetched for an account that is still on the server,
+    new mail is whatever is in the server's UIDL listing and not in here (see
+    MailAcct.new_positions).
+
+    messages deleted on the server (by another client or autoremove) are
+    pruned by MailAcct.sync_server_state, they can't come back.
+    """
+    account = models.ForeignKey('MailAcct', on_delete=models.CASCADE)
+    uidl = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('account', 'uidl')
+
+# ******************************************************************************
+class AccountStats(models.Model):
+    """
+    last known server side numbers for an account, so MailAcct.stats (and
+    anything showing it on a page) doesn't need a POP3 connection.  written
+    whenever a UIDL listing is taken anyway (FetchSession, main_async,
+    server_stat), read from the server by current() only once older than the
+    max_age asked for
+    """
+    account = models.OneToOneField('MailAcct', on_delete=models.CASCADE, related_name='server_stats')
+    remote_emails = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
+    connected = models.BooleanField(default=False)
+    error = models.TextField(null=True, blank=True)
+    checked = models.DateTimeField(null=True, blank=True, default=None)
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def record(cls, account, remote_emails=None, unread=None, error=None):
+        """
+        stores a reading for account, error is the connect error (the numbers
+        from the last good reading are kept)
+        """
+        values = {"checked": timezone.now(), "connected": error is None, "error": error}
+        if remote_emails is not None:
+            values["remote_emails"] = remote_emails
+        if unread is not None:
+            values["unread"] = unread
+        try:
+            cls.objects.update_or_create(account=account, defaults=values)
+        except Exception as e:
+            # --- stats are nice to have, never stop a fetch over them ---
+            customlog.writelog('errorlog', 'AccountStats.record %s - %s' % (str(account), str(e)))
+
+    @classmethod
+    def current(cls, account, max_age=STATS_TTL) -> object:
+        """
+        stats for account, read from the server first if there are none yet
+        or they are older than max_age seconds.  max_age=None never goes to
+        the server (an unsaved, never checked row if there is nothing yet)
+        """
+        row = cls.objects.filter(account=account).first()
+        if max_age is None:
+            return row or cls(account=account)
+        if row is None or row.checked is None or (timezone.now() - row.checked).total_seconds() > max_age:
+            account.refresh_server_stats()
+            row = cls.objects.filter(account=account).first() or cls(account=account)
+        return row
+
+# ******************************************************************************
+class FetchSession:
+    """
+    one pass over the new mail for a MailAcct.
+
+    the UIDL listing is taken once when the session is opened and the new
+    positions are worked out locally, iterating over the session then RETRs
+    each of those positions back to back.  each message is marked as seen
+    (and current_uidl moved forward) as it is handed out, same as grab_eml,
+    pass checkpoint=False when the caller does that itself (batch ingest).
+
+    deadline is the number of seconds the session may run for (defaults to
+    the account's fetch_deadline, 0 or None for no limit).  once it passes no
+    more messages are fetched, the rest stay in pending for the next run
+    (deadline_hit is set).  a RETR still running at the deadline is cut off
+    by shutting the socket down, that message stays in pending too.
+
+    the POP3 session is checked out of poppool for as long as the session
+    runs and put back (close()) once iterating ends.
+
+    usage:
+        session = account.fetch_session()
+        for eml_message in session:
+            ...
+    """
+    def __init__(self, account, checkpoint=True, deadline=None):
+        if deadline is None:
+            deadline = account.fetch_deadline
+        self.deadline = time.monotonic() + deadline if deadline else None
+        self.account = account
+        self.checkpoint = checkpoint
+        self.deadline_hit = False
+        self.cut_off = False
+        self.connection = account.get_connection()
+        self.pending = collections.deque()
+        if self.connection:
+            try:
+                snapshot = account.uidl_snapshot()
+                self.pending = collections.deque(account.new_positions(snapshot))
+                account.sync_server_state(snapshot)
+            except Exception:
+                self.close(broken=True)
+                raise
+            AccountStats.record(account, len(snapshot), len(self.pending))
+        elif account.connect_err != poppool.BUSY:
+            # --- busy means another fetch has the mailbox, it records its own numbers ---
+            AccountStats.record(account, error=account.connect_err)
+
+    # --------------------------------------------------------------------------
+    @property
+    def unread(self):
+        """
+        number of messages still waiting to be fetched, or error message if
+        unable to connect (same as MailAcct.stat_unread)
+        """
+        if not self.connection:
+            return "ERR can't connect: " + self.account.connect_err
+        return len(self.pending)
+
+    # --------------------------------------------------------------------------
+    def __iter__(self):
+        if not self.connection:
+            return
+        try:
+            while self.pending:
+                if not self.within_deadline():
+                    return
+                pos, server_id = self.pending.popleft()
+                try:
+                    with metrics.timer('retr', self.account):
+                        response = self.retr(pos)
+                except Exception:
+                    # --- connection is suspect, next get_connection opens a new one ---
+                    self.close(broken=True)
+                    if self.cut_off or (self.deadline is not None and time.monotonic() >= self.deadline):
+                        self.pending.appendleft((pos, server_id))
+                        self.reached_deadline()
+                        return
+                    raise
+                metrics.count('messages', 1, self.account)
+                metrics.count('bytes', response[2], self.account)
+                email_message = build_eml_message(response[1], server_id)
+
+                if self.checkpoint:
+                    self.account.mark_seen([server_id])
+                yield email_message
+        finally:
+            self.close()
+            AccountStats.record(self.account, unread=len(self.pending))
+
+    def close(self, broken=False):
+        """
+        hands the connection back to poppool (one RSET for the whole session
+        instead of one per message), broken=True drops it instead.  called
+        when iterating ends, call it yourself if the session isn't iterated
+        """
+        if not self.connection:
+            return
+        if broken or self.cut_off:
+            poppool.POOL.discard(self.account, quit=False)
+        else:
+            if not self.account.autoremove:
+                try:
+                    self.connection.rset()
+                except Exception as e:
+                    customlog.writelog('errorlog', 'fetch session rset - ' + str(e))
+            if self.deadline is not None:
+                self.set_timeout(self.account.read_timeout)
+            poppool.POOL.put(self.account, self.connection)
+        self.connection = False
+        self.account.connection = False
+
+    # --------------------------------------------------------------------------
+    def within_deadline(self) -> bool:
+        """
+        False once the deadline has passed, otherwise caps the socket timeout
+        at the time that is left
+        """
+        if self.deadline is None:
+            return True
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            self.reached_deadline()
+            return False
+        self.set_timeout(min(self.account.read_timeout, remaining))
+        return True
+
+    def reached_deadline(self):
+        self.deadline_hit = True
+        customlog.writelog('maillog', 'fetch session for %s hit its deadline, %d messages left' % (
+            str(self.account), len(self.pending),
+        ))
+        metrics.count('deadlines', 1, self.account)
+
+    def retr(self, pos) -> tuple:
+        """ RETR pos, the socket is shut down if it's still running at the deadline """
+        if self.deadline is None:
+            return self.connection.retr(pos)
+        connection = self.connection
+        #
+        def cut_off():
+            self.cut_off = True
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
+                pass # connection already closed
+        #
+        timer = threading.Timer(max(0, self.deadline - time.monotonic()), cut_off)
+        timer.daemon = True
+        timer.start()
+        try:
+            return connection.retr(pos)
+        finally:
+            timer.cancel()
+
+    def set_timeout(self, seconds):
+        try:
+            self.connection.sock.settimeout(seconds)
+        except Exception:
+            pass # connection already closed
 
 
 # ******************************************************************************
@@ -614,6 +1474,13 @@ class MailAcct(models.Model):
     portno_out = models.IntegerField(default=465) # default is ssl smtp
     password = models.CharField(max_length=128)
     current_uidl = models.CharField(max_length=64, null=True, blank=True, default=None)
+    # --- seconds, socket timeouts for the POP3 session ---
+    connect_timeout = models.FloatField(default=5)
+    read_timeout = models.FloatField(default=30)
+    fetch_deadline = models.IntegerField(
+        verbose_name = "seconds a fetch session may run for, 0 for no limit",
+        default=0,
+    )
 
     # --------------------------------------------------------------------------
     def __init__(self, *args, **kwargs):
@@ -626,15 +1493,6 @@ class MailAcct(models.Model):
         self.connection = False
         self.connect_err = ""
 
-    # --------------------------------------------------------------------------
-    def __del__(self, *args, **kwargs):
-        """
-        # --- destructor ---
-        close any open connections when destructor is called
-        """
-        if self.connection:
-            self.connection.close()
-
     # runtime variables ---------------------------------
     # def set_connection(self):
     #     """
@@ -647,57 +1505,100 @@ class MailAcct(models.Model):
     #
     #     return (connect_status, connection)
     # --------------------------------------------------------------------------
-    def stats(self) -> dict:
+    def stats(self, max_age=STATS_TTL) -> dict:
         """
         returns a dict of string values for stats on the account
+
+        - saved_* / error_emails are aggregate COUNT queries
+        - server values come from AccountStats, kept fresh by the fetch cycle.
+        the server is only asked (one connection lookup, one UIDL listing)
+        when they're older than max_age seconds, max_age=None never connects
+        - stats_checked is when the server values were read
         """
-        serverstats = self.server_stat()
+        server = AccountStats.current(self, max_age)
+        if server.checked is None:
+            unread = "not checked yet"
+        elif not server.connected:
+            unread = "ERR can't connect: " + str(server.error)
+        else:
+            unread = server.unread
+        counts = EmailObj.objects.filter(user=self).aggregate(
+            saved=Count('pk'), errors=Count('pk', filter=Q(error=True)),
+        )
         infodict = {
             "account": str(self),
-            "connected": bool(self.get_connection()),
+            "connected": server.connected,
             "uidl": self.current_uidl,
-            "remote_emails": serverstats['num_total'],
-            "unread": self.stat_unread(),
-            "saved_threads": len(self.get_threads()),
-            "saved_emails": len(self.get_related_emails()),
-            "error_emails": EmailObj.objects.filter(user=self, error=True),
+            "remote_emails": server.remote_emails,
+            "unread": unread,
+            "saved_threads": Thread.objects.filter(user=self).count(),
+            "saved_emails": counts['saved'],
+            "error_emails": counts['errors'],
+            "stats_checked": server.checked,
         }
 
         return infodict
     #
     @property
     def attr_stats(self) -> dict:
-        return self.stats()
+        """ cached stats only, never opens a POP3 connection (for pages) """
+        return self.stats(max_age=None)
 
-    # --------------------------------------------------------------------------
-    def get_connection(self) -> object:
+    def refresh_server_stats(self):
+        """
+        reads the server values for AccountStats now (one UIDL listing).  if a
+        fetch has the session checked out the stats are left to it
         """
-        get temp connection value for this MailAcct instance
+        with self.pop_session(wait=0) as connection:
+            if connection:
+                snapshot = self.uidl_snapshot()
+                AccountStats.record(self, len(snapshot), len(self.new_positions(snapshot)))
+            elif self.connect_err != poppool.BUSY:
+                AccountStats.record(self, error=self.connect_err)
 
-        self.connection will be set to False if unable to connect
+    # --------------------------------------------------------------------------
+    def get_connection(self, wait=None) -> object:
         """
-        # if not 'connection' in self.__dict__:
-        # if not self.connection:
-        #     self.set_connection()
-        # else:
-        #     self.test_connection()
+        check out a live connection for this account from poppool.POOL, sessions
+        are shared with every other MailAcct instance for the same mailbox (one
+        user at a time) and are only probed with a NOOP when they haven't been
+        used for a while.  hand it back with release_connection(), or use
+        pop_session()
+
+        self.connection will be set to False if unable to connect (or the
+        session is still checked out after wait seconds, see poppool)
+        """
+        self.connection = poppool.POOL.get(self, wait)
+        return self.connection
 
-        # --- update connection status ---
+    def release_connection(self, broken=False):
+        """ check self.connection back in to poppool, broken=True closes it instead """
         if self.connection:
-            try:
-                self.connection.noop()
-            except:
-                self.pop_connect()
-        else:
-            self.pop_connect()
-
-        # self.test_connection()
+            if broken:
+                poppool.POOL.discard(self, quit=False)
+            else:
+                poppool.POOL.put(self, self.connection)
+        self.connection = False
 
-        return self.connection
+    @contextlib.contextmanager
+    def pop_session(self, wait=None):
+        """
+        get_connection for a block, the connection (or False) is checked back
+        in afterwards, or closed if the block raised
+        """
+        connection = self.get_connection(wait)
+        try:
+            yield connection
+        except Exception:
+            self.release_connection(broken=True)
+            raise
+        else:
+            self.release_connection()
     #
     @property
     def attr_get_connection(self) -> bool:
-        return bool(self.get_connection())
+        with self.pop_session(wait=0) as connection:
+            return bool(connection) or self.connect_err == poppool.BUSY
 
     # ---------------------------------------------------
     def __str__(self):
@@ -706,8 +1607,10 @@ class MailAcct(models.Model):
     # --------------------------------------------------------------------------
     def reset_uidl(self):
         """
-        reset temp uidl
+        reset temp uidl and forget which uidls were fetched, messages that
+        are still saved locally are skipped again (see seed_seen_uidls)
         """
+        self.forget_uidls()
         self.current_uidl = None
         self.save()
 
@@ -717,82 +1620,193 @@ class MailAcct(models.Model):
         get a single email from server, return email object or None
         '''
         # --- get next email from server ---
-        connection = self.get_connection()
-        #
-        if not connection:
-            return None
-        # unread = self.stat_unread()
-        pos = self.check_uidl()
-
-        if pos > 0:
-            # --- parse for headers, convert to email.message ---
-            try:
-                aaa = connection.retr(pos)
-                if not self.autoremove:
-                    connection.rset()
-
-                orig_content = aaa[1]
-                server_id = connection.uidl(pos).split()[2].decode('utf-8')
-                eml = b'\n'.join(orig_content)
-                email_message = email.message_from_bytes(eml, policy=email.policy.default)
-
-                # --- UIDL and MSG-ID are custom headers we use to help later on ---
-                email_message['UIDL'] = server_id
-
-                if not email_message['Message-ID'] or '@' not in email_message['Message-ID']:
-                    email_message['MSG-ID'] = email_message['UIDL']
-
-                else:
-                    message_id = parse_email(email_message['Message-ID'])[0]
-                    email_message['MSG-ID'] = message_id
-
-                self.current_uidl = server_id
-                self.save()
-            except Exception as e:
-                raise Exception(e)
-        else:
-            email_message = None
+        with self.pop_session() as connection:
+            if not connection:
+                return None
+            # unread = self.stat_unread()
+            pos = self.check_uidl()
+
+            if pos > 0:
+                # --- parse for headers, convert to email.message ---
+                try:
+                    with metrics.timer('retr', self):
+                        aaa = connection.retr(pos)
+                    metrics.count('messages', 1, self)
+                    metrics.count('bytes', aaa[2], self)
+                    if not self.autoremove:
+                        connection.rset()
+
+                    orig_content = aaa[1]
+                    server_id = connection.uidl(pos).split()[2].decode('utf-8')
+                    email_message = build_eml_message(orig_content, server_id)
+
+                    self.mark_seen([server_id])
+                except Exception as e:
+                    # --- connection is suspect, pop_session closes it ---
+                    raise Exception(e)
+            else:
+                email_message = None
 
         return email_message
     #
     # --------------------------------------------------------------------------
     def check_uidl(self):
         """
-        compare last_uidl with server to find position to start popping from
-        default position is 1,
+        compare the server's UIDL listing with SeenUidl to find the position to
+        start popping from (the first message not fetched yet)
 
         *** WILL RETURN 0 IF NO NEW MAIL ***
+        """
+        new_mail = self.new_positions(self.uidl_snapshot())
+        if len(new_mail) == 0:
+            return 0 # no new mail
 
-        NOTE: will return one position past the current uidl, so if we ended at pos
-        7 last time this will return 8
+        return new_mail[0][0]
+    #
+    # --------------------------------------------------------------------------
+    def uidl_snapshot(self) -> list:
+        """
+        single UIDL listing from the server, returned as a list of (pos, uidl)
+        tuples in server order
+        """
+        with metrics.timer('uidl', self):
+            return parse_uidl_listing(self.connection.uidl()[1])
+    #
+    # --------------------------------------------------------------------------
+    def new_positions(self, snapshot) -> list:
+        """
+        works out which (pos, uidl) entries of a uidl_snapshot are new mail,
+        same rules as check_uidl without going back to the server
+
+        - anything not in the SeenUidl table is new, so messages deleted on the
+        server don't change what counts as new.  only the uidls in the listing
+        are looked up
+        - accounts from before the SeenUidl table are seeded from their saved
+        emails and current_uidl the first time (see seed_seen_uidls)
+        """
+        seen = self.seen_uidls([uidl for pos, uidl in snapshot])
+        if not seen and not SeenUidl.objects.filter(account=self).exists() and \
+                (self.current_uidl or EmailObj.objects.filter(user=self).exists()):
+            seen = self.seed_seen_uidls(snapshot)
+        return [(pos, uidl) for pos, uidl in snapshot if uidl not in seen]
+    #
+    # --------------------------------------------------------------------------
+    def seen_uidls(self, uidls=None) -> set:
         """
-        ulist = [item.split()[1].decode('utf-8') for item in self.connection.uidl()[1]]
-        # go up two spaces, will be out of bounds if current_uidl is last item
-        # (server indexing starts at "1" vs the response here which starts at "0"
-        # hence adding "2")
+        set of the uidls already fetched for this account, only those among
+        uidls if given (looked up UIDL_CHUNK at a time)
+        """
+        seen = SeenUidl.objects.filter(account=self)
+        if uidls is None:
+            return set(seen.values_list('uidl', flat=True))
+        uidls = list(uidls)
+        found = set()
+        for start in range(0, len(uidls), UIDL_CHUNK):
+            found.update(seen.filter(uidl__in=uidls[start:start + UIDL_CHUNK]).values_list('uidl', flat=True))
+        return found
+
+    def mark_seen(self, uidls):
+        """
+        record uidls as fetched, current_uidl is moved to the last one (kept
+        for stats, it isn't used to find new mail anymore)
+        """
+        uidls = [uidl for uidl in uidls if uidl]
+        if not uidls:
+            return
+        SeenUidl.objects.bulk_create(
+            [SeenUidl(account=self, uidl=uidl) for uidl in uidls],
+            ignore_conflicts=True,
+        )
+        self.current_uidl = uidls[-1]
+        self.save(update_fields=['current_uidl'])
+
+    def forget_uidls(self, uidls=None):
+        """ drop uidls (all of them if None) so they are fetched again """
+        seen = SeenUidl.objects.filter(account=self)
+        if uidls is not None:
+            seen = seen.filter(uidl__in=list(uidls))
+        seen.delete()
+
+    def seed_seen_uidls(self, snapshot) -> set:
+        """
+        fills SeenUidl for an account that only has the old current_uidl
+        cursor: uidls of emails already saved plus everything on the server
+        up to and including current_uidl.  returns the seeded set
+        """
+        seen = set(
+            EmailObj.objects.filter(user=self, uidl__isnull=False).values_list('uidl', flat=True)
+        )
+        ulist = [uidl for pos, uidl in snapshot]
         if self.current_uidl in ulist:
-            pos = ulist.index(self.current_uidl) + 2
-            if pos > self.connection.stat()[0]:
-                pos = 0 # no new mail
-        else:
-            # current_uidl not on server (all mail is new)
-            pos = 1
-
-        return pos
+            seen.update(ulist[:ulist.index(self.current_uidl) + 1])
+        SeenUidl.objects.bulk_create(
+            [SeenUidl(account=self, uidl=uidl) for uidl in seen],
+            ignore_conflicts=True,
+            batch_size=1000,
+        )
+        return seen
+
+    def sync_server_state(self, snapshot) -> int:
+        """
+        prunes seen uidls that are no longer in the server listing (deleted on
+        the server).  the row for current_uidl stays so an emptied mailbox
+        isn't seeded again (see new_positions).  the listing is only counted
+        against the table, rows are read when some are gone.  returns number
+        of uidls pruned
+        """
+        listing = set(uidl for pos, uidl in snapshot)
+        listing.discard(self.current_uidl)
+        rows = SeenUidl.objects.filter(account=self).exclude(uidl=self.current_uidl)
+        uidls = list(listing)
+        on_server = 0
+        for start in range(0, len(uidls), UIDL_CHUNK):
+            on_server += rows.filter(uidl__in=uidls[start:start + UIDL_CHUNK]).count()
+        if rows.count() <= on_server:
+            return 0
+        gone = [pk for pk, uidl in rows.values_list('pk', 'uidl') if uidl not in listing]
+        for start in range(0, len(gone), UIDL_CHUNK):
+            SeenUidl.objects.filter(pk__in=gone[start:start + UIDL_CHUNK]).delete()
+        metrics.count('server_deletions', len(gone), self)
+        return len(gone)
     #
     # --------------------------------------------------------------------------
-    def clear_all_mail(self, skip_trash=False) -> bool:
+    def fetch_session(self, checkpoint=True, deadline=None) -> object:
+        """
+        returns a FetchSession for pulling all new mail in one pass
+        """
+        return FetchSession(self, checkpoint, deadline)
+    #
+    # --------------------------------------------------------------------------
+    def clear_all_mail(self, skip_trash=False, delete_files=True, progress=None) -> bool:
         """
         delete all related email objects
+
+        - rows and files go in chunks through EmailObj.bulk_remove, progress
+        is handed to it (called with (done, total) after every chunk)
+        - delete_files=False leaves the files for a caller removing the whole
+        mailbox directory
+        - emails kept because their trash failed are deleted with their
+        threads, their index entries and blob references go first
         """
         try:
-            # --- first check for threads and delete those ---
-            for thread in Thread.objects.filter(user=self):
-                thread.remove(skip_trash)
-            # --- second pass to delete any remaining emails ---
-            for email in self.get_related_emails():
-                email.remove(skip_trash)
+            EmailObj.bulk_remove(
+                self.get_related_emails(), skip_trash,
+                delete_files=delete_files, progress=progress, refresh_threads=False,
+            )
+            # --- threads in chunks, emails kept because their trash failed go with them ---
+            thread_pks = list(Thread.objects.filter(user=self).values_list('pk', flat=True))
+            for start in range(0, len(thread_pks), BULK_DELETE_BATCH):
+                chunk = thread_pks[start:start + BULK_DELETE_BATCH]
+                kept = list(EmailObj.objects.filter(thread_id__in=chunk).values_list('pk', 'blobs'))
+                with transaction.atomic():
+                    # --- the cascade skips EmailObj.delete, unindex them here ---
+                    searchindex.unindex_emails([pk for pk, blobs in kept])
+                    Thread.objects.filter(pk__in=chunk).delete()
+                refs = [ref for pk, blobs in kept for ref in blobs or []]
+                if refs:
+                    AttachmentBlob.release(refs)
             #
+            self.forget_uidls()
             self.current_uidl = None
             self.save()
             return True
@@ -835,7 +1849,8 @@ class MailAcct(models.Model):
         Note: this also deletes the Trash directory inside the mailbox
         """
         try:
-            self.clear_all_mail(skip_trash=True)
+            # --- the directory goes below, no need to delete files one by one ---
+            self.clear_all_mail(skip_trash=True, delete_files=False)
             # self.clear_deleted()
             dirpath = os.path.join(MAILDIR, self.address)
             if os.path.exists(dirpath):
@@ -848,7 +1863,8 @@ class MailAcct(models.Model):
 
     # --------------------------------------------------------------------------
     def get_threads(self):
-        return Thread.objects.filter(user=self)
+        """ threads by last activity (summary fields, no join to the emails) """
+        return Thread.objects.filter(user=self).order_by(F('last_date').desc(nulls_last=True), '-pk')
     #
     # --------------------------------------------------------------------------
     def get_related_emails(self):
@@ -865,6 +1881,8 @@ class MailAcct(models.Model):
         """
         results = self.get_related_emails()
         searchstr = searchstr.lower()
+        # --- index narrows down candidates, filters below keep the same matching ---
+        results = searchindex.narrow(results, searchstr, exact_match)
         if not exact_match:
             # --- run through each item in search string ---
             searchstr = searchstr.split()
@@ -885,7 +1903,7 @@ class MailAcct(models.Model):
         returns a set of threads
         """
         email_list = self.search_emails(searchstr, exact_match)
-        return list(set(eml.thread for eml in email_list))
+        return list(Thread.objects.filter(pk__in=email_list.values('thread_id')))
     #
     # --------------------------------------------------------------------------
     def pop_connect(self):
@@ -895,34 +1913,67 @@ class MailAcct(models.Model):
             gmail - pop.gmail.com - 995
             aircom - office.aircomusa.com - 1100
 
-        signal_handler will timeout after 5 seconds
+        timeouts are set on the socket (connect_timeout until logged in, then
+        read_timeout for every command after that) so this works from any
+        thread, not just the main one
 
         sets the self.connection variable
             - if unable to connect, puts reason into self.connect_err
         """
-        def signal_handler(signum, frame):
-            sys.exit(1)
-        #
-        signal.signal(signal.SIGALRM, signal_handler)
         try:
-            signal.alarm(5) #timeout 5 seconds
-            try:
-                M = poplib.POP3_SSL(self.server)
-            except:
-                signal.alarm(3) #timeout 3 seconds
-                M = poplib.POP3(self.server, self.portno_in)
-                M.stls(context=None)
+            with metrics.timer('connect', self):
+                try:
+                    M = poplib.POP3_SSL(self.server, timeout=self.connect_timeout)
+                except:
+                    M = poplib.POP3(self.server, self.portno_in, timeout=self.connect_timeout)
+                    M.stls(context=None)
 
-            # --- no timeout, deactivate alarm ---
-            signal.alarm(0)
-            M.user(self.user)
-            M.pass_(self.password)
+                M.user(self.user)
+                M.pass_(self.password)
+                M.sock.settimeout(self.read_timeout)
 
             self.connection = M
 
         except Exception as e:
             self.connection = False
             self.connect_err = str(e)
+            metrics.count('connect_errors', 1, self)
+
+    #
+    # --------------------------------------------------------------------------
+    async def async_pop_connect(self) -> object:
+        """
+        asyncio version of pop_connect, same order of attempts (SSL first, then
+        plain connection upgraded with STLS) and same timeouts
+
+        returns an aiopop.AsyncPOP3 session or False, if unable to connect puts
+        reason into self.connect_err.  self.connection is not touched so the
+        blocking connection for this account is left alone
+        """
+        M = None
+        try:
+            with metrics.timer('connect', self):
+                try:
+                    M = await aiopop.AsyncPOP3.connect(
+                        self.server, use_ssl=True, timeout=self.connect_timeout,
+                    )
+                except Exception:
+                    M = await aiopop.AsyncPOP3.connect(
+                        self.server, self.portno_in, timeout=self.connect_timeout,
+                    )
+                    await M.stls()
+
+                await M.user(self.user)
+                await M.pass_(self.password)
+                M.timeout = self.read_timeout
+            return M
+
+        except Exception as e:
+            if M:
+                M.close()
+            self.connect_err = str(e)
+            metrics.count('connect_errors', 1, self)
+            return False
 
     #
     # --------------------------------------------------------------------------
@@ -933,22 +1984,12 @@ class MailAcct(models.Model):
         if unable to connect will return error message
         '''
         # --- double check for connection ---
-        connection = self.get_connection()
-        if not connection:
-            return "ERR can't connect: " + self.connect_err
+        with self.pop_session() as connection:
+            if not connection:
+                return "ERR can't connect: " + self.connect_err
 
-        # note: pos is index of next email to be popped
-        pos = self.check_uidl()
-
-        if pos == 0:
-            # --- no new messages ---
-            num_unread = 0
-        #
-        else:
-            # --- current_uidl found on server, get everything after that ---
-            num_unread = connection.stat()[0] - (pos - 1) # from last popped email (not next)
-
-        return num_unread
+            # --- anything on the server that isn't in SeenUidl ---
+            return len(self.new_positions(self.uidl_snapshot()))
     #
 
     @property
@@ -960,18 +2001,24 @@ class MailAcct(models.Model):
         '''
         returns dictionary of stats on server
         '''
-        connection = self.get_connection()
-        if not connection:
-            stat_dict = {
-                "pos": 0,
-                "num_total": 0,
-                "connection": f"ERR can't connect: {self.connect_err}",
-            }
-        else:
-            stat_dict = {
-                "pos": self.check_uidl(),
-                "num_total": connection.stat()[0],
-            }
+        with self.pop_session() as connection:
+            if not connection:
+                if self.connect_err != poppool.BUSY:
+                    AccountStats.record(self, error=self.connect_err)
+                stat_dict = {
+                    "pos": 0,
+                    "num_total": 0,
+                    "connection": f"ERR can't connect: {self.connect_err}",
+                }
+            else:
+                # --- one UIDL listing for both values ---
+                snapshot = self.uidl_snapshot()
+                new_mail = self.new_positions(snapshot)
+                AccountStats.record(self, len(snapshot), len(new_mail))
+                stat_dict = {
+                    "pos": new_mail[0][0] if new_mail else 0,
+                    "num_total": len(snapshot),
+                }
         return stat_dict
     #
     # --------------------------------------------------------------------------
@@ -1008,6 +2055,7 @@ class MailAcct(models.Model):
                 msg['References'] = '<'+ last_email.message_id +'>'
             thread.thread_id = msg['References']
             thread.save()
+            ThreadRef.register(thread, parse_email(thread.thread_id))
 
             if type(email_form['email_body']) == list:
                 html_text = " ".join(email_form['email_body'])
@@ -0,0 +1,106 @@
+"""
+bounded LRU cache of parsed .eml files, shared by the EmailObj accessors
+(read_file and everything built on it) so one page view doesn't parse the same
+file over and over.
+
+entries are keyed on (path, mtime, size) so a rewritten file is parsed again,
+and the cache is bounded by the total size of the cached files.  records that
+never change in place (segment store) pass their size in and skip the stat.
+"""
+
+import os, threading
+from collections import OrderedDict
+
+# ******************************************************************************
+class MessageCache:
+    """
+    - loader is called with an open binary file and returns the parsed message
+    - max_bytes caps the total file size held in the cache, files bigger than
+    that are parsed every time and never cached
+    - opener opens a path for reading (binary), emlstore.open_eml for stores
+    with compressed files
+    """
+    def __init__(self, loader, max_bytes, opener=open):
+        self.loader = loader
+        self.opener = opener
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # key -> (message, size)
+        self.paths = {}              # path -> key currently cached for it
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def get(self, path, size=None, opener=None, extra=0) -> object:
+        """
+        returns the parsed message for path, raises OSError if the file can't
+        be read
+
+        - size given means path names something immutable (a segment record,
+        path is just its key), it is opened with opener instead of self.opener
+        - extra is added to the size counted against max_bytes, for openers
+        that hand back more than what's stored at path
+        """
+        if size is None:
+            st = os.stat(path)
+            key = (path, st.st_mtime_ns, st.st_size)
+        else:
+            key = (path, 0, size)
+        size = key[2] + extra
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        #
+        # --- parse outside the lock so other readers aren't held up ---
+        with (opener or self.opener)(path, 'rb') as f:
+            message = self.loader(f)
+        #
+        if size <= self.max_bytes:
+            with self.lock:
+                self._discard(self.paths.get(path))
+                self.entries[key] = (message, size)
+                self.paths[path] = key
+                self.total += size
+                while self.total > self.max_bytes:
+                    oldest = next(iter(self.entries))
+                    self._discard(oldest)
+                    self.evictions += 1
+        return message
+
+    # --------------------------------------------------------------------------
+    def _discard(self, key):
+        """ drop an entry, lock has to be held """
+        entry = self.entries.pop(key, None) if key else None
+        if entry is not None:
+            self.total -= entry[1]
+            if self.paths.get(key[0]) == key:
+                del self.paths[key[0]]
+
+    def invalidate(self, path):
+        """ forget whatever is cached for path (file moved or deleted) """
+        with self.lock:
+            self._discard(self.paths.get(path))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.paths.clear()
+            self.total = 0
+
+    # --------------------------------------------------------------------------
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
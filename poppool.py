@@ -0,0 +1,221 @@
+"""
+keeps POP3 sessions open between calls so MailAcct.get_connection doesn't
+send a NOOP (or log in again) every time it's asked for a connection.
+
+sessions are keyed by mailbox (server, port, user), so every MailAcct
+instance for the same account shares one session, including instances from
+separate controller.main runs in the same process.
+
+sessions are checked out: get() takes the session out of the pool and put()
+hands it back, so only one caller (thread) talks to a mailbox at a time.
+a get() for a mailbox whose session is checked out waits up to CHECKOUT_WAIT
+seconds for it to come back, then gives up with account.connect_err = BUSY
+(a second login would only hit the server's maildrop lock).
+
+- a session used in the last PROBE_AFTER seconds is handed out as is, older
+ones are checked with a NOOP first and reopened if that fails
+- a POP3 server only shows the mail that was there when the session logged
+in, so sessions are logged out and back in once they are MAX_AGE seconds old
+(new mail shows up at most that late)
+- sessions idle in the pool for IDLE_TIMEOUT seconds are closed with QUIT
+- at most MAX_SESSIONS are kept, the least recently used idle one is closed
+to make room
+- ageing, idle timeouts and close_all() only ever touch sessions that are in
+the pool, never one that is checked out
+- everything in the pool is closed with QUIT at interpreter exit
+
+settings (scarifsettings): POP_PROBE_AFTER, POP_SESSION_MAX_AGE,
+POP_IDLE_TIMEOUT, POP_MAX_SESSIONS, POP_CHECKOUT_WAIT
+"""
+
+import time, threading, atexit
+
+from scarifmail import scarifsettings, metrics
+
+PROBE_AFTER = getattr(scarifsettings, 'POP_PROBE_AFTER', 10)
+MAX_AGE = getattr(scarifsettings, 'POP_SESSION_MAX_AGE', 60)
+IDLE_TIMEOUT = getattr(scarifsettings, 'POP_IDLE_TIMEOUT', 120)
+MAX_SESSIONS = getattr(scarifsettings, 'POP_MAX_SESSIONS', 32)
+CHECKOUT_WAIT = getattr(scarifsettings, 'POP_CHECKOUT_WAIT', 10)
+
+BUSY = "session in use"
+
+# ------------------------------------------------------------------------------
+def account_key(account) -> tuple:
+    return (account.server, account.portno_in, account.user)
+
+# ******************************************************************************
+class PooledSession:
+    __slots__ = ('connection', 'opened', 'last_used')
+
+    def __init__(self, connection, now):
+        self.connection = connection
+        self.opened = now
+        self.last_used = now
+
+# ******************************************************************************
+class ConnectionManager:
+    """
+    checks POP3 sessions out per account, see the module docstring
+
+    sessions are opened with account.pop_connect().  every get() that returns
+    a connection has to be matched by put() (done with it, session goes back
+    in the pool) or discard() (connection is broken or should be closed),
+    MailAcct.pop_session() does that around a block
+    """
+    def __init__(self, probe_after=PROBE_AFTER, max_age=MAX_AGE,
+                 idle_timeout=IDLE_TIMEOUT, max_sessions=MAX_SESSIONS, checkout_wait=CHECKOUT_WAIT):
+        self.probe_after = probe_after
+        self.max_age = max_age
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.checkout_wait = checkout_wait
+        self.sessions = {}      # in the pool, free to check out
+        self.checked_out = {}   # handed out by get(), key -> session (None while opening)
+        self.lock = threading.Lock()
+        self.returned = threading.Condition(self.lock)
+
+    # --------------------------------------------------------------------------
+    def get(self, account, wait=None) -> object:
+        """
+        checks out a live session for account, returns the connection or False
+        if unable to connect (reason is in account.connect_err, same as
+        pop_connect).  waits up to wait seconds (checkout_wait by default) if
+        the session is checked out already, connect_err is BUSY if it doesn't
+        come back in time
+        """
+        if wait is None:
+            wait = self.checkout_wait
+        key = account_key(account)
+        self.close_idle()
+        deadline = time.monotonic() + wait
+        with self.returned:
+            while key in self.checked_out:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    account.connect_err = BUSY
+                    metrics.count('sessions_busy', 1, account)
+                    return False
+                self.returned.wait(remaining)
+            session = self.sessions.pop(key, None)
+            # --- key is reserved while the session is probed or opened ---
+            self.checked_out[key] = session
+        #
+        now = time.monotonic()
+        try:
+            if session is not None:
+                if now - session.opened >= self.max_age:
+                    # --- maildrop is a snapshot from login, log in again to see new mail ---
+                    self._quit(session.connection)
+                    session = None
+                elif now - session.last_used >= self.probe_after:
+                    try:
+                        session.connection.noop()
+                    except Exception:
+                        self._close(session.connection)
+                        session = None
+            if session is None:
+                account.pop_connect()
+                if account.connection:
+                    session = PooledSession(account.connection, now)
+        except Exception:
+            session = None
+            raise
+        finally:
+            with self.returned:
+                if session is None:
+                    self.checked_out.pop(key, None)
+                    self.returned.notify_all()
+                else:
+                    session.last_used = now
+                    self.checked_out[key] = session
+        return session.connection if session is not None else False
+
+    def put(self, account, connection):
+        """
+        checks a session back in for account (or adds one opened some other
+        way), replaces any session already in the pool for it
+        """
+        key = account_key(account)
+        now = time.monotonic()
+        evicted = []
+        with self.returned:
+            session = self.checked_out.pop(key, None)
+            if session is None or session.connection is not connection:
+                session = PooledSession(connection, now)
+            session.last_used = now
+            old = self.sessions.pop(key, None)
+            if old is not None and old.connection is not connection:
+                evicted.append(old)
+            while self.sessions and len(self.sessions) + len(self.checked_out) >= self.max_sessions:
+                oldest = min(self.sessions, key=lambda k: self.sessions[k].last_used)
+                evicted.append(self.sessions.pop(oldest))
+            if len(self.checked_out) < self.max_sessions:
+                self.sessions[key] = session
+            else:
+                evicted.append(session)
+            self.returned.notify_all()
+        for session in evicted:
+            self._quit(session.connection)
+        if evicted:
+            metrics.count('sessions_evicted', len(evicted), account)
+
+    # --------------------------------------------------------------------------
+    def discard(self, account, quit=True):
+        """
+        drop the session for account instead of putting it back, call after
+        an error on a checked out connection so the next get() opens a new
+        one.  also closes a session sitting in the pool for account.
+        quit=False skips the QUIT for sessions that are known to be broken
+        """
+        key = account_key(account)
+        with self.returned:
+            sessions = [self.checked_out.pop(key, None), self.sessions.pop(key, None)]
+            self.returned.notify_all()
+        for session in sessions:
+            if session is None:
+                continue
+            if quit:
+                self._quit(session.connection)
+            else:
+                self._close(session.connection)
+
+    def close_idle(self, now=None):
+        """ QUIT every pooled session that hasn't been used for idle_timeout seconds """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            idle = [
+                key for key, session in self.sessions.items()
+                if now - session.last_used >= self.idle_timeout
+            ]
+            idle = [self.sessions.pop(key) for key in idle]
+        for session in idle:
+            self._quit(session.connection)
+
+    def close_all(self):
+        """ QUIT every session in the pool (checked out ones are left alone), called at exit """
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            self._quit(session.connection)
+
+    # --------------------------------------------------------------------------
+    def _quit(self, connection):
+        try:
+            connection.quit()
+        except Exception:
+            self._close(connection)
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def __len__(self):
+        return len(self.sessions) + len(self.checked_out)
+
+POOL = ConnectionManager()
+atexit.register(POOL.close_all)
@@ -0,0 +1,184 @@
+"""
+full text index behind MailAcct.search_emails / search_threads
+
+two backends, picked per database connection:
+    - sqlite with FTS5 available: a trigram FTS5 table keyed on EmailObj.id,
+    trigram queries are substring matches so the results line up with the
+    cleantext__icontains filters they narrow down
+    - anything else: SearchTerm/SearchPosting tables, a vocabulary of the
+    trigrams of the words in cleantext and which emails they show up in.  a
+    search word is looked up by its trigrams (exact, indexed term matches),
+    any email containing the word has all of them
+
+either way the index only narrows the queryset, the original icontains filters
+still run on the candidates so search results don't change.
+
+the index is kept up to date by new_eml_object/save_eml_batch (index_emails)
+and EmailObj.remove (unindex_emails), maintenance.rebuild_search_index fills it
+for existing mail.
+"""
+# --- django imports ---
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.models import Count
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length
+from django.dispatch import receiver
+
+# --- custom/project imports ---
+from scarifmail import models
+
+FTS_TABLE = 'scarifmail_emailfts'
+TRIGRAM = 3 # trigram index can't match anything shorter
+CHUNK = 500 # max params per IN (...) list
+
+# ------------------------------------------------------------------------------
+@receiver(connection_created)
+def create_fts_table(sender, connection, **kwargs):
+    """
+    creates the FTS5 table as each connection opens.  that is before any
+    transaction, so a rollback can't take the table with it.  whether it
+    worked is kept on the connection for use_fts
+    """
+    connection.scarifmail_fts = False
+    if connection.vendor != 'sqlite':
+        return
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s "
+                "USING fts5(cleantext, tokenize='trigram')" % FTS_TABLE
+            )
+        connection.scarifmail_fts = True
+    except Exception:
+        # --- sqlite built without fts5 or older than 3.34 (no trigram) ---
+        pass
+
+def use_fts() -> bool:
+    """
+    True if the FTS5 table can be used (see create_fts_table)
+    """
+    connection.ensure_connection()
+    return getattr(connection, 'scarifmail_fts', False)
+
+# ------------------------------------------------------------------------------
+def _chunks(items, size=CHUNK):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _trigrams(word) -> set:
+    return set(word[i:i + TRIGRAM] for i in range(len(word) - TRIGRAM + 1))
+
+def _terms(cleantext) -> set:
+    terms = set()
+    for word in set(cleantext.split()):
+        terms |= _trigrams(word)
+    return terms
+
+# ------------------------------------------------------------------------------
+def index_emails(emails):
+    """
+    add (or refresh) index entries for a list of saved EmailObjs
+    """
+    emails = [email for email in emails if email.pk and email.cleantext]
+    if not emails:
+        return
+    #
+    if use_fts():
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO %s (rowid, cleantext) VALUES (%%s, %%s)" % FTS_TABLE,
+                [(email.pk, email.cleantext) for email in emails],
+            )
+        return
+    #
+    email_terms = {email.pk: _terms(email.cleantext) for email in emails}
+    vocabulary = set().union(*email_terms.values())
+    term_pks = {}
+    for chunk in _chunks(vocabulary):
+        term_pks.update(
+            models.SearchTerm.objects.filter(term__in=chunk).values_list('term', 'pk')
+        )
+    missing = [models.SearchTerm(term=term) for term in vocabulary if term not in term_pks]
+    if missing:
+        models.SearchTerm.objects.bulk_create(missing, ignore_conflicts=True)
+        for chunk in _chunks(term.term for term in missing):
+            term_pks.update(
+                models.SearchTerm.objects.filter(term__in=chunk).values_list('term', 'pk')
+            )
+    #
+    models.SearchPosting.objects.bulk_create(
+        [
+            models.SearchPosting(term_id=term_pks[term], email_id=email_pk)
+            for email_pk, terms in email_terms.items()
+            for term in terms
+        ],
+        ignore_conflicts=True,
+    )
+
+# ------------------------------------------------------------------------------
+def unindex_emails(email_pks):
+    """
+    drop index entries for the given EmailObj primary keys
+    """
+    email_pks = [pk for pk in email_pks if pk]
+    if not email_pks:
+        return
+    if use_fts():
+        with connection.cursor() as cursor:
+            for chunk in _chunks(email_pks):
+                cursor.execute(
+                    "DELETE FROM %s WHERE rowid IN (%s)" % (FTS_TABLE, ", ".join(["%s"] * len(chunk))),
+                    chunk,
+                )
+        return
+    for chunk in _chunks(email_pks):
+        models.SearchPosting.objects.filter(email_id__in=chunk).delete()
+
+# ------------------------------------------------------------------------------
+def narrow(queryset, searchstr, exact_match=False):
+    """
+    restricts an EmailObj queryset to the index candidates for searchstr
+    (already lower case).  words the index can't help with are left to the
+    icontains filters the caller runs afterwards
+    """
+    if exact_match:
+        words = [searchstr] if searchstr.strip() else []
+    else:
+        words = searchstr.split()
+    #
+    if use_fts():
+        words = [word for word in words if len(word) >= TRIGRAM]
+        if not words:
+            return queryset
+        query = " AND ".join('"%s"' % word.replace('"', '""') for word in words)
+        return queryset.filter(pk__in=RawSQL(
+            "SELECT rowid FROM %s WHERE %s MATCH %%s" % (FTS_TABLE, FTS_TABLE),
+            [query],
+        ))
+    #
+    # --- every trigram of every word (of the phrase) has to be in the email ---
+    trigrams = set()
+    for word in searchstr.split():
+        trigrams |= _trigrams(word)
+    if not trigrams:
+        return queryset
+    term_pks = list(models.SearchTerm.objects.filter(term__in=trigrams).values_list('pk', flat=True))
+    if len(term_pks) < len(trigrams):
+        # --- a trigram no email has, nothing can match ---
+        return queryset.none()
+    return queryset.filter(pk__in=models.SearchPosting.objects.filter(term_id__in=term_pks)
+        .values('email_id').annotate(found=Count('term_id')).filter(found=len(term_pks))
+        .values('email_id'))
+
+# ------------------------------------------------------------------------------
+def drop_stale_terms() -> int:
+    """
+    removes SearchTerm rows (and their postings) that aren't trigrams, left
+    over from indexes built from whole words.  returns number of terms removed
+    """
+    if use_fts():
+        return 0
+    deleted, counts = models.SearchTerm.objects.annotate(size=Length('term')).exclude(size=TRIGRAM).delete()
+    return counts.get(models.SearchTerm._meta.label, 0)
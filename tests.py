@@ -1,11 +1,15 @@
 # --- general imports ---
-import pdb
+import pdb, asyncio, datetime, email, email.policy, poplib, os, multiprocessing, socketserver, tempfile, threading, time
+from unittest import mock
 
 # --- django imports ---
-from django.test import TestCase
+from django.db import connection, transaction
+from django.test import TestCase, SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 # --- custom/project imports ---
-from scarifmail import models, controller
+from scarifmail import models, controller, aiopop, localpop, filterengine, textextract, benchmarks, metrics, poppool, emlstore, blobstore, attachindex, searchindex
 from . import customlog
 
 # ------------------------------------------------------------------------------
@@ -27,13 +31,15 @@ def iterate_emails():
 #
 # ------------------------------------------------------------------------------
 def test_getmail_full(account, testid, keep=False):
-    connection = account.get_connection()
+    with account.pop_session() as connection:
+        pass
     if not connection:
         customlog.writelog("tests", 'account: ' + str(account) + " - unable to connect")
         customlog.writelog("errorlog", 'account: ' + str(account) + " - unable to connect")
         return
 
     current_uidl = account.current_uidl
+    seen = account.seen_uidls()
     try:
         customlog.writelog("tests", 'account: ' + str(account))
         customlog.writelog("tests", 'started main driver')
@@ -50,14 +56,16 @@ def test_getmail_full(account, testid, keep=False):
 
     # --- delete everything if keep isn't True ---
     if not keep:
-        account.current_uidl = current_uidl
         account.reset_mailbox() # clears everything, including trash
+        account.mark_seen(list(seen))
+        account.current_uidl = current_uidl
         account.save()
 #
 # ------------------------------------------------------------------------------
 def test_get_one_email(account, testid, keep=False) -> object:
     # --- try running the test for one email on given account ---
-    connection = account.get_connection()
+    with account.pop_session() as connection:
+        pass
     if not connection:
         customlog.writelog("tests", 'account: ' + str(account) + " - unable to connect")
         customlog.writelog("errorlog", 'account: ' + str(account) + " - unable to connect")
@@ -98,6 +106,7 @@ def test_get_one_email(account, testid, keep=False) -> object:
     if eml_object:
         if not keep:
             # --- reset uidl position for account ---
+            account.forget_uidls([eml_object.uidl])
             account.current_uidl = current_uidl
             account.save()
             # --- delete email file ---
@@ -107,3 +116,901 @@ def test_get_one_email(account, testid, keep=False) -> object:
     return eml_object
 
 # ------------------------------------------------------------------------------
+class AsyncPOP3Tests(SimpleTestCase):
+    """
+    aiopop client against the in-process localpop server
+    """
+    MESSAGES = [
+        ('uidl-1', b'Subject: first\r\nMessage-ID: <1@test>\r\n\r\nhello\r\n.starts with a dot\r\n'),
+        ('uidl-2', b'Subject: second\r\n\r\nline 1\r\nline 2\r\nline 3\r\n'),
+    ]
+
+    def setUp(self):
+        self.server = localpop.LocalPOP3Server(self.MESSAGES).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    async def login(self):
+        conn = await aiopop.AsyncPOP3.connect('127.0.0.1', self.server.port, timeout=5)
+        await conn.user('test')
+        await conn.pass_('test')
+        return conn
+
+    # --------------------------------------------------------------------------
+    def test_listings(self):
+        async def run():
+            conn = await self.login()
+            count, size = await conn.stat()
+            resp, uidls, octets = await conn.uidl()
+            resp, sizes, octets = await conn.list()
+            single = await conn.uidl(2)
+            await conn.quit()
+            return count, uidls, sizes, single
+        #
+        count, uidls, sizes, single = asyncio.run(run())
+        self.assertEqual(count, 2)
+        self.assertEqual(models.parse_uidl_listing(uidls), [(1, 'uidl-1'), (2, 'uidl-2')])
+        self.assertEqual(len(sizes), 2)
+        self.assertEqual(single, b'+OK 2 uidl-2')
+
+    def test_retr_and_top(self):
+        async def run():
+            conn = await self.login()
+            resp, retr_lines, octets = await conn.retr(1)
+            resp, top_lines, octets = await conn.top(2, 1)
+            await conn.quit()
+            return retr_lines, top_lines
+        #
+        retr_lines, top_lines = asyncio.run(run())
+        # --- byte stuffed line comes back with a single dot ---
+        self.assertIn(b'.starts with a dot', retr_lines)
+        eml_message = models.build_eml_message(retr_lines, 'uidl-1')
+        self.assertEqual(eml_message['UIDL'], 'uidl-1')
+        self.assertEqual(eml_message['MSG-ID'], '1@test')
+        self.assertEqual(top_lines, [b'Subject: second', b'', b'line 1'])
+
+    def test_dele_applied_on_quit(self):
+        async def run():
+            conn = await self.login()
+            await conn.dele(1)
+            await conn.quit()
+            conn = await self.login()
+            resp, uidls, octets = await conn.uidl()
+            await conn.quit()
+            return uidls
+        #
+        # --- a new session numbers the remaining messages from 1 ---
+        self.assertEqual(asyncio.run(run()), [b'1 uidl-2'])
+
+    def test_bad_login(self):
+        async def run():
+            conn = await aiopop.AsyncPOP3.connect('127.0.0.1', self.server.port, timeout=5)
+            await conn.user('test')
+            try:
+                await conn.pass_('wrong')
+            finally:
+                conn.close()
+        #
+        with self.assertRaises(aiopop.POP3Error):
+            asyncio.run(run())
+
+    def test_line_too_long(self):
+        self.server.add_message('uidl-3', b'Subject: long\r\n\r\n' + b'x' * (2 ** 21) + b'\r\n')
+        async def run():
+            conn = await self.login()
+            try:
+                await conn.retr(3)
+            finally:
+                conn.close()
+        #
+        with self.assertRaises(aiopop.POP3Error):
+            asyncio.run(run())
+#
+# ------------------------------------------------------------------------------
+class AsyncFetchTests(TransactionTestCase):
+    """
+    controller.async_process_account end to end against localpop, the account
+    gets a plain (no SSL/STLS) async_pop_connect.  TransactionTestCase since
+    the ORM is used from sync_to_async's worker thread
+    """
+    def setUp(self):
+        self.server = localpop.LocalPOP3Server(AsyncPOP3Tests.MESSAGES).start()
+        self.account = models.MailAcct.objects.create(
+            address='async@localpop.test', user='test', password='test', server='127.0.0.1',
+            portno_in=self.server.port,
+        )
+        async def async_pop_connect():
+            conn = await aiopop.AsyncPOP3.connect('127.0.0.1', self.server.port, timeout=5)
+            await conn.user('test')
+            await conn.pass_('test')
+            return conn
+        self.account.async_pop_connect = async_pop_connect
+
+    def tearDown(self):
+        self.account.reset_mailbox()
+        self.server.stop()
+
+    def fetch(self):
+        return asyncio.run(controller.async_process_account(self.account, asyncio.Semaphore(1)))
+
+    def uidls(self):
+        return set(models.EmailObj.objects.filter(user=self.account).values_list('uidl', flat=True))
+
+    def test_fetch_and_resume(self):
+        self.assertFalse(self.fetch())
+        self.assertEqual(self.uidls(), {'uidl-1', 'uidl-2'})
+        self.assertEqual(models.EmailObj.objects.get(uidl='uidl-1').message_id, '1@test')
+        # --- second run only picks up what's new ---
+        self.server.add_message('uidl-3', b'Subject: third\r\n\r\nbody\r\n')
+        self.assertFalse(self.fetch())
+        self.assertEqual(self.uidls(), {'uidl-1', 'uidl-2', 'uidl-3'})
+        self.assertEqual(models.EmailObj.objects.filter(user=self.account).count(), 3)
+        stats = models.AccountStats.objects.get(account=self.account)
+        self.assertEqual((stats.remote_emails, stats.unread), (3, 0))
+#
+# ------------------------------------------------------------------------------
+def raw_message(uidl, message_id, subject, day, references=None) -> object:
+    """ build_eml_message for a small plain text message """
+    lines = [
+        b'From: Sender <sender@test>',
+        b'To: inbox@test',
+        b'Subject: ' + subject.encode(),
+        b'Date: %d Jan 2024 10:00:00 +0000' % day,
+        b'Message-ID: <' + message_id.encode() + b'>',
+    ]
+    if references:
+        lines.append(b'References: <' + references.encode() + b'>')
+    return models.build_eml_message(lines + [b'', b'body'], uidl)
+
+class BatchIngestTests(TestCase):
+    """
+    save_eml_batch threads and summaries match one at a time ingest
+    """
+    def setUp(self):
+        self.account = models.MailAcct.objects.create(address='batch@test', user='test', password='test', server='127.0.0.1')
+
+    def test_reply_marks_thread_unread(self):
+        first = raw_message('uidl-1', '1@test', 'hello', 2)
+        controller.save_eml_batch(self.account, [first])
+        thread = models.Thread.objects.get(user=self.account)
+        thread.mark_read()
+        #
+        reply = raw_message('uidl-2', '2@test', 're: hello', 3, references='1@test')
+        pairs = controller.save_eml_batch(self.account, [reply, raw_message('uidl-1', '1@test', 'hello', 2)])
+        self.assertEqual(len(pairs), 1)
+        thread.refresh_from_db()
+        self.assertTrue(thread.unread)
+        self.assertEqual((thread.email_count, thread.unread_count, thread.last_subject), (2, 1, 're: hello'))
+        self.assertEqual(models.EmailObj.objects.get(uidl='uidl-2').thread_id, thread.pk)
+
+    def test_summary_counts_add_to_row(self):
+        # --- counters add to what is in the row, an older reply leaves last_* alone ---
+        controller.save_eml_batch(self.account, [raw_message('uidl-1', '1@test', 'hello', 3)])
+        thread = models.Thread.objects.get(user=self.account)
+        models.Thread.objects.filter(pk=thread.pk).update(email_count=10, unread_count=0)
+        controller.save_eml_batch(self.account, [raw_message('uidl-2', '2@test', 're: hello', 2, references='1@test')])
+        thread.refresh_from_db()
+        self.assertEqual((thread.email_count, thread.unread_count, thread.last_subject), (11, 1, 'hello'))
+        self.assertEqual(thread.last_date.day, 3)
+
+    def test_filter_error_kept_on_email(self):
+        class Broken:
+            def tags_for(self, emailobj):
+                raise ValueError('broken filter')
+        models.Filter._compiled = Broken()
+        try:
+            pairs = controller.save_eml_batch(self.account, [raw_message('uidl-1', '1@test', 'hello', 2)])
+        finally:
+            models.Filter.reset_compiled()
+        email = models.EmailObj.objects.get(pk=pairs[0][1].pk)
+        self.assertTrue(email.error)
+        self.assertIn('broken filter', email.error_msg)
+        self.assertIsNotNone(email.thread_id)
+
+    def test_write_batch_no_row_updates(self):
+        # --- nothing write_file sets needs saving for plain messages ---
+        chunk = [raw_message('uidl-%d' % n, '%d@test' % n, 'hello %d' % n, 2) for n in range(3)]
+        with tempfile.TemporaryDirectory() as maildir, mock.patch.object(controller, 'MAILDIR', maildir), \
+                mock.patch.object(emlstore, 'STORE', emlstore.FileStore.name):
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(controller.write_batch(self.account, chunk))
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "scarifmail_emailobj"')]
+        self.assertEqual(updates, [])
+        self.assertEqual(models.EmailObj.objects.filter(user=self.account, attachment_index__isnull=True).count(), 3)
+#
+# ------------------------------------------------------------------------------
+class AccountStatsTests(TestCase):
+    """
+    MailAcct.stats only goes to the server for stale AccountStats
+    """
+    def setUp(self):
+        self.account = models.MailAcct.objects.create(address='stats@test', user='test', password='test', server='127.0.0.1')
+
+    def refreshed(self):
+        models.AccountStats.record(self.account, remote_emails=3, unread=1)
+
+    def test_attr_stats_never_connects(self):
+        with mock.patch.object(models.MailAcct, 'get_connection') as get_connection:
+            self.assertEqual(self.account.attr_stats['unread'], 'not checked yet')
+            models.AccountStats.objects.create(
+                account=self.account, connected=True, unread=2,
+                checked=timezone.now() - datetime.timedelta(days=1),
+            )
+            self.assertEqual(self.account.attr_stats['unread'], 2)
+        get_connection.assert_not_called()
+
+    def test_stale_row_refreshed_once(self):
+        models.AccountStats.objects.create(
+            account=self.account, connected=True, unread=2,
+            checked=timezone.now() - datetime.timedelta(seconds=120),
+        )
+        with mock.patch.object(models.MailAcct, 'refresh_server_stats', autospec=True,
+                               side_effect=lambda account: self.refreshed()) as refresh:
+            stats = self.account.stats(max_age=60)
+            self.assertEqual((stats['remote_emails'], stats['unread']), (3, 1))
+            # --- fresh now, read from the row ---
+            self.account.stats(max_age=60)
+        self.assertEqual(refresh.call_count, 1)
+#
+# ------------------------------------------------------------------------------
+class SeenUidlTests(TestCase):
+    """
+    new mail is the listing minus SeenUidl, rows gone from the server are pruned
+    """
+    def setUp(self):
+        self.account = models.MailAcct.objects.create(address='seen@test', user='test', password='test', server='127.0.0.1')
+
+    def test_new_positions_and_prune(self):
+        self.account.mark_seen(['a', 'b', 'c'])
+        snapshot = [(1, 'b'), (2, 'c'), (3, 'd')]
+        self.assertEqual(self.account.new_positions(snapshot), [(3, 'd')])
+        # --- 'a' is gone from the server ---
+        self.assertEqual(self.account.sync_server_state(snapshot), 1)
+        self.assertEqual(self.account.seen_uidls(), {'b', 'c'})
+        self.assertEqual(self.account.sync_server_state(snapshot), 0)
+
+    def test_emptied_mailbox_not_seeded_again(self):
+        self.account.mark_seen(['a', 'b'])
+        self.assertEqual(self.account.sync_server_state([]), 1)
+        # --- current_uidl is kept, a new message is the only new one ---
+        self.assertEqual(self.account.seen_uidls(), {'b'})
+        with mock.patch.object(models.MailAcct, 'seed_seen_uidls') as seed:
+            self.assertEqual(self.account.new_positions([(1, 'e')]), [(1, 'e')])
+        seed.assert_not_called()
+#
+# ------------------------------------------------------------------------------
+class BulkRemoveTests(TestCase):
+    """
+    EmailObj.bulk_remove chunks, trash failures and clear_all_mail
+    """
+    def setUp(self):
+        self.account = models.MailAcct.objects.create(address='remove@test', user='test', password='test', server='127.0.0.1')
+        controller.save_eml_batch(
+            self.account, [raw_message('uidl-%d' % n, '%d@test' % n, 'hello %d' % n, 2) for n in range(5)],
+        )
+
+    def test_chunks_and_progress(self):
+        calls = []
+        removed = models.EmailObj.bulk_remove(
+            self.account.get_related_emails(), delete_files=False, batch_size=2,
+            progress=lambda done, total: calls.append((done, total)),
+        )
+        self.assertEqual(removed, 5)
+        self.assertEqual(calls, [(2, 5), (4, 5), (5, 5)])
+        self.assertFalse(self.account.get_related_emails().exists())
+
+    def test_trash_failure_kept(self):
+        with mock.patch.object(models.EmailObj, 'trash_file', lambda email: email.uidl != 'uidl-1'):
+            removed = models.EmailObj.bulk_remove(self.account.get_related_emails(), batch_size=2)
+        self.assertEqual(removed, 4)
+        self.assertEqual(list(self.account.get_related_emails().values_list('uidl', flat=True)), ['uidl-1'])
+
+    def test_clear_all_mail_kept_emails(self):
+        # --- the email whose trash fails goes with its thread, unindexed and released ---
+        ref = {'sha256': 'ab' * 32}
+        models.EmailObj.objects.filter(user=self.account, uidl='uidl-1').update(blobs=[ref])
+        kept_pk = models.EmailObj.objects.get(user=self.account, uidl='uidl-1').pk
+        with mock.patch.object(models.EmailObj, 'trash_file', lambda email: email.uidl != 'uidl-1'), \
+                mock.patch.object(searchindex, 'unindex_emails') as unindex, \
+                mock.patch.object(models.AttachmentBlob, 'release') as release:
+            self.assertTrue(self.account.clear_all_mail())
+        self.assertIn(kept_pk, [pk for call in unindex.call_args_list for pk in call.args[0]])
+        release.assert_called_once_with([ref])
+        self.assertFalse(self.account.get_related_emails().exists())
+        self.assertFalse(models.Thread.objects.filter(user=self.account).exists())
+#
+# ------------------------------------------------------------------------------
+class FilterEngineTests(SimpleTestCase):
+    """
+    compiled filters should agree with Filter.filter_email
+    """
+    def setUp(self):
+        self.filters = [
+            models.Filter(pk=1, name='invoices', subject='Invoice', tag_id=10),
+            models.Filter(pk=2, name='boss', sender='boss@example.com', sender_exact_match=True, tag_id=11),
+            models.Filter(
+                pk=3, name='boss invoices', match_all=True,
+                subject='invoice', sender='boss@', tag_id=12,
+            ),
+            # --- overlapping substrings on the same field ---
+            models.Filter(pk=4, name='news', cleantext='newsletter', tag_id=13),
+            models.Filter(pk=5, name='letter', cleantext='letter', tag_id=14),
+            models.Filter(pk=6, name='no tag', subject='invoice'),
+        ]
+        self.compiled = filterengine.CompiledFilters(self.filters)
+
+    def check(self, emailobj):
+        expected = [i for i, f in enumerate(self.filters) if f.filter_email(emailobj)]
+        self.assertEqual(self.compiled.matching(emailobj), expected)
+
+    # --------------------------------------------------------------------------
+    def test_matches_filter_email(self):
+        emails = [
+            models.EmailObj(subject='Your INVOICE', sender='boss@example.com', recipient='me@example.com', cleantext='weekly newsletter'),
+            models.EmailObj(subject='hello', sender='someone@example.com', recipient='me@example.com', cleantext='a letter'),
+            models.EmailObj(subject='invoice 12', sender='Boss@Example.com', recipient='me@example.com', cleantext=''),
+        ]
+        for emailobj in emails:
+            self.check(emailobj)
+
+    def test_tags(self):
+        emailobj = models.EmailObj(
+            subject='invoice', sender='boss@example.com', recipient='me@example.com',
+            cleantext='the newsletter',
+        )
+        self.assertEqual(self.compiled.tags_for(emailobj), [10, 11, 12, 13, 14])
+#
+# ------------------------------------------------------------------------------
+class SearchTermTests(SimpleTestCase):
+    """
+    trigram terms of a substring are always among the terms of the text
+    """
+    def test_trigrams(self):
+        terms = searchindex._terms('quarterly invoice attached')
+        self.assertIn('inv', terms)
+        self.assertNotIn('y i', terms)
+        for word in ('voic', 'invoice', 'arterl', 'ched'):
+            self.assertTrue(searchindex._trigrams(word) <= terms, word)
+        self.assertFalse(searchindex._trigrams('invoices') <= terms)
+        self.assertEqual(searchindex._trigrams('in'), set())
+
+class SearchIndexTests(TestCase):
+    """
+    the index still works after a transaction that used it rolled back
+    """
+    def test_after_rollback(self):
+        account = models.MailAcct.objects.create(address='search@test', user='test', password='test', server='127.0.0.1')
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                controller.save_eml_batch(account, [raw_message('uidl-1', '1@test', 'invoice', 2)])
+                raise ValueError('rolled back')
+        controller.save_eml_batch(account, [raw_message('uidl-2', '2@test', 'invoice', 2)])
+        email = models.EmailObj.objects.get(uidl='uidl-2')
+        email.cleantext = 'quarterly invoice attached'
+        searchindex.index_emails([email])
+        found = searchindex.narrow(models.EmailObj.objects.filter(user=account), 'invoice')
+        self.assertEqual(list(found), [email])
+#
+# ------------------------------------------------------------------------------
+class TextExtractTests(SimpleTestCase):
+    """
+    textextract should give the same cleantext as the BeautifulSoup path
+    """
+    DOCUMENTS = [
+        "<p>a<b>b</b> c</p>",
+        "plain text\n\n  body &amp; more",
+        "<div>x<script>var a = '<p>';</script>y</div>",
+        "<style>p {color: red}</style><title>T</title><p>caf&eacute; &#8212;&nbsp;x</p>",
+        "a < b and c > d",
+    ]
+
+    def test_same_as_soup(self):
+        for content in self.DOCUMENTS:
+            self.assertEqual(textextract.html_to_text(content), textextract.soup_text(content))
+
+    def test_limit(self):
+        content = "<p>" + "word " * 10000 + "</p>"
+        text = textextract.html_to_text(content, 100)
+        self.assertGreaterEqual(len(text), 100)
+        self.assertLess(len(text), 200)
+        self.assertEqual(text[:100], textextract.soup_text(content)[:100])
+#
+# ------------------------------------------------------------------------------
+class SyntheticCorpusTests(SimpleTestCase):
+    """
+    generated benchmark corpus should parse and be served as-is by localpop
+    """
+    def test_corpus(self):
+        corpus = benchmarks.synthetic_corpus(200, seed=3, max_refs=20)
+        self.assertEqual(corpus, benchmarks.synthetic_corpus(200, seed=3, max_refs=20))
+        types = set()
+        longest = 0
+        for uidl, raw in corpus:
+            msg = email.message_from_bytes(raw, policy=email.policy.default)
+            types.add(msg.get_content_type())
+            if msg['references']:
+                longest = max(longest, len(msg['references'].split()))
+        self.assertEqual(types, {'text/plain', 'text/html', 'multipart/mixed'})
+        self.assertEqual(longest, 19)
+
+    def test_served_by_localpop(self):
+        corpus = benchmarks.synthetic_corpus(5)
+        with localpop.LocalPOP3Server(corpus) as server:
+            conn = poplib.POP3('127.0.0.1', server.port, timeout=5)
+            conn.user('test')
+            conn.pass_('test')
+            resp, lines, octets = conn.retr(3)
+            conn.quit()
+        eml_message = models.build_eml_message(lines, corpus[2][0])
+        self.assertEqual(eml_message['UIDL'], 'bench-2')
+        # --- stored messages are joined with \n, the corpus has CRLF line endings ---
+        original = email.message_from_bytes(corpus[2][1].replace(b'\r\n', b'\n'), policy=email.policy.default)
+        self.assertEqual(eml_message['subject'], original['subject'])
+        self.assertEqual(eml_message.get_body().get_content(), original.get_body().get_content())
+#
+# ------------------------------------------------------------------------------
+class MetricsTests(SimpleTestCase):
+    """
+    stage timers are no-ops until a hook is installed, then land in the aggregator
+    """
+    def setUp(self):
+        self.hooks = list(metrics._hooks)
+        metrics.disable()
+        self.aggregator = metrics.Aggregator()
+
+    def tearDown(self):
+        metrics.disable()
+        for hook in self.hooks:
+            metrics.add_hook(hook)
+
+    def test_disabled(self):
+        self.assertIs(metrics.timer('retr'), metrics.NULL_TIMER)
+        with metrics.scope('a@example.com'), metrics.timer('retr'):
+            metrics.count('messages')
+        self.assertEqual(self.aggregator.histograms, {})
+
+    def test_scope_and_exposition(self):
+        metrics.add_hook(self.aggregator)
+        with metrics.scope('a@example.com'):
+            with metrics.timer('retr'):
+                pass
+            metrics.count('messages', 2)
+        metrics.observe('retr', 0.2, 'b@example.com')
+        self.assertEqual(
+            sorted(self.aggregator.histograms), [('retr', 'a@example.com'), ('retr', 'b@example.com')],
+        )
+        self.assertEqual(self.aggregator.counters, {('messages', 'a@example.com'): 2})
+        text = self.aggregator.exposition()
+        self.assertIn('scarifmail_stage_seconds_bucket{stage="retr",account="b@example.com",le="0.25"} 1', text)
+        self.assertIn('scarifmail_stage_seconds_bucket{stage="retr",account="b@example.com",le="0.1"} 0', text)
+        self.assertIn('scarifmail_stage_seconds_count{stage="retr",account="b@example.com"} 1', text)
+        self.assertIn('scarifmail_events_total{name="messages",account="a@example.com"} 2', text)
+#
+# ------------------------------------------------------------------------------
+class LogWriterTests(SimpleTestCase):
+    """
+    buffered customlog writer, lines land in order and logs rotate by size
+    """
+    def test_buffered_and_rotated(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            writer = customlog.LogWriter(log_dir, flush_interval=0.05, max_bytes=500)
+            for i in range(100):
+                writer.put('testlog', 'line %d' % i)
+            writer.close()
+            self.assertFalse(writer.thread.is_alive())
+            lines = []
+            for name in os.listdir(log_dir):
+                with open(os.path.join(log_dir, name)) as f:
+                    lines += [line.split(' ', 1)[1] for line in f.read().splitlines()]
+            self.assertGreater(len(os.listdir(log_dir)), 1)
+            self.assertEqual(sorted(lines, key=lambda line: int(line.split()[1])), ['line %d' % i for i in range(100)])
+            self.assertLess(os.path.getsize(os.path.join(log_dir, 'testlog')), 600)
+
+    def test_rotated_by_bytes(self):
+        # --- non-ascii lines are bigger on disk than they are long ---
+        with tempfile.TemporaryDirectory() as log_dir:
+            logfile = customlog.LogFile(os.path.join(log_dir, 'testlog'), max_bytes=100)
+            for i in range(10):
+                logfile.write('\u00e9' * 40 + '\n', time.time())
+            logfile.close()
+            # --- each line is 81 bytes, so a file never holds more than two ---
+            self.assertEqual(len(os.listdir(log_dir)), 5)
+            self.assertEqual(logfile.size, os.path.getsize(os.path.join(log_dir, 'testlog')))
+#
+# ------------------------------------------------------------------------------
+class ConnectionPoolTests(SimpleTestCase):
+    """
+    poppool sessions against localpop, accounts are stand ins with a plain
+    (no SSL/STLS) pop_connect
+    """
+    class Account:
+        def __init__(self, port, user='test'):
+            self.server, self.portno_in, self.user = '127.0.0.1', port, user
+            self.connection, self.connect_err, self.opened = False, "", 0
+
+        def pop_connect(self):
+            self.opened += 1
+            try:
+                connection = poplib.POP3(self.server, self.portno_in, timeout=5)
+                connection.user(self.user)
+                connection.pass_('test')
+                self.connection = connection
+            except Exception as e:
+                self.connection = False
+                self.connect_err = str(e)
+
+    def setUp(self):
+        self.server = localpop.LocalPOP3Server([('uidl-1', b'Subject: hi\r\n\r\nbody')]).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_reuse_and_probe(self):
+        pool = poppool.ConnectionManager(probe_after=60, max_age=60, idle_timeout=60)
+        account = self.Account(self.server.port)
+        first = pool.get(account)
+        pool.put(account, first)
+        other = self.Account(self.server.port)
+        self.assertIs(pool.get(other), first)
+        pool.put(other, first)
+        # --- broken session is found by the probe and replaced ---
+        first.close()
+        pool.probe_after = 0
+        second = pool.get(account)
+        self.assertIsNot(second, first)
+        self.assertEqual(second.stat()[0], 1)
+        self.assertEqual(account.opened, 2)
+        pool.put(account, second)
+        pool.close_all()
+        self.assertEqual(len(pool), 0)
+
+    def test_checkout_is_exclusive(self):
+        pool = poppool.ConnectionManager(probe_after=0, max_age=0, idle_timeout=0, checkout_wait=0)
+        account = self.Account(self.server.port)
+        connection = pool.get(account)
+        # --- checked out sessions aren't aged out, closed as idle or handed to anyone else ---
+        other = self.Account(self.server.port)
+        self.assertFalse(pool.get(other))
+        self.assertEqual(other.connect_err, poppool.BUSY)
+        pool.close_idle()
+        pool.close_all()
+        self.assertEqual(connection.stat()[0], 1)
+        self.assertEqual(account.opened, 1)
+        # --- a waiting get() picks the session up once it's put back ---
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(pool.get(other, wait=5)))
+        waiter.start()
+        time.sleep(0.1)
+        pool.put(account, connection)
+        waiter.join(5)
+        self.assertTrue(result[0])
+        pool.discard(other)
+        self.assertEqual(len(pool), 0)
+
+    def test_max_age_sees_new_mail(self):
+        pool = poppool.ConnectionManager(max_age=60)
+        account = self.Account(self.server.port)
+        connection = pool.get(account)
+        self.assertEqual(connection.stat()[0], 1)
+        pool.put(account, connection)
+        self.server.add_message('uidl-2', b'Subject: new\r\n\r\nbody')
+        connection = pool.get(account)
+        self.assertEqual(connection.stat()[0], 1)
+        pool.put(account, connection)
+        pool.max_age = 0
+        connection = pool.get(account)
+        self.assertEqual(connection.stat()[0], 2)
+        pool.put(account, connection)
+        pool.close_all()
+
+    def test_max_sessions(self):
+        pool = poppool.ConnectionManager(max_sessions=1)
+        account = self.Account(self.server.port, 'test')
+        pool.put(account, pool.get(account))
+        # --- second mailbox (login fails, localpop has one user) isn't kept ---
+        self.assertFalse(pool.get(self.Account(self.server.port, 'other')))
+        self.assertEqual(len(pool), 1)
+        # --- a session for another mailbox takes the only slot ---
+        extra = poplib.POP3('127.0.0.1', self.server.port, timeout=5)
+        pool.put(self.Account(self.server.port, 'other'), extra)
+        self.assertEqual(len(pool), 1)
+        self.assertIs(pool.get(self.Account(self.server.port, 'other')), extra)
+        pool.discard(self.Account(self.server.port, 'other'))
+        self.assertEqual(len(pool), 0)
+#
+# ------------------------------------------------------------------------------
+class FetchDeadlineTests(SimpleTestCase):
+    """
+    a RETR that is still trickling in at the deadline gets cut off
+    """
+    class SlowHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.wfile.write(b'+OK slow server\r\n')
+            self.rfile.readline()
+            self.wfile.write(b'+OK message follows\r\n')
+            try:
+                while True:
+                    self.wfile.write(b'still coming\r\n')
+                    time.sleep(0.05)
+            except OSError:
+                pass
+
+    def test_retr_cut_off(self):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), self.SlowHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            session = models.FetchSession.__new__(models.FetchSession)
+            session.connection = poplib.POP3('127.0.0.1', server.server_address[1], timeout=5)
+            session.deadline = time.monotonic() + 0.3
+            session.cut_off = False
+            start = time.monotonic()
+            with self.assertRaises(Exception):
+                session.retr(1)
+            self.assertTrue(session.cut_off)
+            self.assertLess(time.monotonic() - start, 2)
+            session.connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+#
+# ------------------------------------------------------------------------------
+class EmlStoreTests(SimpleTestCase):
+    """
+    compressed .eml files read back the same as plain ones
+    """
+    RAW = b'Subject: hi\r\nMessage-ID: <1@test>\r\n\r\n' + b'body line\r\n' * 200
+
+    def test_write_and_convert(self):
+        with tempfile.TemporaryDirectory() as store:
+            path = os.path.join(store, 'uidl-1.eml' + emlstore.suffix('gzip'))
+            with emlstore.open_eml(path, 'wb') as f:
+                f.write(self.RAW)
+            self.assertLess(os.path.getsize(path), len(self.RAW))
+            self.assertEqual(emlstore.raw_size(path), len(self.RAW))
+            #
+            plain = emlstore.convert(path, None)
+            self.assertEqual(plain, os.path.join(store, 'uidl-1.eml'))
+            self.assertEqual(os.listdir(store), ['uidl-1.eml'])
+            with emlstore.open_eml(plain) as f:
+                self.assertEqual(f.read(), self.RAW)
+            self.assertEqual(emlstore.convert(plain, None), plain)
+
+    # --------------------------------------------------------------------------
+    def test_segment_store(self):
+        """ records read back by offset, deletes tombstone, compaction keeps the live ones """
+        class Email:
+            pk = None
+            store_offset = store_length = None
+            def __init__(self, uidl, fileloc):
+                self.uidl = uidl
+                self.fileloc = fileloc
+        #
+        with tempfile.TemporaryDirectory() as maildir:
+            store = emlstore.SegmentStore(segment_bytes=len(self.RAW) * 2, compression=None)
+            emails = []
+            for n in range(5):
+                email = Email('uidl-%d' % n, os.path.join(maildir, 'uidl-%d.eml' % n))
+                store.write(email, self.RAW + str(n).encode())
+                emails.append(email)
+            segments = store.segments(os.path.join(maildir, 'segments'))
+            self.assertGreater(len(segments), 1)
+            for n, email in enumerate(emails):
+                self.assertEqual(emlstore.store_for(email).name, 'segments')
+                self.assertEqual(store.read(email.fileloc, email.store_offset, email.store_length), self.RAW + str(n).encode())
+            #
+            first = [email for email in emails if email.fileloc == segments[0]]
+            store.delete(first[0])
+            self.assertEqual(store.tombstones(segments[0]), [(first[0].store_offset, first[0].store_length)])
+            moved = store.compact(segments[0], [(e.uidl, e.store_offset, e.store_length) for e in first])
+            self.assertEqual(set(moved), {e.uidl for e in first[1:]})
+            store.remove_segment(segments[0])
+            for email in first[1:]:
+                path, offset, length = moved[email.uidl]
+                self.assertNotEqual(path, segments[0])
+                self.assertEqual(store.unpack(store.read_record(path, offset, length))[0], email.uidl)
+
+    def test_segment_writers_in_two_processes(self):
+        """ appends from separate processes (own SegmentStore each) get their own offsets """
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        #
+        def writer(name, directory):
+            store = emlstore.SegmentStore(segment_bytes=1 << 16, compression=None)
+            for n in range(200):
+                uidl = '%s-%d' % (name, n)
+                results.put((uidl,) + store.append(directory, store.pack(uidl, self.RAW * (n % 3 + 1))))
+        #
+        with tempfile.TemporaryDirectory() as maildir:
+            directory = os.path.join(maildir, 'segments')
+            workers = [context.Process(target=writer, args=(name, directory)) for name in ('a', 'b')]
+            for worker in workers:
+                worker.start()
+            records = [results.get(timeout=30) for n in range(400)]
+            for worker in workers:
+                worker.join(30)
+            store = emlstore.SegmentStore(compression=None)
+            for uidl, path, offset, length in records:
+                self.assertEqual(store.unpack(store.read_record(path, offset, length))[0], uidl)
+            spans = sorted((path, offset, offset + length) for uidl, path, offset, length in records)
+            for before, after in zip(spans, spans[1:]):
+                if before[0] == after[0]:
+                    self.assertLessEqual(before[2], after[1])
+
+    # --------------------------------------------------------------------------
+    def test_sharded_layout(self):
+        """ shard directories come from the uidl and are stripped again to find the mailbox """
+        with tempfile.TemporaryDirectory() as mailbox:
+            path = emlstore.shard_path(mailbox, 'uidl-1.eml.gz', levels=2)
+            shards = os.path.relpath(os.path.dirname(path), mailbox).split(os.sep)
+            self.assertEqual(shards, emlstore.shard_dirs('uidl-1', levels=2))
+            self.assertEqual([len(shard) for shard in shards], [emlstore.SHARD_WIDTH] * 2)
+            self.assertEqual(emlstore.mailbox_dir(path), mailbox)
+            self.assertEqual(emlstore.mailbox_dir(os.path.join(mailbox, 'uidl-1.eml')), mailbox)
+            #
+            flat = os.path.join(mailbox, 'uidl-1.eml.gz')
+            with emlstore.open_eml(flat, 'wb') as f:
+                f.write(self.RAW)
+            emlstore.place(flat, path)
+            os.remove(flat)
+            with emlstore.open_eml(path) as f:
+                self.assertEqual(f.read(), self.RAW)
+#
+# ------------------------------------------------------------------------------
+class BlobStoreTests(SimpleTestCase):
+    """
+    attachment bodies split out of a message rebuild it byte for byte
+    """
+    def test_split_and_rebuild(self):
+        corpus = benchmarks.synthetic_corpus(40, seed=5)
+        multipart = [raw for uidl, raw in corpus if b'multipart/mixed' in raw]
+        self.assertTrue(multipart)
+        with tempfile.TemporaryDirectory() as root:
+            blobs = blobstore.BlobStore(root, min_bytes=256)
+            for raw in multipart:
+                stub, refs, payloads = blobs.split(raw)
+                self.assertTrue(refs)
+                self.assertLess(len(stub), len(raw))
+                for digest, body in payloads.items():
+                    blobs.put(digest, body)
+                self.assertEqual(blobs.rebuild(stub, refs), raw)
+                #
+                original = email.message_from_bytes(raw, policy=email.policy.default)
+                attachments = {part.get_filename(): part.get_content() for part in original.iter_attachments()}
+                for ref in refs:
+                    self.assertEqual(blobs.payload(ref), attachments[ref['filename']])
+                # --- the stub is still a readable message ---
+                parsed = email.message_from_bytes(stub, policy=email.policy.default)
+                self.assertEqual(parsed.get_body(('plain',)).get_content(), original.get_body(('plain',)).get_content())
+#
+# ------------------------------------------------------------------------------
+class AttachmentBlobTests(TestCase):
+    """
+    reference counts decide when a blob file goes, a blob is only written
+    when it isn't stored
+    """
+    def test_acquire_and_release(self):
+        digest = 'ab' * 32
+        refs = [{'sha256': digest}]
+        payloads = {digest: b'payload'}
+        with tempfile.TemporaryDirectory() as root, mock.patch.object(models, 'BLOBS', blobstore.BlobStore(root)):
+            models.AttachmentBlob.acquire(refs * 2, payloads)
+            models.AttachmentBlob.release(refs)
+            self.assertEqual(models.AttachmentBlob.objects.get(sha256=digest).refcount, 1)
+            self.assertEqual(models.BLOBS.get(digest), b'payload')
+            models.AttachmentBlob.release(refs)
+            self.assertFalse(models.AttachmentBlob.objects.filter(sha256=digest).exists())
+            self.assertFalse(models.BLOBS.exists(digest))
+            # --- back after the last reference went, written again ---
+            models.AttachmentBlob.acquire(refs, payloads)
+            self.assertEqual(models.BLOBS.get(digest), b'payload')
+            self.assertEqual(models.AttachmentBlob.objects.get(sha256=digest).refcount, 1)
+
+    def test_stored_once(self):
+        digest = 'ab' * 32
+        refs = [{'sha256': digest}]
+        with tempfile.TemporaryDirectory() as root, mock.patch.object(models, 'BLOBS', blobstore.BlobStore(root)):
+            models.AttachmentBlob.acquire(refs, {digest: b'payload'})
+            # --- a duplicate doesn't touch the stored file ---
+            models.AttachmentBlob.acquire(refs, {digest: b'duplicate'})
+            self.assertEqual(models.BLOBS.get(digest), b'payload')
+            # --- row there but file gone, written again ---
+            models.BLOBS.remove(digest)
+            models.AttachmentBlob.acquire(refs, {digest: b'payload'})
+            self.assertEqual(models.BLOBS.get(digest), b'payload')
+            self.assertEqual(models.AttachmentBlob.objects.get(sha256=digest).refcount, 3)
+
+    def test_remove_releases_when_trash_fails(self):
+        # --- only email of its thread, the thread delete takes the row ---
+        account = models.MailAcct.objects.create(address='blobs@test', user='test', password='test', server='127.0.0.1')
+        pairs = controller.save_eml_batch(account, [raw_message('uidl-1', '1@test', 'hello', 2)])
+        email = models.EmailObj.objects.get(pk=pairs[0][1].pk)
+        email.blobs = [{'sha256': 'ab' * 32}]
+        with mock.patch.object(models.EmailObj, 'trash_file', return_value=False), \
+                mock.patch.object(models.AttachmentBlob, 'release') as release:
+            email.remove()
+        release.assert_called_once_with(email.blobs)
+        self.assertFalse(models.EmailObj.objects.filter(pk=email.pk).exists())
+#
+# ------------------------------------------------------------------------------
+class AttachIndexTests(SimpleTestCase):
+    """
+    attachments read from their span decode the same as a full parse
+    """
+    def test_scan_and_decode(self):
+        corpus = benchmarks.synthetic_corpus(40, seed=7)
+        checked = 0
+        for uidl, raw in corpus:
+            original = email.message_from_bytes(raw, policy=email.policy.default)
+            expected = [part.get_content() for part in original.iter_attachments()]
+            index = attachindex.build_index(attachindex.scan(raw), raw)
+            self.assertEqual(len(index), len(expected))
+            for entry, content in zip(index, expected):
+                end = entry['offset'] + entry['length']
+                chunks = (raw[n:min(n + 100, end)] for n in range(entry['offset'], end, 100))
+                self.assertEqual(b''.join(attachindex.decode_chunks(chunks, entry['encoding'])), content)
+                checked += 1
+        self.assertGreater(checked, 0)
+
+    def test_store_ranges(self):
+        """ plain files are mapped, compressed files and segment records read the same range """
+        raw = next(raw for uidl, raw in benchmarks.synthetic_corpus(40, seed=7) if b'multipart/mixed' in raw)
+        entry = attachindex.build_index(attachindex.scan(raw), raw)[0]
+        expected = raw[entry['offset']:entry['offset'] + entry['length']]
+
+        class Email:
+            pk = None
+            uidl = 'uidl-1'
+            store_offset = store_length = None
+        #
+        with tempfile.TemporaryDirectory() as maildir:
+            for compression in (None, 'gzip'):
+                email_obj = Email()
+                email_obj.fileloc = os.path.join(maildir, 'uidl-1.eml' + emlstore.suffix(compression))
+                emlstore.FileStore().write(email_obj, raw)
+                chunks = emlstore.FileStore().iter_range(email_obj, entry['offset'], entry['length'], 1000)
+                self.assertEqual(b''.join(chunks), expected)
+                #
+                segments = emlstore.SegmentStore(compression=compression)
+                segments.write(email_obj, raw)
+                chunks = segments.iter_range(email_obj, entry['offset'], entry['length'], 1000)
+                self.assertEqual(b''.join(chunks), expected)
+#
+# ------------------------------------------------------------------------------
+class MessageStructureTests(SimpleTestCase):
+    """
+    body part recorded at ingest is the one get_body picks
+    """
+    def test_body_part(self):
+        msg = email.message.EmailMessage()
+        msg['Subject'] = 'structure'
+        msg.set_content('plain body')
+        msg.add_alternative('<p>html body</p>', subtype='html')
+        msg.add_attachment(b'%PDF' * 10, maintype='application', subtype='pdf', filename='a.pdf')
+        structure = models.message_structure(msg)
+        self.assertEqual(structure['body_type'], 'text/html')
+        self.assertEqual(structure['attachment_count'], 1)
+        email_obj = models.EmailObj(structure=structure)
+        self.assertIs(email_obj.body_part(msg), msg.get_body(preferencelist=('html', 'related', 'plain')))
+        # --- recorded position doesn't fit the message, falls back to get_body ---
+        email_obj.structure = dict(structure, body_part=0)
+        self.assertEqual(email_obj.body_part(msg).get_content(), '<p>html body</p>\n')
+#
+# ------------------------------------------------------------------------------
+class ThreadSummaryTests(SimpleTestCase):
+    """
+    thread summary fields follow the latest email as emails are noted
+    """
+    def test_note_email(self):
+        thread = models.Thread(thread_id='<1@test>')
+        dates = [datetime.datetime(2024, 1, day, tzinfo=datetime.timezone.utc) for day in (2, 5, 3)]
+        for n, date in enumerate(dates):
+            thread.note_email(models.EmailObj(date=date, sender='s%d@test' % n, subject='subject %d ' % n * 50))
+        self.assertEqual(thread.email_count, 3)
+        self.assertEqual(thread.unread_count, 3)
+        self.assertEqual(thread.last_date, dates[1])
+        self.assertEqual(thread.last_sender, 's1@test')
+        self.assertEqual(len(thread.last_subject), models.Thread.SNIPPET_LENGTH)
+#
+# ------------------------------------------------------------------------------
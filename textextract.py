@@ -0,0 +1,114 @@
+"""
+streaming HTML to text for cleantext/search, replaces building a full
+BeautifulSoup tree just to read .text
+
+- script and style contents are dropped, entities are decoded
+- text is collected as the parser goes and parsing stops once limit
+characters have been collected
+- anything the parser chokes on is handed to BeautifulSoup instead
+
+html_to_text(content) gives the same result as
+" ".join(BeautifulSoup(content, "lxml").text.split()) for well formed input.
+"""
+
+import warnings
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup
+
+SKIP_TAGS = ('script', 'style')
+CHUNK = 4096 # most characters of text handled at a time when there is a limit
+
+# ------------------------------------------------------------------------------
+class _LimitReached(Exception):
+    pass
+
+# ******************************************************************************
+class TextExtractor(HTMLParser):
+    """
+    collects the text of a document
+
+    - collapse=True joins words with single spaces (like " ".join(text.split())),
+    collapse=False keeps the text exactly as it appears in the document
+    - limit is the number of characters needed, None reads everything
+    """
+    def __init__(self, limit=None, collapse=True):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.collapse = collapse
+        self.parts = []
+        self.length = 0
+        self.tail = ''   # word that may continue in the next chunk of text
+        self.skipping = 0
+
+    # --------------------------------------------------------------------------
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if self.skipping or not data:
+            return
+        if self.limit is None:
+            self.add(data)
+            return
+        # --- long runs of text are taken a piece at a time, never much more than is still needed ---
+        start = 0
+        while start < len(data):
+            size = min(CHUNK, max(self.limit - self.length + 1, 1))
+            self.add(data[start:start + size])
+            start += size
+            # --- length counts a separator after every word, the tail has none ---
+            if self.length + len(self.tail) > self.limit:
+                raise _LimitReached()
+
+    def add(self, data):
+        if not self.collapse:
+            self.parts.append(data)
+            self.length += len(data)
+            return
+        words = (self.tail + data).split()
+        if words and not data[-1].isspace():
+            # --- last word might carry on in the next chunk ---
+            self.tail = words.pop()
+        else:
+            self.tail = ''
+        for word in words:
+            self.parts.append(word)
+            self.length += len(word) + 1
+
+    # --------------------------------------------------------------------------
+    def text(self) -> str:
+        if not self.collapse:
+            return ''.join(self.parts)
+        parts = self.parts + [self.tail] if self.tail else self.parts
+        return ' '.join(parts)
+
+# ------------------------------------------------------------------------------
+def soup_text(content, collapse=True) -> str:
+    """ the BeautifulSoup version, used as a fallback """
+    warnings.filterwarnings('ignore', category=UserWarning, module='bs4')
+    text = BeautifulSoup(content, "lxml").text
+    if collapse:
+        return " ".join(text.split())
+    return text
+
+# ------------------------------------------------------------------------------
+def html_to_text(content, limit=None, collapse=True) -> str:
+    """
+    text of an html (or plain text) document, at least limit characters of it
+    when it is that long (callers still slice to the exact size they need)
+    """
+    extractor = TextExtractor(limit, collapse)
+    try:
+        extractor.feed(content)
+        extractor.close()
+    except _LimitReached:
+        pass
+    except Exception:
+        # --- malformed markup, let BeautifulSoup sort it out ---
+        return soup_text(content, collapse)
+    return extractor.text()